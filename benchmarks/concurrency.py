@@ -0,0 +1,66 @@
+"""
+Load test: latency of cheap entity lookups while heavy aggregations run on the
+same worker.
+
+    python benchmarks/concurrency.py [entity_id] [aggregation url]
+
+Requires a populated store (see `make followthemoney.store`) and the same env
+as the test suite (`FTM_STORE_URI`, `CATALOG`).
+"""
+
+import asyncio
+import statistics
+import sys
+import time
+
+from httpx import ASGITransport, AsyncClient
+
+from ftmstore_fastapi.api import app
+
+ENTITY_ID = "eu-authorities-chafea"
+HEAVY_URL = "/aggregate?aggCount=id&aggGroups=schema&aggMin=date&aggMax=date"
+LOOKUPS = 200
+HEAVY = 20
+
+
+def percentile(values: list[float], p: int) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+async def lookups(client: AsyncClient, entity_id: str) -> list[float]:
+    timings = []
+    for _ in range(LOOKUPS):
+        start = time.perf_counter()
+        res = await client.get(f"/entities/{entity_id}")
+        assert res.status_code == 200, res.text
+        timings.append((time.perf_counter() - start) * 1000)
+    return timings
+
+
+async def heavy(client: AsyncClient, url: str) -> None:
+    await asyncio.gather(*(client.get(url) for _ in range(HEAVY)))
+
+
+def report(label: str, timings: list[float]) -> None:
+    print(
+        f"{label:<24} p50: {statistics.median(timings):8.2f} ms   "
+        f"p99: {percentile(timings, 99):8.2f} ms"
+    )
+
+
+async def main(entity_id: str, url: str) -> None:
+    transport = ASGITransport(app=app)
+    async with AsyncClient(transport=transport, base_url="http://bench") as client:
+        await client.get(f"/entities/{entity_id}")  # warm up
+        report("idle", await lookups(client, entity_id))
+        timings, _ = await asyncio.gather(
+            lookups(client, entity_id), heavy(client, url)
+        )
+        report("with heavy /aggregate", timings)
+
+
+if __name__ == "__main__":
+    entity_id = sys.argv[1] if len(sys.argv) > 1 else ENTITY_ID
+    url = sys.argv[2] if len(sys.argv) > 2 else HEAVY_URL
+    asyncio.run(main(entity_id, url))
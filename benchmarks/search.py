@@ -0,0 +1,65 @@
+"""
+Search (`q`) for a page of entities: sql `LIKE` filters vs. the ranked
+full-text search index, on the test fixtures.
+
+    python benchmarks/search.py [search term]
+
+Requires the same env as the test suite (`FTM_STORE_URI`, `CATALOG`), set
+`ENTITY_CACHE_SIZE=0` to not serve the indexed results from the entity cache.
+"""
+
+import sys
+import tempfile
+import timeit
+
+from ftmstore_fastapi import settings
+from ftmstore_fastapi.query import Query, RetrieveParams
+from ftmstore_fastapi.search import get_search_index
+from ftmstore_fastapi.store import get_view
+
+TERMS = ("foundation", "data protection", "medecins", "found*")
+LIMIT = 100
+ROUNDS = 10
+REPEAT = 5
+
+
+def like(term: str) -> list[str]:
+    view = get_view()
+    query = Query()[:LIMIT].search(term.rstrip("*"))
+    return [e.id for e in view.query.entities(query)]
+
+
+def indexed(term: str) -> list[str]:
+    view = get_view()
+    params = RetrieveParams(
+        nested=False, featured=False, dehydrate=False, dehydrate_nested=False
+    )
+    query = Query()[:LIMIT].ranked_search(term, get_search_index().search(term))
+    return [e.id for e in view.get_ranked_entities(query, params)]
+
+
+def measure(func, *args) -> float:
+    """
+    Best of `REPEAT` runs (after warming up), in ms per call
+    """
+    func(*args)
+    timings = timeit.repeat(lambda: func(*args), number=ROUNDS, repeat=REPEAT)
+    return min(timings) / ROUNDS * 1000
+
+
+def main(terms: tuple[str, ...]) -> None:
+    settings.SEARCH_INDEX = True
+    settings.PRELOAD_PATH = tempfile.mkdtemp()
+    get_search_index()  # build the index
+    for term in terms:
+        like_ms = measure(like, term)
+        index_ms = measure(indexed, term)
+        print(
+            f"{term!r:>20}   like: {like_ms:8.2f} ms ({len(like(term)):>3})   "
+            f"index: {index_ms:8.2f} ms ({len(indexed(term)):>3})   "
+            f"({like_ms / index_ms:.1f}x)"
+        )
+
+
+if __name__ == "__main__":
+    main((sys.argv[1],) if len(sys.argv) > 1 else TERMS)
@@ -0,0 +1,77 @@
+"""
+Serialization of entity pages: pydantic response models vs. the direct
+(orjson) fast path, on the test fixtures.
+
+    python benchmarks/serialize.py [page size]
+
+Requires the same env as the test suite (`FTM_STORE_URI`, `CATALOG`).
+"""
+
+import sys
+import timeit
+from itertools import cycle, islice
+
+from fastapi import Request
+from ftmq.io import smart_read_proxies
+
+from ftmstore_fastapi.serialize import EntitiesResponse
+from ftmstore_fastapi.store import get_view
+
+FIXTURES = (
+    "./tests/fixtures/eu_authorities.ftm.json",
+    "./tests/fixtures/gdho.ftm.json",
+)
+PAGE_SIZES = (100, 1_000)
+ROUNDS = 10
+REPEAT = 5
+
+
+def get_request(limit: int) -> Request:
+    return Request(
+        {
+            "type": "http",
+            "scheme": "http",
+            "server": ("bench", 80),
+            "path": "/entities",
+            "query_string": f"limit={limit}".encode(),
+            "headers": [(b"host", b"bench")],
+        }
+    )
+
+
+def models(request: Request, entities, stats) -> bytes:
+    response = EntitiesResponse.from_view(request, entities, stats=stats)
+    return response.model_dump_json(by_alias=True).encode()
+
+
+def fast(request: Request, entities, stats) -> bytes:
+    return EntitiesResponse.dump_view(request, entities, stats=stats)
+
+
+def measure(func, *args) -> float:
+    """
+    Best of `REPEAT` runs (after warming up), in ms per call
+    """
+    func(*args)
+    timings = timeit.repeat(lambda: func(*args), number=ROUNDS, repeat=REPEAT)
+    return min(timings) / ROUNDS * 1000
+
+
+def main(page_sizes: tuple[int, ...]) -> None:
+    proxies = [p for f in FIXTURES for p in smart_read_proxies(f)]
+    stats = get_view().stats()
+    for size in page_sizes:
+        request = get_request(size)
+        entities = list(islice(cycle(proxies), size))
+        assert models(request, entities, stats) == fast(request, entities, stats)
+        slow_ms = measure(models, request, entities, stats)
+        fast_ms = measure(fast, request, entities, stats)
+        print(
+            f"{size:>5} entities   models: {slow_ms:8.2f} ms   "
+            f"fast path: {fast_ms:8.2f} ms   ({slow_ms / fast_ms:.1f}x)"
+        )
+
+
+if __name__ == "__main__":
+    sizes = (int(sys.argv[1]),) if len(sys.argv) > 1 else PAGE_SIZES
+    main(sizes)
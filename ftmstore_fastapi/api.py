@@ -1,25 +1,58 @@
 import secrets
+from collections.abc import AsyncGenerator, Callable
+from contextlib import asynccontextmanager
+from typing import Any
 
-from fastapi import Depends, FastAPI, Query, Request
+from fastapi import Depends, FastAPI, HTTPException, Query, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import RedirectResponse
+from fastapi.responses import StreamingResponse
+from ftmq.types import Schemata
 
 from ftmstore_fastapi import settings, views
+from ftmstore_fastapi.cache import get_cache_headers, is_not_modified
+from ftmstore_fastapi.concurrency import (
+    iterate_in_threadpool,
+    run_heavy_in_threadpool,
+    run_in_threadpool,
+)
+from ftmstore_fastapi.facets import get_facet_tables, is_facet
 from ftmstore_fastapi.logging import get_logger
-from ftmstore_fastapi.query import QueryParams
+from ftmstore_fastapi.metrics import metrics
+from ftmstore_fastapi.query import BatchParams, QueryParams
+from ftmstore_fastapi.resolver import get_resolver_map
+from ftmstore_fastapi.search import get_search_index
 from ftmstore_fastapi.serialize import (
     AggregationResponse,
     CatalogResponse,
     DatasetResponse,
+    EntitiesBatchResponse,
     EntitiesResponse,
     EntityResponse,
     ErrorResponse,
+    FacetsResponse,
+    SuggestResponse,
 )
 from ftmstore_fastapi.settings import FTM_STORE_URI
-from ftmstore_fastapi.store import Datasets
+from ftmstore_fastapi.stats import get_stats_futures
+from ftmstore_fastapi.store import Datasets, get_store_uri
+from ftmstore_fastapi.suggest import get_suggest_index
 
 log = get_logger(__name__)
 
+
+@asynccontextmanager
+async def lifespan(app: FastAPI) -> AsyncGenerator[None, None]:
+    await run_in_threadpool(get_store_uri)  # preload datasets at worker start
+    await run_in_threadpool(get_resolver_map)
+    await run_in_threadpool(get_search_index)
+    await run_in_threadpool(get_facet_tables)
+    if settings.SUGGEST_PRELOAD:
+        await run_in_threadpool(get_suggest_index)
+    if settings.DATASETS_STATS:
+        get_stats_futures()  # start computing dataset stats in the background
+    yield
+
+
 app = FastAPI(
     debug=settings.DEBUG,
     title=settings.TITLE,
@@ -27,16 +60,33 @@ app = FastAPI(
     description=settings.DESCRIPTION,
     redoc_url="/",
     version=settings.VERSION,
+    lifespan=lifespan,
 )
 app.add_middleware(
     CORSMiddleware,
     allow_origins=[*settings.ALLOWED_ORIGIN, "http://localhost:3000"],
-    allow_methods=["OPTIONS", "GET"],
+    allow_methods=["OPTIONS", "GET", "POST"],
 )
 
 log.info("Ftm store: %s" % FTM_STORE_URI)
 
 
+async def respond(
+    request: Request, view: Callable, *args, heavy: bool | None = False, **kwargs
+) -> Response:
+    """
+    Run a (cached) view in the thread pool with http cache headers, or return
+    `304 Not Modified` without touching the store if the client already has
+    the current version
+    """
+    headers = get_cache_headers(request, view, *args, **kwargs)
+    if is_not_modified(request, headers):
+        return Response(status_code=304, headers=headers)
+    run = run_heavy_in_threadpool if heavy else run_in_threadpool
+    res = await run(view, request, *args, **kwargs)
+    return res.to_response(request, headers)
+
+
 @app.get(
     "/catalog",
     response_model=CatalogResponse,
@@ -44,14 +94,14 @@ log.info("Ftm store: %s" % FTM_STORE_URI)
         500: {"model": ErrorResponse, "description": "Server error"},
     },
 )
-async def dataset_list(request: Request) -> CatalogResponse:
+async def dataset_list(request: Request) -> Response:
     """
     Show metadata for catalog (as described in
     [nomenklatura.DataCatalog](https://github.com/opensanctions/nomenklatura))
 
     This is basically a list of the available dataset within this api instance.
     """
-    return views.dataset_list(request)
+    return await respond(request, views.dataset_list, heavy=True)
 
 
 @app.get(
@@ -61,12 +111,12 @@ async def dataset_list(request: Request) -> CatalogResponse:
         500: {"model": ErrorResponse, "description": "Server error"},
     },
 )
-async def dataset_detail(request: Request, dataset: Datasets) -> DatasetResponse:
+async def dataset_detail(request: Request, dataset: Datasets) -> Response:
     """
     Show metadata for given dataset (as described in
     [nomenklatura.Dataset](https://github.com/opensanctions/nomenklatura))
     """
-    return views.dataset_detail(request, dataset)
+    return await respond(request, views.dataset_detail, dataset, heavy=True)
 
 
 def get_authenticated(
@@ -91,8 +141,9 @@ async def entities(
     request: Request,
     params: QueryParams = Depends(QueryParams),
     retrieve_params: views.RetrieveParams = Depends(views.get_retrieve_params),
+    stats_params: views.StatsParams = Depends(views.get_stats_params),
     authenticated: bool = Depends(get_authenticated),
-) -> EntitiesResponse:
+) -> Response:
     """
     Retrieve a paginated list of entities for the given dataset based on filter
     criteria.
@@ -103,6 +154,9 @@ async def entities(
     returned. This is e.g. useful for static site builders to reduce the data
     amount.
 
+    Use `props` to only include the given properties (they are filtered at the
+    store level): `/entities?props=name,country`
+
     ## dataset scope
 
     Limit entities filter to one or more datasets from the catalog:
@@ -140,13 +194,114 @@ async def entities(
     array is used as the sorting value. (The entity property dict remains
     uncasted, aka all properties are multi values as string)
 
+    If the store has precomputed sort keys (e.g. the preloaded mirror), numeric
+    and date properties are sorted via their index instead.
+
+    ## pagination
+
+    Use `page` and `limit`, or for walking through large result sets, the
+    opaque `cursor` from the `next_cursor` field of the previous response
+    (`next_url` and `prev_url` are cursor based). Each cursor page costs the
+    same, regardless of its depth.
+
+    ## stats
+
+    The total count and stats (schemata, countries, coverage) are shared across
+    all pages of the same filter criteria. Use `stats=false` to skip the stats
+    breakdown, or `total=estimate` to skip counting entirely.
+
     ## searching
 
     Search entities via the configured search backend.
 
-    Use optional `q` parameter for a search term.
+    Use optional `q` parameter for a search term. With the search index enabled,
+    results are ordered by relevance (unless `order_by` is given), and a
+    trailing `*` searches for a prefix, e.g. `q=amnes*`.
+    """
+    return await respond(
+        request,
+        views.entity_list,
+        retrieve_params,
+        authenticated=authenticated,
+        stats_params=stats_params,
+    )
+
+
+@app.get(
+    "/entities/stream",
+    response_class=StreamingResponse,
+    responses={
+        200: {
+            "content": {"application/x-ndjson": {}},
+            "description": "Line-based ftm json",
+        },
+        500: {"model": ErrorResponse, "description": "Server error"},
+    },
+)
+async def stream_entities(
+    request: Request,
+    params: QueryParams = Depends(QueryParams),
+    retrieve_params: views.RetrieveParams = Depends(views.get_retrieve_params),
+    authenticated: bool = Depends(get_authenticated),
+) -> Response:
+    """
+    Stream all entities matching the filter criteria (same as the entities
+    endpoint, but without pagination) as line-based
+    [FollowTheMoney](https://followthemoney.tech) json, e.g. for a full
+    dataset export:
+
+    `/entities/stream?dataset=my_dataset`
+
+    The response is gzip compressed on the fly if the client accepts it.
+    """
+    headers = get_cache_headers(
+        request, views.entity_stream, retrieve_params, authenticated=authenticated
+    )
+    if is_not_modified(request, headers):
+        return Response(status_code=304, headers=headers)
+    compress = "gzip" in request.headers.get("accept-encoding", "")
+    headers["Vary"] = "Accept-Encoding"
+    if compress:
+        headers["Content-Encoding"] = "gzip"
+    stream = views.entity_stream(request, retrieve_params, authenticated, compress)
+    return StreamingResponse(
+        iterate_in_threadpool(stream),
+        media_type="application/x-ndjson",
+        headers=headers,
+    )
+
+
+@app.post(
+    "/entities/batch",
+    response_model=EntitiesBatchResponse,
+    responses={
+        500: {"model": ErrorResponse, "description": "Server error"},
+    },
+)
+async def batch_entities(
+    request: Request,
+    params: BatchParams,
+    retrieve_params: views.RetrieveParams = Depends(views.get_retrieve_params),
+    authenticated: bool = Depends(get_authenticated),
+) -> Response:
+    """
+    Retrieve multiple entities by their ids in one request:
+
+        POST /entities/batch {"ids": ["id1", "id2", ...]}
+
+    Optionally inline (nest) adjacent entities for all of them.
+
+    Ids of entities that were merged into another entity are listed in
+    `redirects` (mapping to the new entity id), not existing ids in `missing`.
+    Unauthenticated requests are limited to `DEFAULT_LIMIT` ids.
     """
-    return views.entity_list(request, retrieve_params, authenticated=authenticated)
+    if not authenticated and len(params.ids) > settings.DEFAULT_LIMIT:
+        raise HTTPException(
+            422, detail=[f"Max. {settings.DEFAULT_LIMIT} ids per request."]
+        )
+    return await respond(
+        request, views.entity_batch, tuple(params.ids), retrieve_params
+    )
 
 
 @app.get(
@@ -162,7 +317,7 @@ async def detail_entity(
     request: Request,
     entity_id: str,
     retrieve_params: views.RetrieveParams = Depends(views.get_retrieve_params),
-) -> EntityResponse | RedirectResponse | ErrorResponse:
+) -> Response:
     """
     Retrieve a single entity within the given dataset.
 
@@ -175,7 +330,66 @@ async def detail_entity(
         `x-entity-id` - the new entity id
         `x-entity-schema` - the new entity schema
     """
-    return views.entity_detail(request, entity_id, retrieve_params)
+    return await respond(request, views.entity_detail, entity_id, retrieve_params)
+
+
+@app.get(
+    "/facets",
+    response_model=FacetsResponse,
+    responses={
+        500: {"model": ErrorResponse, "description": "Server error"},
+    },
+)
+async def facets(
+    request: Request,
+    params: QueryParams = Depends(QueryParams),
+    facet: list[str] = Query(
+        ..., description="Properties (or `schema`, `dataset`) to count values for"
+    ),
+    facet_limit: int = Query(
+        10, ge=1, le=settings.DEFAULT_LIMIT, description="Top values per facet"
+    ),
+) -> Response:
+    """
+    Number of matching entities per value of one or more facets for the given
+    filter criteria (same as the entities endpoint + search term), e.g. for
+    filter sidebars:
+
+    `/facets?facet=country&facet=schema&dataset=my_dataset`
+
+    Facets for a dataset (or all datasets) without further filters are served
+    from precomputed counts (`FACETS` setting).
+    """
+    invalid = [f for f in facet if not is_facet(f)]
+    if invalid:
+        raise HTTPException(422, detail=[f"Invalid facets: `{', '.join(invalid)}`"])
+    facets = tuple(dict.fromkeys(facet))  # unique, in order
+    return await respond(request, views.facets, facets, facet_limit, heavy=True)
+
+
+@app.get(
+    "/suggest",
+    response_model=SuggestResponse,
+    responses={
+        500: {"model": ErrorResponse, "description": "Server error"},
+    },
+)
+async def suggest(
+    request: Request,
+    prefix: str = Query(..., min_length=1, description="Caption prefix"),
+    schema: Schemata | None = Query(
+        None, description="Only suggest entities of this schema (or descendants)"
+    ),
+    limit: int = Query(10, ge=1, le=settings.DEFAULT_LIMIT),
+) -> Response:
+    """
+    Typeahead suggestions: entities (id, schema and caption) whose caption, or
+    a word within it, starts with the given prefix (case and diacritics
+    insensitive), e.g.
+
+    `/suggest?prefix=hope+fou&schema=Organization`
+    """
+    return await respond(request, views.suggest, prefix, schema, limit)
 
 
 @app.get(
@@ -189,8 +403,9 @@ async def aggregation(
     request: Request,
     params: QueryParams = Depends(QueryParams),
     aggregation_params: views.AggregationParams = Depends(views.get_aggregation_params),
+    stats_params: views.StatsParams = Depends(views.get_stats_params),
     authenticated: bool = Depends(get_authenticated),
-) -> AggregationResponse:
+) -> Response:
     """
     Aggregate property values for given filter criteria (same as entities
     endpoint + search term)
@@ -202,5 +417,19 @@ async def aggregation(
     multiple fields possible:
 
         ?aggMax=amount&aggMax=date
+
+    distinct counts (e.g. number of entities via `id`) and breakdowns by
+    groups (at most `AGGREGATION_GROUPS_LIMIT` biggest groups, computed in one
+    pass):
+
+        ?aggGroups=country&aggCount=id&aggSum=amount
+    """
+    return await respond(request, views.aggregation, stats_params, heavy=True)
+
+
+@app.get("/metrics", include_in_schema=False)
+async def get_metrics() -> dict[str, Any]:
+    """
+    Per-worker counters and timings (e.g. time spent for stats vs. entities)
     """
-    return views.aggregation(request)
+    return metrics.to_dict()
@@ -1,12 +1,393 @@
+import hashlib
+import json
+import secrets
+import struct
+import time
+from collections.abc import Callable, Generator
+from contextlib import contextmanager
+from datetime import timezone
+from email.utils import format_datetime, parsedate_to_datetime
+from functools import cache, wraps
+from threading import Lock
+from typing import TYPE_CHECKING, Any
+
+from anystore.exceptions import DoesNotExist
+from anystore.serialize import Mode, from_store, to_store
+from anystore.store import get_store
+from anystore.store.base import BaseStore
+from anystore.store.redis import RedisStore, get_redis
+from anystore.types import Model
 from fastapi import Request
 from normality import slugify
+from pydantic import BaseModel
 
 from ftmstore_fastapi import settings
+from ftmstore_fastapi.concurrency import SingleFlight, get_background_executor
+from ftmstore_fastapi.logging import get_logger
+from ftmstore_fastapi.lru import LRUCache
+from ftmstore_fastapi.metrics import metrics
+from ftmstore_fastapi.query import RetrieveParams, StatsParams, ViewQueryParams
+from ftmstore_fastapi.store import (
+    SCOPE_ALL,
+    entity_cache,
+    get_last_modified,
+    get_store_fingerprint,
+)
+
+if TYPE_CHECKING:
+    from ftmstore_fastapi.query import Query
+    from ftmstore_fastapi.store import View
+
+log = get_logger(__name__)
 
 PREFIX = f"ftmstore_fastapi:{settings.VERSION}:{slugify(settings.TITLE)}"
+HEADER = struct.Struct("!d")  # creation timestamp of stored entries
+LOCK_POLL_INTERVAL = 0.05
+
+# store version of the current cache entries
+_version: str | None = None
+_version_lock = Lock()
+
+# in-process tier in front of the (redis) cache store
+memory = LRUCache(
+    settings.CACHE_MEMORY_SIZE,
+    settings.CACHE_MEMORY_MB * 1024 * 1024,
+    settings.CACHE_MEMORY_TTL,
+    name="cache.memory",
+)
+
+
+def normalize(value: Any) -> Any:
+    """
+    Make a value json serializable with a stable representation, so that
+    equivalent parameters result in the same cache key
+    """
+    if isinstance(value, BaseModel):
+        value = value.model_dump(mode="json", by_alias=True)
+    if isinstance(value, dict):
+        return {str(k): normalize(v) for k, v in value.items()}
+    if isinstance(value, tuple):  # positional, keep order
+        return [normalize(v) for v in value]
+    if isinstance(value, (list, set)):
+        return sorted((normalize(v) for v in value), key=json.dumps)
+    return value
+
+
+def make_key(*parts: Any) -> str:
+    data = json.dumps(normalize(parts), sort_keys=True, default=str)
+    return hashlib.sha256(data.encode()).hexdigest()
+
+
+def get_request_params(
+    request: Request, authenticated: bool | None = False
+) -> dict[str, Any]:
+    """
+    Parsed query parameters with defaults filled in and the effective limit.
+    Parameters that are passed to the views as separate arguments (retrieve,
+    stats) are left out here.
+    """
+    params = ViewQueryParams.from_request(request, authenticated)
+    data = params.model_dump(mode="json", by_alias=True)
+    for key in set(RetrieveParams.model_fields) | set(StatsParams.model_fields):
+        data.pop(key, None)
+    if data.get("cursor"):  # takes precedence
+        data.pop("page", None)
+    return data
+
+
+def make_scope(*datasets: str | None) -> str:
+    """
+    The datasets a cache entry depends on, used for invalidation
+    """
+    return ",".join(sorted(set(d for d in datasets if d))) or SCOPE_ALL
+
+
+def get_key_scope(key: str) -> set[str]:
+    return set(key[len(PREFIX) + 1 :].split(":", 1)[0].split(","))
+
+
+def get_cache_version() -> str:
+    """
+    The store version the cache keys are based on. When it changes (the store
+    was rebuilt), the entries of the previous version are removed
+    """
+    global _version
+    version = get_store_fingerprint()
+    if version != _version:
+        with _version_lock:
+            if _version is not None and version != _version:
+                removed = invalidate()
+                log.info("Store changed, invalidated cache", removed=removed)
+            _version = version
+    return version
 
 
 def get_cache_key(request: Request, *args, **kwargs) -> str | None:
     if not settings.CACHE:
         return None
-    return f"{PREFIX}:{slugify(str(request.url))}"
+    authenticated = kwargs.pop("authenticated", False)
+    params = get_request_params(request, authenticated)
+    # responses contain absolute urls of the requested host
+    url = str(request.url.replace(query=""))
+    key = make_key(get_cache_version(), url, params, args, kwargs)
+    return f"{PREFIX}:{make_scope(*params['dataset'] or [])}:{key}"
+
+
+def get_etag(request: Request, *args, **kwargs) -> str:
+    """
+    A (weak) etag for the response of a view, based on the store version and
+    the normalized request. Takes the same arguments as the view.
+    """
+    authenticated = kwargs.pop("authenticated", False)
+    params = get_request_params(request, authenticated)
+    # responses contain absolute urls of the requested host
+    url = str(request.url.replace(query=""))
+    key = make_key(get_store_fingerprint(), url, params, args, kwargs)
+    return f'W/"{key[:32]}"'
+
+
+def get_cache_headers(
+    request: Request, view: Callable, *args, **kwargs
+) -> dict[str, str]:
+    headers = {
+        "etag": get_etag(request, *args, **kwargs),
+        "cache-control": settings.CACHE_CONTROL_VIEWS.get(
+            view.__name__, settings.CACHE_CONTROL
+        ),
+    }
+    last_modified = get_last_modified()
+    if last_modified is not None:
+        headers["last-modified"] = format_datetime(last_modified, usegmt=True)
+    return headers
+
+
+def is_not_modified(request: Request, headers: dict[str, str]) -> bool:
+    """
+    Conditional GET: compare the request's `If-None-Match` (or, if absent,
+    `If-Modified-Since`) with the response's cache headers. Doesn't apply to
+    other methods (e.g. the `POST` of batch lookups)
+    """
+    if request.method not in ("GET", "HEAD"):
+        return False
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        etag = headers["etag"].removeprefix("W/")
+        for value in if_none_match.split(","):
+            value = value.strip()
+            if value == "*" or value.removeprefix("W/") == etag:
+                return True
+        return False
+    if_modified_since = request.headers.get("if-modified-since")
+    last_modified = headers.get("last-modified")
+    if if_modified_since and last_modified:
+        try:
+            since = parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+        if since.tzinfo is None:
+            since = since.replace(tzinfo=timezone.utc)
+        return parsedate_to_datetime(last_modified) <= since
+    return False
+
+
+def get_query_key(query: "Query") -> str:
+    """
+    The query for the current store version
+    """
+    data = json.dumps(
+        [get_cache_version(), query.to_dict()], sort_keys=True, default=sorted
+    )
+    return hashlib.sha1(data.encode()).hexdigest()
+
+
+def get_stats_cache_key(view: "View", query: "Query", *args, **kwargs) -> str | None:
+    if not settings.CACHE:
+        return None
+    scope = make_scope(view.dataset, *query.dataset_names)
+    return f"{PREFIX}:{scope}:stats:{get_query_key(query)}"
+
+
+def get_count_cache_key(view: "View", query: "Query", *args, **kwargs) -> str | None:
+    if not settings.CACHE:
+        return None
+    scope = make_scope(view.dataset, *query.dataset_names)
+    return f"{PREFIX}:{scope}:count:{get_query_key(query)}"
+
+
+@cache
+def get_cache_store() -> BaseStore:
+    store = get_store(serialization_mode="raw").model_copy()
+    store.raise_on_nonexist = True
+    return store
+
+
+def _count(func: str, key: str) -> None:
+    metrics.incr(f"cache.{key}")
+    metrics.incr(f"cache.{func}.{key}")
+
+
+def _pack(data: bytes, created: float) -> bytes:
+    return HEADER.pack(created) + data
+
+
+def _unpack(data: bytes) -> tuple[float, bytes]:
+    return HEADER.unpack_from(data)[0], data[HEADER.size :]
+
+
+def is_fresh(created: float) -> bool:
+    return not settings.CACHE_TIMEOUT or time.time() - created < settings.CACHE_TIMEOUT
+
+
+def is_stale(created: float) -> bool:
+    """
+    Expired, but still within the stale-while-revalidate window
+    """
+    timeout = settings.CACHE_TIMEOUT + settings.CACHE_STALE_TIMEOUT
+    return not is_fresh(created) and time.time() - created < timeout
+
+
+@contextmanager
+def cluster_lock(key: str, blocking: bool | None = True) -> Generator[bool, None, None]:
+    """
+    Optional redis lock (`CACHE_LOCK=1`) to compute a cache entry only once
+    across all workers. Yields if the lock was acquired, waiting at most
+    `CACHE_LOCK_TIMEOUT` seconds if `blocking`.
+    """
+    store = get_cache_store()
+    if not settings.CACHE_LOCK or not isinstance(store, RedisStore):
+        yield True
+        return
+    con = get_redis(store.uri)
+    name = f"{store.get_key(key)}:lock"
+    token = secrets.token_hex(8)
+    timeout = settings.CACHE_LOCK_TIMEOUT
+    deadline = time.monotonic() + timeout
+    while not (acquired := con.set(name, token, nx=True, ex=timeout)):
+        if not blocking or time.monotonic() > deadline:
+            break
+        time.sleep(LOCK_POLL_INTERVAL)
+    try:
+        yield bool(acquired)
+    finally:
+        if acquired and con.get(name) == token.encode():
+            con.delete(name)
+
+
+def cached(
+    key_func: Callable[..., str | None],
+    serialization_mode: Mode | None = None,
+    model: Model | None = None,
+    serialize_func: Callable[[Any], Any] | None = None,
+    cache_if: Callable[[Any], bool] | None = None,
+) -> Callable:
+    """
+    Like `anystore.anycache`, but with an in-process lru tier (read-through,
+    write-through) in front of the cache store. Cache hits and misses are
+    counted (in total and per decorated function) for `/metrics`
+
+    On a miss, concurrent calls for the same key are coalesced so that only
+    one of them computes the result (optionally across workers, see
+    `cluster_lock`). Entries older than `CACHE_TIMEOUT` are still served for
+    `CACHE_STALE_TIMEOUT` seconds while they are refreshed in the background.
+    Results for which `cache_if` returns `False` are not stored.
+    """
+
+    def _compute(func: Callable, *args, **kwargs) -> Any:
+        res = func(*args, **kwargs)
+        if serialize_func is not None:
+            res = serialize_func(res)
+        return res
+
+    def _decorator(func: Callable) -> Callable:
+        name = func.__name__
+        flight = SingleFlight()
+
+        def _load(key: str) -> tuple[float, Any] | None:
+            try:
+                entry = memory.get(key)
+                metrics.incr("cache.memory.hit")
+                return entry
+            except KeyError:
+                metrics.incr("cache.memory.miss")
+            try:
+                created, data = _unpack(get_cache_store().get(key))
+            except DoesNotExist:
+                return None
+            entry = created, from_store(data, serialization_mode, model=model)
+            memory.put(key, entry, size=len(data), tags=get_key_scope(key))
+            return entry
+
+        def _store(key: str, res: Any) -> Any:
+            if cache_if is not None and not cache_if(res):
+                return res
+            data = to_store(res, serialization_mode, model=model)
+            created = time.time()
+            get_cache_store().put(key, _pack(data, created))
+            memory.put(key, (created, res), size=len(data), tags=get_key_scope(key))
+            return res
+
+        def _fill(key: str, *args, **kwargs) -> Any:
+            with cluster_lock(key):
+                if settings.CACHE_LOCK:  # another worker might just have done it
+                    entry = _load(key)
+                    if entry is not None and is_fresh(entry[0]):
+                        return entry[1]
+                return _store(key, _compute(func, *args, **kwargs))
+
+        def _refresh(key: str, *args, **kwargs) -> None:
+            try:
+                with cluster_lock(key, blocking=False) as acquired:
+                    if acquired:
+                        _store(key, _compute(func, *args, **kwargs))
+            except Exception as e:
+                log.error(f"Cache refresh failed: `{e}`", key=key)
+
+        @wraps(func)
+        def _inner(*args, **kwargs):
+            key = key_func(*args, **kwargs)
+            if key is None:
+                return _compute(func, *args, **kwargs)
+            entry = _load(key)
+            if entry is not None:
+                created, res = entry
+                if is_fresh(created):
+                    _count(name, "hit")
+                    return res
+                if is_stale(created):
+                    _count(name, "hit")
+                    _count(name, "stale")
+                    if not flight.is_running(key):
+                        get_background_executor().submit(
+                            flight.run, key, _refresh, key, *args, **kwargs
+                        )
+                    return res
+            _count(name, "miss")
+            if flight.is_running(key):
+                metrics.incr("cache.coalesced")
+            return flight.run(key, _fill, key, *args, **kwargs)
+
+        return _inner
+
+    return _decorator
+
+
+def invalidate(dataset: str | None = None) -> int:
+    """
+    Remove cached entries that depend on the given dataset (this includes
+    entries spanning all datasets) or all entries if no dataset given. Other
+    workers' in-process tiers expire after `CACHE_MEMORY_TTL` (and
+    `ENTITY_CACHE_TTL`).
+    """
+    entity_cache.invalidate(dataset)
+    if dataset is None:
+        removed = len(memory)
+        memory.clear()
+    else:
+        removed = memory.invalidate(dataset, SCOPE_ALL)
+    store = get_cache_store()
+    if isinstance(store, RedisStore):
+        con = get_redis(store.uri)
+        for key in store.iterate_keys(PREFIX):
+            if dataset is None or get_key_scope(key) & {dataset, SCOPE_ALL}:
+                removed += con.delete(store.get_key(key))
+    return removed
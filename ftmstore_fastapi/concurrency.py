@@ -0,0 +1,95 @@
+"""
+Dispatch blocking store and cache work off the event loop.
+
+All views are synchronous (sql queries, redis lookups), so the async routes
+hand them over to a bounded thread pool. Expensive views (aggregations,
+catalog stats) are additionally limited by a smaller pool so that they can't
+starve cheap entity lookups on the same worker.
+"""
+
+from collections.abc import AsyncGenerator, Callable, Iterable
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import cache, partial
+from threading import Lock
+from typing import Any, TypeVar
+
+from anyio import CapacityLimiter, to_thread
+
+from ftmstore_fastapi import settings
+
+T = TypeVar("T")
+
+
+@cache
+def get_limiter(heavy: bool | None = False) -> CapacityLimiter:
+    if heavy:
+        return CapacityLimiter(settings.MAX_HEAVY_CONCURRENCY)
+    return CapacityLimiter(settings.MAX_CONCURRENCY)
+
+
+@cache
+def get_background_executor() -> ThreadPoolExecutor:
+    """
+    Threads for work that shouldn't block a response, e.g. cache refreshes
+    """
+    return ThreadPoolExecutor(
+        settings.MAX_HEAVY_CONCURRENCY, thread_name_prefix="ftmstore-background"
+    )
+
+
+class SingleFlight:
+    """
+    Coalesce concurrent calls for the same key (within this worker): only the
+    first caller runs the function, the others wait for its result
+    """
+
+    def __init__(self) -> None:
+        self.lock = Lock()
+        self.calls: dict[str, Future] = {}
+
+    def is_running(self, key: str) -> bool:
+        return key in self.calls
+
+    def run(self, key: str, func: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+        with self.lock:
+            running = self.calls.get(key)
+            if running is None:
+                future = self.calls[key] = Future()
+        if running is not None:
+            return running.result()
+        try:
+            res = func(*args, **kwargs)
+            future.set_result(res)
+            return res
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self.lock:
+                self.calls.pop(key, None)
+
+
+async def run_in_threadpool(func: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+    return await to_thread.run_sync(
+        partial(func, *args, **kwargs), limiter=get_limiter()
+    )
+
+
+async def run_heavy_in_threadpool(
+    func: Callable[..., T], *args: Any, **kwargs: Any
+) -> T:
+    async with get_limiter(heavy=True):
+        return await run_in_threadpool(func, *args, **kwargs)
+
+
+async def iterate_in_threadpool(iterator: Iterable[T]) -> AsyncGenerator[T, None]:
+    """
+    Consume a blocking iterator (e.g. a streaming store query) chunk by chunk
+    in the thread pool
+    """
+    iterator = iter(iterator)
+    while True:
+        chunk = await run_in_threadpool(next, iterator, StopIteration)
+        if chunk is StopIteration:
+            break
+        yield chunk
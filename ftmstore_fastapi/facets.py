@@ -0,0 +1,220 @@
+"""
+Facet counts (`/facets`): the number of matching entities per value of some
+properties (or `schema`, `dataset`) for filter sidebars.
+
+The counts of the `FACETS` for each dataset and for all datasets are
+materialized once per store version into a read-only sqlite file at
+`PRELOAD_PATH` that all workers open as `immutable` and therefore share via
+the os page cache, so that unfiltered (or dataset-only) facets don't touch
+the store. Filtered facets are computed in one statement.
+"""
+
+import hashlib
+from collections.abc import Generator, Iterable
+from functools import cache
+from pathlib import Path
+
+from ftmq.enums import PropertyTypesMap
+from sqlalchemy import (
+    Column,
+    Engine,
+    Index,
+    Integer,
+    MetaData,
+    Table,
+    Unicode,
+    create_engine,
+    desc,
+    insert,
+    select,
+)
+
+from ftmstore_fastapi import settings
+from ftmstore_fastapi.logging import get_logger
+from ftmstore_fastapi.metrics import metrics
+from ftmstore_fastapi.preload import file_lock, get_prefix, remove_outdated
+from ftmstore_fastapi.query import Query
+from ftmstore_fastapi.store import (
+    SCOPE_ALL,
+    get_catalog,
+    get_exposed_datasets,
+    get_source_engine,
+    get_store_fingerprint,
+    get_view,
+)
+
+log = get_logger(__name__)
+
+FACETS_NAME = "ftmstore_fastapi_facets"
+FACET_FIELDS = {"schema", "dataset"}
+Counts = list[tuple[str, int]]
+
+metadata = MetaData()
+table = Table(
+    "facets",
+    metadata,
+    Column("scope", Unicode(255), nullable=False),
+    Column("facet", Unicode(255), nullable=False),
+    Column("value", Unicode(65535), nullable=False),
+    Column("count", Integer, nullable=False),
+    Index("ix_facets", "scope", "facet", "count"),
+)
+
+
+def is_facet(name: str) -> bool:
+    return name in FACET_FIELDS or name in PropertyTypesMap.__members__
+
+
+def get_facets_version() -> str:
+    parts = [get_store_fingerprint(), *settings.FACETS]
+    return hashlib.sha1(":".join(parts).encode()).hexdigest()
+
+
+def get_facets_prefix() -> str:
+    datasets = sorted(get_exposed_datasets() or [])
+    return get_prefix(FACETS_NAME, settings.FTM_STORE_URI, *datasets, *settings.FACETS)
+
+
+def get_facets_path(version: str) -> Path:
+    return Path(settings.PRELOAD_PATH) / f"{get_facets_prefix()}-{version[:16]}.db"
+
+
+def get_scopes() -> dict[str, list[str]]:
+    """
+    Datasets per materialized scope: each dataset and all datasets
+    """
+    datasets = sorted(get_catalog().names)
+    return {SCOPE_ALL: datasets, **{d: [d] for d in datasets}}
+
+
+def iter_counts(
+    engine: Engine, facets: Iterable[str], limit: int | None = None, **filters
+) -> Generator[tuple[str, str, int], None, None]:
+    query = Query().where(**filters) if filters else Query()
+    with engine.connect() as conn:
+        yield from conn.execute(query.sql.get_facet_counts(facets, limit)).tuples()
+
+
+def build(source: Engine, path: Path) -> int:
+    tmp_path = path.with_suffix(".tmp")
+    tmp_path.unlink(missing_ok=True)
+    engine = create_engine(f"sqlite:///{tmp_path}")
+    metadata.create_all(engine)
+    rows = 0
+    with engine.begin() as conn:
+        for scope, datasets in get_scopes().items():
+            filters: dict[str, list[str]] = {}
+            if datasets:
+                filters["dataset__in"] = datasets
+            batch = [
+                {"scope": scope, "facet": facet, "value": value, "count": count}
+                for facet, value, count in iter_counts(
+                    source, settings.FACETS, None, **filters
+                )
+            ]
+            if batch:
+                conn.execute(insert(table), batch)
+            rows += len(batch)
+    engine.dispose()
+    tmp_path.replace(path)
+    return rows
+
+
+class FacetTables:
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        self.engine = create_engine(
+            f"sqlite:///file:{path}?mode=ro&immutable=1&uri=true"
+        )
+
+    def get_counts(
+        self, scope: str, facets: Iterable[str], limit: int | None = None
+    ) -> dict[str, Counts]:
+        res: dict[str, Counts] = {}
+        with self.engine.connect() as conn:
+            for facet in facets:
+                q = (
+                    select(table.c.value, table.c.count)
+                    .where(table.c.scope == scope, table.c.facet == facet)
+                    .order_by(desc(table.c.count), table.c.value)
+                    .limit(limit)
+                )
+                res[facet] = [tuple(r) for r in conn.execute(q)]
+        return res
+
+
+@cache
+def load_tables(version: str) -> FacetTables:
+    """
+    Materialize the facet counts for this store version once (the first
+    process to get here computes them, the others wait)
+    """
+    path = get_facets_path(version)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with file_lock(path.with_suffix(".lock")):
+        if path.exists():
+            log.info("Using facet tables", path=str(path))
+        else:
+            with metrics.timer("facet_tables"), get_source_engine() as engine:
+                rows = build(engine, path)
+            log.info("Built facet tables", path=str(path), rows=rows)
+            remove_outdated(path, get_facets_prefix())
+    return FacetTables(path)
+
+
+def get_facet_tables() -> FacetTables | None:
+    if not settings.FACETS:
+        return None
+    try:
+        version = get_facets_version()
+        tables = load_tables(version)
+        if not tables.path.exists():  # removed in the meantime
+            load_tables.cache_clear()
+            tables = load_tables(version)
+        return tables
+    except Exception as e:
+        log.warning(f"Facet tables not available: {e}")
+        return None
+
+
+def get_scope(query: Query) -> str | None:
+    """
+    The materialized scope for a query that is only filtered by datasets
+    """
+    data = query.to_dict()
+    for key in ("dataset", "dataset__in", "limit", "offset"):
+        data.pop(key, None)
+    if data or query.search_filters:
+        return None
+    datasets = query.dataset_names or get_catalog().names
+    if len(datasets) == 1:
+        return list(datasets)[0]
+    if datasets == get_catalog().names:
+        return SCOPE_ALL
+    return None
+
+
+def get_facet_counts(
+    query: Query, facets: list[str], limit: int | None = None
+) -> dict[str, Counts]:
+    """
+    Top values with their number of entities for the given facets, from the
+    facet tables if possible
+    """
+    res: dict[str, Counts] = {}
+    scope = get_scope(query)
+    tables = get_facet_tables() if scope is not None else None
+    if scope is not None and tables is not None:
+        materialized = [f for f in facets if f in settings.FACETS]
+        res.update(tables.get_counts(scope, materialized, limit))
+    missing = [f for f in facets if f not in res]
+    if missing:
+        view = get_view()
+        query = view.query.ensure_scoped_query(query)
+        for facet in missing:
+            res[facet] = []
+        with metrics.timer("facets"):
+            sql = query.sql.get_facet_counts(missing, limit)
+            for facet, value, count in view.store._execute(sql, stream=False):
+                res[facet].append((value, count))
+    return {f: res[f] for f in facets}
@@ -0,0 +1,39 @@
+"""
+gunicorn config to build the shared store snapshot (`PRELOAD_DATASETS=1`,
+`PRELOAD_SHARED=1`), the resolver map (`RESOLVER`), the search index
+(`SEARCH_INDEX=1`), the facet tables (`FACETS`) and the suggest index
+(`SUGGEST_PRELOAD=1`) once in the master process before forking the workers:
+
+    gunicorn -c python:ftmstore_fastapi.gunicorn ftmstore_fastapi.api:app
+"""
+
+from ftmstore_fastapi import settings
+
+worker_class = "uvicorn.workers.UvicornWorker"
+
+
+def on_starting(server) -> None:
+    if settings.PRELOAD_DATASETS and settings.PRELOAD_SHARED:
+        from ftmstore_fastapi.store import get_store_uri
+
+        server.log.info("Store: %s" % get_store_uri())
+    if settings.RESOLVER:
+        from ftmstore_fastapi.resolver import load_map
+
+        server.log.info("Resolver map: %s" % load_map(settings.RESOLVER).path)
+    if settings.SEARCH_INDEX:
+        from ftmstore_fastapi.search import get_search_index
+
+        index = get_search_index()
+        if index is not None:
+            server.log.info("Search index: %s" % index.path)
+    if settings.FACETS:
+        from ftmstore_fastapi.facets import get_facet_tables
+
+        tables = get_facet_tables()
+        if tables is not None:
+            server.log.info("Facet tables: %s" % tables.path)
+    if settings.SUGGEST_PRELOAD:
+        from ftmstore_fastapi.suggest import load_index
+
+        server.log.info("Suggest index: %d entities" % len(load_index()))
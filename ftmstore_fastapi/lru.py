@@ -0,0 +1,111 @@
+"""
+A thread-safe in-process (per worker) LRU cache bounded by entry count and
+total size, with optional ttl and tags for invalidation. Named caches count
+their evictions at `/metrics`.
+"""
+
+import time
+from collections import OrderedDict
+from collections.abc import Hashable, Iterable
+from threading import Lock
+from typing import Any, NamedTuple
+
+from ftmstore_fastapi.metrics import metrics
+
+
+class Entry(NamedTuple):
+    value: Any
+    size: int
+    expires: float | None
+    tags: frozenset[str]
+
+
+class LRUCache:
+    def __init__(
+        self,
+        maxsize: int | None = 1_000,
+        maxbytes: int | None = None,
+        ttl: int | float | None = None,
+        name: str | None = None,
+    ) -> None:
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.ttl = ttl
+        self.name = name
+        self.lock = Lock()
+        self.data: OrderedDict[Hashable, Entry] = OrderedDict()
+        self.nbytes = 0
+
+    def __len__(self) -> int:
+        return len(self.data)
+
+    def __contains__(self, key: Hashable) -> bool:
+        try:
+            self.get(key)
+            return True
+        except KeyError:
+            return False
+
+    def get(self, key: Hashable) -> Any:
+        """
+        Get a value or raise `KeyError` if it doesn't exist or is expired
+        """
+        with self.lock:
+            entry = self.data[key]
+            if entry.expires is not None and entry.expires < time.monotonic():
+                self._remove(key)
+                raise KeyError(key)
+            self.data.move_to_end(key)
+            return entry.value
+
+    def put(
+        self,
+        key: Hashable,
+        value: Any,
+        size: int = 0,
+        tags: Iterable[str] | None = None,
+        ttl: int | float | None = None,
+    ) -> None:
+        if not self.maxsize:
+            return
+        if self.maxbytes and size > self.maxbytes:
+            return  # would evict everything else
+        ttl = ttl or self.ttl
+        expires = time.monotonic() + ttl if ttl else None
+        with self.lock:
+            if key in self.data:
+                self._remove(key)
+            self.data[key] = Entry(value, size, expires, frozenset(tags or ()))
+            self.nbytes += size
+            while len(self.data) > self.maxsize or (
+                self.maxbytes and self.nbytes > self.maxbytes
+            ):
+                self._remove(next(iter(self.data)))
+                if self.name:
+                    metrics.incr(f"{self.name}.evicted")
+
+    def delete(self, key: Hashable) -> None:
+        with self.lock:
+            if key in self.data:
+                self._remove(key)
+
+    def invalidate(self, *tags: str) -> int:
+        """
+        Remove all entries with any of the given tags, return the number of
+        removed entries
+        """
+        matching = set(tags)
+        with self.lock:
+            keys = [k for k, e in self.data.items() if e.tags & matching]
+            for key in keys:
+                self._remove(key)
+        return len(keys)
+
+    def clear(self) -> None:
+        with self.lock:
+            self.data.clear()
+            self.nbytes = 0
+
+    def _remove(self, key: Hashable) -> None:
+        entry = self.data.pop(key)
+        self.nbytes -= entry.size
@@ -0,0 +1,66 @@
+"""
+Simple in-process (per worker) counters and timers, exposed at `/metrics`
+"""
+
+import time
+from collections import Counter, defaultdict
+from collections.abc import Generator
+from contextlib import contextmanager
+from threading import Lock
+from typing import Any
+
+
+class Metrics:
+    def __init__(self) -> None:
+        self.lock = Lock()
+        self.counters: Counter = Counter()
+        self.timers: defaultdict[str, float] = defaultdict(float)
+        self.timer_counts: Counter = Counter()
+
+    def incr(self, key: str, value: int = 1) -> None:
+        with self.lock:
+            self.counters[key] += value
+
+    @contextmanager
+    def timer(self, key: str) -> Generator[None, None, None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - start
+            with self.lock:
+                self.timer_counts[key] += 1
+                self.timers[key] += duration
+
+    def to_dict(self) -> dict[str, Any]:
+        with self.lock:
+            return {
+                "counters": dict(self.counters),
+                "timers": {
+                    key: {
+                        "count": self.timer_counts[key],
+                        "total_ms": round(total * 1000, 3),
+                        "avg_ms": round(total * 1000 / self.timer_counts[key], 3),
+                    }
+                    for key, total in self.timers.items()
+                },
+                "hit_rates": self.get_hit_rates(),
+            }
+
+    def get_hit_rates(self) -> dict[str, float]:
+        rates = {}
+        for key, hits in self.counters.items():
+            if key.endswith(".hit"):
+                key = key[:-4]
+                total = hits + self.counters[f"{key}.miss"]
+                rates[key] = round(hits / total, 3)
+        return rates
+
+    def reset(self) -> None:
+        with self.lock:
+            self.counters.clear()
+            self.timers.clear()
+            self.timer_counts.clear()
+
+
+metrics = Metrics()
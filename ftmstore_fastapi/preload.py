@@ -0,0 +1,237 @@
+"""
+Preload datasets from the configured store (`FTM_STORE_URI`, e.g. postgres or
+a sqlite file) into an in-memory (or tmpfs) sqlite mirror at worker start,
+if they fit into the memory budget.
+"""
+
+import atexit
+import fcntl
+import hashlib
+import operator
+import os
+import time
+from collections.abc import Generator
+from contextlib import contextmanager
+from functools import reduce
+from pathlib import Path
+
+from nomenklatura.statement.db import make_statement_table
+from sqlalchemy import Connection, Engine, Index, MetaData, create_engine, func, select
+
+from ftmstore_fastapi import settings, sortkeys
+from ftmstore_fastapi.logging import get_logger
+from ftmstore_fastapi.metrics import metrics
+
+log = get_logger(__name__)
+
+MIRROR_NAME = "ftmstore_fastapi_preload"
+# not matching the per-worker mirrors (`{MIRROR_NAME}-{pid}.store`)
+SNAPSHOT_NAME = f"{MIRROR_NAME}_snapshot"
+BATCH_SIZE = 10_000
+# rough factor of sqlite storage (pages, indexes) vs. raw values size
+STORAGE_OVERHEAD = 3
+
+# keeps the in-memory database alive
+_connection: Connection | None = None
+
+
+class PreloadError(Exception):
+    pass
+
+
+def get_mirror_uri() -> str:
+    if settings.SQLITE_IN_MEMORY:
+        return f"sqlite:///file:{MIRROR_NAME}?mode=memory&cache=shared&uri=true"
+    path = Path(settings.PRELOAD_PATH) / f"{MIRROR_NAME}-{os.getpid()}.store"
+    path.unlink(missing_ok=True)
+    atexit.register(path.unlink, missing_ok=True)
+    return f"sqlite:///{path}"
+
+
+def estimate_size(engine: Engine, datasets: list[str] | None = None) -> dict[str, int]:
+    """
+    Estimated storage size in bytes per dataset
+    """
+    table = make_statement_table(MetaData())
+    size = reduce(
+        operator.add,
+        [func.coalesce(func.length(c), 0) for c in table.columns if c.name != "target"],
+    )
+    q = select(table.c.dataset, func.sum(size)).group_by(table.c.dataset)
+    if datasets is not None:
+        q = q.where(table.c.dataset.in_(datasets))
+    with engine.connect() as conn:
+        return {r[0]: int(r[1] or 0) * STORAGE_OVERHEAD for r in conn.execute(q)}
+
+
+def get_db_size(engine: Engine) -> int:
+    with engine.connect() as conn:
+        page_count = conn.exec_driver_sql("PRAGMA page_count").scalar_one()
+        page_size = conn.exec_driver_sql("PRAGMA page_size").scalar_one()
+    return page_count * page_size
+
+
+def copy_statements(
+    source: Engine, target: Engine, datasets: list[str] | None = None
+) -> int:
+    metadata = MetaData()
+    table = make_statement_table(metadata)
+    metadata.drop_all(target)
+    metadata.create_all(target)
+    q = select(table)
+    if datasets is not None:
+        q = q.where(table.c.dataset.in_(datasets))
+    statements = 0
+    with source.connect() as conn, target.begin() as tx:
+        res = conn.execution_options(stream_results=True).execute(q)
+        while rows := res.fetchmany(BATCH_SIZE):
+            tx.execute(table.insert(), [dict(r._mapping) for r in rows])
+            statements += len(rows)
+    # additional indexes for the api query patterns (lookup, sort, filter)
+    Index(f"ix_{table.name}_canonical_prop", table.c.canonical_id, table.c.prop)
+    Index(f"ix_{table.name}_prop_value", table.c.prop, table.c.value)
+    for index in table.indexes:
+        index.create(target, checkfirst=True)
+    return statements
+
+
+def check_budget(source: Engine, datasets: list[str] | None = None) -> list[str]:
+    """
+    Raise `PreloadError` if the datasets (or all) don't fit into
+    `PRELOAD_MEMORY_MB` or none of them is in the store, otherwise return the
+    names of the datasets to load
+    """
+    budget = settings.PRELOAD_MEMORY_MB * 1024 * 1024
+    sizes = estimate_size(source, datasets)
+    if datasets is not None and not sizes:
+        raise PreloadError(f"Datasets not in store: {', '.join(datasets)}")
+    total = 0
+    for dataset, size in sorted(sizes.items()):
+        total += size
+        if total > budget:
+            raise PreloadError(
+                f"Dataset `{dataset}` exceeds preload memory budget "
+                f"({total // 2**20} MB > {settings.PRELOAD_MEMORY_MB} MB)"
+            )
+    return sorted(sizes)
+
+
+def load(source: Engine, target: Engine, datasets: list[str] | None = None) -> None:
+    start = time.perf_counter()
+    with metrics.timer("preload"):
+        statements = copy_statements(source, target, datasets)
+    if settings.SORT_KEYS:
+        with metrics.timer("preload.sort_keys"):
+            sortkeys.build(target)
+    size = get_db_size(target)
+    metrics.incr("preload.statements", statements)
+    metrics.incr("preload.bytes", size)
+    log.info(
+        "Preloaded %d statements (%d MB) in %.2fs"
+        % (statements, size // 2**20, time.perf_counter() - start),
+        datasets=datasets,
+        uri=str(target.url),
+    )
+
+
+def get_source(uri: str) -> Engine:
+    if "sql" not in uri:
+        raise PreloadError(f"Preloading is not supported for store: `{uri}`")
+    return create_engine(uri)
+
+
+def preload(uri: str, datasets: list[str] | None = None) -> str:
+    """
+    Copy the given datasets (or all) from the store at `uri` into a sqlite
+    mirror and return its uri. Raises `PreloadError` if they don't fit into
+    `PRELOAD_MEMORY_MB`, in this case nothing is loaded.
+    """
+    global _connection
+
+    source = get_source(uri)
+    datasets = check_budget(source, datasets)
+    mirror_uri = get_mirror_uri()
+    # the mirror is loaded in one (worker) thread and then used by others
+    target = create_engine(mirror_uri, connect_args={"check_same_thread": False})
+    if settings.SQLITE_IN_MEMORY:
+        _connection = target.connect()
+    load(source, target, datasets)
+    source.dispose()
+    return mirror_uri
+
+
+@contextmanager
+def file_lock(path: Path) -> Generator[None, None, None]:
+    with open(path, "w") as fh:
+        fcntl.flock(fh, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(fh, fcntl.LOCK_UN)
+
+
+def get_prefix(name: str, *parts: str) -> str:
+    """
+    Versions of an artifact built from the same source (store, datasets,
+    settings) share a prefix, so that rebuilding one only removes its own
+    outdated versions and not the ones of other instances using the same
+    `PRELOAD_PATH`
+    """
+    key = ":".join(parts)
+    return f"{name}-{hashlib.sha1(key.encode()).hexdigest()[:8]}"
+
+
+def remove_outdated(path: Path, prefix: str) -> None:
+    """
+    Remove the other versions of an artifact, processes still using them keep
+    their open file handles
+    """
+    for outdated in path.parent.glob(f"{prefix}-*{path.suffix}"):
+        if outdated != path:
+            outdated.unlink(missing_ok=True)
+
+
+def get_snapshot_prefix(uri: str, datasets: list[str] | None = None) -> str:
+    return get_prefix(SNAPSHOT_NAME, uri, *sorted(datasets or []))
+
+
+def get_snapshot_path(
+    version: str, uri: str = "", datasets: list[str] | None = None
+) -> Path:
+    """
+    The snapshot for the store version, which includes the sort keys table
+    only if `SORT_KEYS` is enabled
+    """
+    prefix = get_snapshot_prefix(uri, datasets)
+    key = f"{version}:sort_keys={int(settings.SORT_KEYS)}"
+    version = hashlib.sha1(key.encode()).hexdigest()[:16]
+    return Path(settings.PRELOAD_PATH) / f"{prefix}-{version}.store"
+
+
+def snapshot(uri: str, datasets: list[str] | None = None, version: str = "") -> str:
+    """
+    Build a read-only sqlite snapshot for the given store version once (the
+    first process to get here builds it, the others wait) and return its uri.
+    All processes (gunicorn workers) open the same file `immutable`, so they
+    share the os page cache instead of each loading its own copy.
+    """
+    path = get_snapshot_path(version, uri, datasets)
+    prefix = get_snapshot_prefix(uri, datasets)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with file_lock(path.with_suffix(".lock")):
+        if path.exists():
+            log.info("Using store snapshot", path=str(path))
+        else:
+            source = get_source(uri)
+            datasets = check_budget(source, datasets)
+            tmp_path = path.with_suffix(".tmp")
+            tmp_path.unlink(missing_ok=True)
+            target = create_engine(f"sqlite:///{tmp_path}")
+            load(source, target, datasets)
+            with target.connect() as conn:
+                conn.exec_driver_sql("ANALYZE")
+            source.dispose()
+            target.dispose()
+            tmp_path.replace(path)
+            remove_outdated(path, prefix)
+    return f"sqlite:///file:{path}?mode=ro&immutable=1&uri=true"
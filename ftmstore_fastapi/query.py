@@ -1,15 +1,35 @@
-from typing import Annotated, Any
+import base64
+import json
+from collections.abc import Iterable
+from typing import Annotated, Any, Literal, Self
 
 from banal import clean_dict
 from fastapi import Query as FastQuery
 from fastapi import Request
+from fastapi.exceptions import RequestValidationError
+from followthemoney import model
+from followthemoney.schema import Schema
+from followthemoney.types import registry
 from ftmq.aggregations import Aggregator
+from ftmq.filters import Lookup
 from ftmq.query import Query as _Query
-from ftmq.types import Schemata
-from pydantic import BaseModel, ConfigDict, Field
+from ftmq.query import Sort
+from ftmq.types import CE, CEGenerator, Schemata
+from ftmq.util import to_numeric
+from nomenklatura.statement import Statement
+from pydantic import AfterValidator, BaseModel, ConfigDict, Field, ValidationError
+from sqlalchemy import TextualSelect
 
-from ftmstore_fastapi import settings
-from ftmstore_fastapi.store import Datasets
+from ftmstore_fastapi import settings, sortkeys
+from ftmstore_fastapi.search import get_search_index
+from ftmstore_fastapi.sql import Sql, is_numeric_sort
+from ftmstore_fastapi.store import (
+    Datasets,
+    get_catalog,
+    get_exposed_datasets,
+    has_attached_search_index,
+    has_sort_keys,
+)
 
 
 class RetrieveParams(BaseModel):
@@ -17,6 +37,21 @@ class RetrieveParams(BaseModel):
     featured: bool
     dehydrate: bool
     dehydrate_nested: bool
+    nested_limit: int | None = settings.NESTED_LIMIT
+    props: list[str] | None = None
+
+
+class BatchParams(BaseModel):
+    ids: list[str] = Field(
+        min_length=1,
+        max_length=settings.BATCH_LIMIT,
+        description="Entity ids to retrieve",
+    )
+
+
+class StatsParams(BaseModel):
+    stats: bool | None = True
+    total: Literal["exact", "estimate"] | None = "exact"
 
 
 class AggregationParams(BaseModel):
@@ -28,6 +63,71 @@ class AggregationParams(BaseModel):
     aggGroups: list[str] | None = []
 
 
+class FacetParams(BaseModel):
+    facet: list[str] = []
+    facet_limit: int | None = 10
+
+
+class Cursor(BaseModel):
+    """
+    Keyset pagination: position after (or, if `reverse`, before) the given
+    (sort value, entity id) pair
+    """
+
+    id: str
+    value: str | int | float | None = None
+    reverse: bool | None = False
+
+    def encode(self) -> str:
+        data = json.dumps([self.id, self.value, int(bool(self.reverse))]).encode()
+        return base64.urlsafe_b64encode(data).decode().rstrip("=")
+
+    @classmethod
+    def decode(cls, cursor: str) -> Self:
+        try:
+            data = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+            entity_id, value, reverse = json.loads(data)
+            return cls(id=entity_id, value=value, reverse=reverse)
+        except Exception:
+            raise ValueError(f"Invalid cursor: `{cursor}`")
+
+    @classmethod
+    def from_proxy(
+        cls,
+        proxy: CE,
+        sort: Sort | None = None,
+        reverse: bool | None = False,
+        values: dict[str, Any] | None = None,
+    ) -> Self:
+        """
+        The cursor at the given entity, its sort value as the (sql) store
+        sorted it from `values` (entity id -> sort value) if given
+        """
+        value = None
+        if values is not None and proxy.id in values:
+            value = values[proxy.id]
+        elif sort is not None:
+            prop = sort.values[0]
+            prop_values: list[Any] = proxy.get(prop, quiet=True)
+            if is_numeric_sort(prop):
+                # sql casts non-numeric values to 0
+                prop_values = [to_numeric(v) or 0 for v in prop_values]
+            elif sortkeys.is_sortable(prop):
+                # invalid dates don't count for the sort key
+                prop_values = [
+                    v for v in prop_values if registry.date.clean(v) is not None
+                ]
+            if prop_values:
+                value = min(prop_values) if sort.ascending else max(prop_values)
+        return cls(id=proxy.id, value=value, reverse=reverse)
+
+
+def validate_cursor(value: str | None) -> str | None:
+    if value is not None:
+        Cursor.decode(value)
+    return value
+
+
 class QueryParams(BaseModel):
     model_config = ConfigDict(populate_by_name=True)
 
@@ -40,6 +140,14 @@ class QueryParams(BaseModel):
     ] = []
     limit: int | None = settings.DEFAULT_LIMIT
     page: int | None = 1
+    cursor: Annotated[
+        str | None,
+        AfterValidator(validate_cursor),
+        FastQuery(
+            description="Opaque pagination cursor from `next_cursor` (takes "
+            "precedence over `page`)"
+        ),
+    ] = None
     schema_: Schemata | None = Field(
         None,
         example="LegalEntity",
@@ -54,11 +162,13 @@ class QueryParams(BaseModel):
 
 META_FIELDS = (
     set(AggregationParams.model_fields)
+    | set(FacetParams.model_fields)  # noqa: W503
     | set(RetrieveParams.model_fields)  # noqa: W503
+    | set(StatsParams.model_fields)  # noqa: W503
     | set(QueryParams.model_fields)  # noqa: W503
 )
 
-LISTISH_PARAMS = ["dataset", *AggregationParams.__fields__.keys()]
+LISTISH_PARAMS = ["dataset", "facet", *AggregationParams.__fields__.keys()]
 
 
 class ViewQueryParams(QueryParams):
@@ -78,7 +188,10 @@ class ViewQueryParams(QueryParams):
             listish = request.query_params.getlist(p)
             if listish:
                 params[p] = listish
-        params = cls(**params)
+        try:
+            params = cls(**params)
+        except ValidationError as e:
+            raise RequestValidationError(e.errors())
         if not authenticated and params.limit > settings.DEFAULT_LIMIT:
             params.limit = settings.DEFAULT_LIMIT
         return params
@@ -93,12 +206,170 @@ class ViewQueryParams(QueryParams):
         return Aggregator.from_dict(data)
 
 
+def get_caption_props(schemata: Iterable[Schema] | None = None) -> set[str]:
+    """
+    Properties needed to compute the captions of entities of the given (or
+    all) schemata
+    """
+    return {p for s in schemata or model.schemata.values() for p in s.caption}
+
+
 class Query(_Query):
+    def __init__(
+        self,
+        *args,
+        cursor: Cursor | None = None,
+        props: list[str] | None = None,
+        search_term: str | None = None,
+        search_ids: list[str] | None = None,
+        search_matches: TextualSelect | None = None,
+        sort_keys: bool | None = False,
+        **kwargs,
+    ):
+        super().__init__(*args, **kwargs)
+        self.cursor = cursor
+        self.props = props
+        self.search_term = search_term
+        self.search_ids = search_ids
+        self.search_matches = search_matches
+        self.sort_keys = sort_keys
+
+    @property
+    def sql(self) -> Sql:
+        return Sql(self)
+
+    def to_dict(self) -> dict[str, Any]:
+        data = super().to_dict()
+        if self.cursor is not None:
+            data["cursor"] = self.cursor.encode()
+        if self.props:
+            data["props"] = self.props
+        if self.search_term:
+            data["search"] = self.search_term
+        return data
+
+    @property
+    def stats_query(self) -> "Query":
+        """
+        The query without pagination, sorting and aggregations, so that all
+        pages of the same filter share their stats
+        """
+        return self._chain(
+            slice=None, sort=None, cursor=None, props=None, aggregations=None
+        )
+
+    def after(self, cursor: Cursor) -> "Query":
+        return self._chain(cursor=cursor)
+
+    def project(self, props: list[str] | None) -> "Query":
+        return self._chain(props=props)
+
+    def ranked_search(
+        self, term: str, ids: list[str], matches: TextualSelect | None = None
+    ) -> "Query":
+        """
+        Restrict to the given ids of a search index, ordered by their rank. If
+        given, sql restricts via the `matches` subquery of the same ids.
+        """
+        return self._chain(search_term=term, search_ids=ids, search_matches=matches)
+
+    def use_sort_keys(self) -> "Query":
+        """
+        Sort by numeric and date properties via the precomputed sort keys of
+        the store
+        """
+        return self._chain(sort_keys=True)
+
+    @property
+    def is_ranked(self) -> bool:
+        return self.search_ids is not None and not self.sort
+
+    def paginate(self, ids: list[str]) -> list[str]:
+        """
+        The current page (offset or cursor) of the given ordered ids
+        """
+        if self.cursor is None:
+            offset = self.offset or 0
+            return ids[offset : offset + self.limit if self.limit else None]
+        if self.cursor.id not in ids:
+            return []
+        ix = ids.index(self.cursor.id)
+        if self.cursor.reverse:
+            return ids[max(0, ix - (self.limit or ix)) : ix]
+        return ids[ix + 1 :][: self.limit]
+
+    @property
+    def projected_props(self) -> list[str] | None:
+        """
+        Properties to load from the store for a projection (`props`): the
+        requested ones plus what's needed for the entity id, caption and sort
+        """
+        if not self.props:
+            return None
+        schemata: set[Schema] = set()
+        for f in self.schemata:
+            if f.comparator not in (Lookup.EQUALS, Lookup.IN):
+                schemata.clear()  # all schemata
+                break
+            schemata.update(f.schemata)
+        props = {Statement.BASE, *self.props, *get_caption_props(schemata)}
+        if self.sort:
+            props.update(self.sort.values)
+        return sorted(props)
+
+    def get_next_cursor(
+        self, proxies: list[CE], values: dict[str, Any] | None = None
+    ) -> Cursor | None:
+        """
+        Cursor for the page after the given page of results
+        """
+        if not proxies:
+            return None
+        if len(proxies) == self.limit or (self.cursor and self.cursor.reverse):
+            return Cursor.from_proxy(proxies[-1], self.sort, values=values)
+        return None
+
+    def get_prev_cursor(
+        self, proxies: list[CE], values: dict[str, Any] | None = None
+    ) -> Cursor | None:
+        """
+        Cursor for the page before the given page of results (if it was
+        retrieved via a cursor itself)
+        """
+        if proxies and self.cursor is not None:
+            if not self.cursor.reverse or len(proxies) == self.limit:
+                return Cursor.from_proxy(
+                    proxies[0], self.sort, reverse=True, values=values
+                )
+        return None
+
+    def apply_iter(self, proxies: CEGenerator) -> CEGenerator:
+        if self.cursor is None:
+            yield from super().apply_iter(proxies)
+            return
+        # keyset pagination for non-sql stores: seek the cursor entity within
+        # the ordered results
+        q = self._chain(slice=None, cursor=None)
+        proxies = list(q.apply_iter(proxies))
+        ids = [p.id for p in proxies]
+        if self.cursor.id not in ids:
+            return
+        ix = ids.index(self.cursor.id)
+        if self.cursor.reverse:
+            yield from proxies[max(0, ix - (self.limit or ix)) : ix]
+        else:
+            yield from proxies[ix + 1 :][: self.limit]
+
     @classmethod
     def from_params(cls: "Query", params: ViewQueryParams) -> "Query":
-        q = cls()[(params.page - 1) * params.limit : params.page * params.limit]
+        if params.cursor:
+            q = cls()[: params.limit].after(Cursor.decode(params.cursor))
+        else:
+            q = cls()[(params.page - 1) * params.limit : params.page * params.limit]
         if params.dataset:
             q = q.where(dataset__in=params.dataset)
+        elif get_exposed_datasets() is not None:
+            q = q.where(dataset__in=sorted(get_catalog().names))
         if params.schema_:
             q = q.where(schema=params.schema_)
         if params.order_by:
@@ -107,11 +378,20 @@ class Query(_Query):
                 ascending = False
                 params.order_by = params.order_by.lstrip("-")
             q = q.order_by(params.order_by, ascending=ascending)
+            if has_sort_keys():
+                q = q.use_sort_keys()
         if params.reverse:
             q = q.where(reverse=params.reverse)
         q = q.where(**params.to_where_lookup_dict())
         if params.q:
-            q = q.search(params.q)
+            index = get_search_index()
+            if index is not None:
+                matches = None
+                if has_attached_search_index():
+                    matches = index.get_matches(params.q)
+                q = q.ranked_search(params.q, index.search(params.q), matches)
+            else:
+                q = q.search(params.q)
         aggregator = params.to_aggregator()
         q.aggregations = aggregator.aggregations
         return q
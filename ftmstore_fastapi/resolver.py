@@ -0,0 +1,162 @@
+"""
+Precomputed resolver map (referent id -> canonical id) for the configured
+`RESOLVER`, so that looking up canonical ids doesn't walk the resolver graph
+for each entity.
+
+The map is built once per resolver file version into a read-only sqlite file
+at `PRELOAD_PATH` that all workers open as `immutable` and therefore share via
+the os page cache. The stores still load the resolver graph per worker, as
+assembling entities needs it (canonical ids of referenced entities, referents).
+"""
+
+import hashlib
+import os
+from collections.abc import Generator, Iterable
+from functools import cache
+from pathlib import Path
+
+from ftmq.dedupe import get_resolver
+from nomenklatura.resolver import Identifier, Resolver
+from sqlalchemy import (
+    Column,
+    Engine,
+    MetaData,
+    Table,
+    Unicode,
+    create_engine,
+    insert,
+    select,
+)
+
+from ftmstore_fastapi import settings
+from ftmstore_fastapi.logging import get_logger
+from ftmstore_fastapi.metrics import metrics
+from ftmstore_fastapi.preload import file_lock, get_prefix, remove_outdated
+
+log = get_logger(__name__)
+
+MAP_NAME = "ftmstore_fastapi_resolver"
+BATCH_SIZE = 10_000
+LOOKUP_BATCH_SIZE = 1_000
+
+metadata = MetaData()
+table = Table(
+    "resolver",
+    metadata,
+    Column("id", Unicode(512), primary_key=True),
+    Column("canonical_id", Unicode(512), nullable=False),
+    sqlite_with_rowid=False,
+)
+
+
+def get_resolver_version(uri: str) -> str:
+    parts: list[str | int | None] = [settings.VERSION, uri, settings.STORE_VERSION]
+    if os.path.isfile(uri):
+        stat = os.stat(uri)
+        parts.extend([stat.st_mtime_ns, stat.st_size])
+    return hashlib.sha1(":".join(map(str, parts)).encode()).hexdigest()
+
+
+def get_map_path(version: str, uri: str = "") -> Path:
+    prefix = get_prefix(MAP_NAME, uri)
+    return Path(settings.PRELOAD_PATH) / f"{prefix}-{version[:16]}.db"
+
+
+def iter_canonicals(resolver: Resolver) -> Generator[tuple[str, str], None, None]:
+    """
+    Yield (referent, canonical) id pairs, traversing each connected cluster of
+    the resolver graph only once
+    """
+    seen: set[Identifier] = set()
+    for node in resolver.nodes:
+        if node in seen:
+            continue
+        connected = resolver._traverse(node, set())
+        seen.update(connected)
+        canonical = max(connected)
+        if not canonical.canonical:
+            continue
+        for referent in connected:
+            if referent != canonical:
+                yield referent.id, canonical.id
+
+
+def build(resolver: Resolver, path: Path) -> int:
+    tmp_path = path.with_suffix(".tmp")
+    tmp_path.unlink(missing_ok=True)
+    engine = create_engine(f"sqlite:///{tmp_path}")
+    metadata.create_all(engine)
+    rows = 0
+    with engine.begin() as conn:
+        batch: list[dict[str, str]] = []
+        for referent, canonical in iter_canonicals(resolver):
+            batch.append({"id": referent, "canonical_id": canonical})
+            if len(batch) == BATCH_SIZE:
+                conn.execute(insert(table), batch)
+                rows += len(batch)
+                batch = []
+        if batch:
+            conn.execute(insert(table), batch)
+            rows += len(batch)
+    engine.dispose()
+    tmp_path.replace(path)
+    return rows
+
+
+class ResolverMap:
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        self.engine: Engine = create_engine(
+            f"sqlite:///file:{path}?mode=ro&immutable=1&uri=true"
+        )
+
+    def get_canonical(self, entity_id: str) -> str:
+        return self.get_canonicals([entity_id])[entity_id]
+
+    def get_canonicals(self, entity_ids: Iterable[str]) -> dict[str, str]:
+        """
+        Resolve multiple ids at once, ids without a canonical id resolve to
+        themselves
+        """
+        entity_ids = list(entity_ids)
+        res = {i: i for i in entity_ids}
+        with self.engine.connect() as conn:
+            for ix in range(0, len(entity_ids), LOOKUP_BATCH_SIZE):
+                batch = entity_ids[ix : ix + LOOKUP_BATCH_SIZE]
+                q = select(table.c.id, table.c.canonical_id).where(
+                    table.c.id.in_(batch)
+                )
+                res.update((i, c) for i, c in conn.execute(q))
+        return res
+
+
+def load_map(uri: str) -> ResolverMap:
+    """
+    Build the resolver map for the current version of the resolver file once
+    (the first process to get here builds it, the others wait)
+    """
+    path = get_map_path(get_resolver_version(uri), uri)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with file_lock(path.with_suffix(".lock")):
+        if path.exists():
+            log.info("Using resolver map", path=str(path))
+        else:
+            with metrics.timer("resolver_map"):
+                # fresh (not the cached) resolver for the current file version
+                rows = build(get_resolver.__wrapped__(uri), path)
+            log.info("Built resolver map", path=str(path), rows=rows)
+            # only the outdated maps of this resolver file
+            remove_outdated(path, get_prefix(MAP_NAME, uri))
+    return ResolverMap(path)
+
+
+@cache
+def get_resolver_map(uri: str | None = None) -> ResolverMap | None:
+    uri = uri or settings.RESOLVER
+    if not uri:
+        return None
+    try:
+        return load_map(uri)
+    except Exception as e:
+        log.warning(f"Not using resolver map: {e}", uri=uri)
+        return None
@@ -0,0 +1,271 @@
+"""
+Full-text search index (`SEARCH_INDEX=1`) for the `q` parameter: a sqlite
+FTS5 index over names, identifiers, featured properties and the additional
+`INDEX_PROPERTIES` of all entities, with BM25 ranked results.
+
+The index is built once per store version into a read-only sqlite file at
+`PRELOAD_PATH` that all workers open as `immutable` and therefore share via
+the os page cache. For sqlite stores, it is attached to the store
+connections, so that store queries (stats, facets, sorted pages) restrict to
+the matches in sql instead of binding the matching ids as parameters.
+"""
+
+import hashlib
+import re
+from collections.abc import Generator
+from functools import cache
+from pathlib import Path
+from threading import Lock
+
+from followthemoney import model
+from followthemoney.types import registry
+from nomenklatura.statement.db import make_statement_table
+from sqlalchemy import (
+    Engine,
+    MetaData,
+    TextualSelect,
+    column,
+    create_engine,
+    event,
+    select,
+    text,
+)
+
+from ftmstore_fastapi import settings
+from ftmstore_fastapi.logging import get_logger
+from ftmstore_fastapi.metrics import metrics
+from ftmstore_fastapi.preload import file_lock, get_prefix, remove_outdated
+
+log = get_logger(__name__)
+
+INDEX_NAME = "ftmstore_fastapi_search"
+BATCH_SIZE = 10_000
+TOKENS = re.compile(r"\w+\*?")
+# bm25 column weights: canonical_id (not indexed), names, other values
+WEIGHTS = 0.0, 10.0, 1.0
+
+# schema name of the index attached to sqlite store connections
+SCHEMA = "search_index"
+MATCHES = (
+    "SELECT canonical_id FROM {schema}search WHERE search MATCH :search_q "
+    f"ORDER BY bm25(search, {', '.join(map(str, WEIGHTS))}) LIMIT :search_limit"
+)
+
+_lock = Lock()
+_index: "SearchIndex | None" = None
+
+
+@cache
+def get_index_props() -> tuple[set[str], set[str]]:
+    """
+    Name properties and other indexed properties (identifiers, featured
+    properties and `INDEX_PROPERTIES`)
+    """
+    names: set[str] = set()
+    others = set(settings.INDEX_PROPERTIES)
+    for schema in model.schemata.values():
+        others.update(schema.featured)
+        for prop in schema.properties.values():
+            if prop.type == registry.name:
+                names.add(prop.name)
+            elif prop.type == registry.identifier:
+                others.add(prop.name)
+    return names, others - names
+
+
+def to_fts_query(q: str) -> str | None:
+    """
+    Turn a user search term into a fts5 query: all tokens need to match,
+    tokens ending with `*` are prefix queries
+    """
+    tokens = []
+    for token in TOKENS.findall(q):
+        if token.endswith("*"):
+            tokens.append(f'"{token[:-1]}"*')
+        else:
+            tokens.append(f'"{token}"')
+    return " ".join(tokens) or None
+
+
+def iter_documents(
+    engine: Engine, datasets: list[str] | None = None
+) -> Generator[tuple[str, str, str], None, None]:
+    """
+    Yield (canonical_id, names, other values) for all entities in the store
+    """
+    names, others = get_index_props()
+    table = make_statement_table(MetaData())
+    q = (
+        select(table.c.canonical_id, table.c.prop, table.c.value)
+        .where(table.c.prop.in_(sorted(names | others)))
+        .order_by(table.c.canonical_id)
+    )
+    if datasets:
+        q = q.where(table.c.dataset.in_(datasets))
+    current_id: str | None = None
+    current_names: list[str] = []
+    current_others: list[str] = []
+    with engine.connect() as conn:
+        conn = conn.execution_options(stream_results=True)
+        for canonical_id, prop, value in conn.execute(q):
+            if canonical_id != current_id:
+                if current_id is not None:
+                    yield current_id, " ".join(current_names), " ".join(current_others)
+                current_id, current_names, current_others = canonical_id, [], []
+            if prop in names:
+                current_names.append(value)
+            else:
+                current_others.append(value)
+    if current_id is not None:
+        yield current_id, " ".join(current_names), " ".join(current_others)
+
+
+def build(source: Engine, path: Path, datasets: list[str] | None = None) -> int:
+    tmp_path = path.with_suffix(".tmp")
+    tmp_path.unlink(missing_ok=True)
+    target = create_engine(f"sqlite:///{tmp_path}")
+    rows = 0
+    with target.begin() as conn:
+        conn.exec_driver_sql(
+            "CREATE VIRTUAL TABLE search USING fts5(canonical_id UNINDEXED, names, "
+            "other, tokenize='unicode61 remove_diacritics 2', prefix='2 3')"
+        )
+        batch: list[tuple[str, str, str]] = []
+        for doc in iter_documents(source, datasets):
+            batch.append(doc)
+            if len(batch) == BATCH_SIZE:
+                conn.exec_driver_sql("INSERT INTO search VALUES (?, ?, ?)", batch)
+                rows += len(batch)
+                batch = []
+        if batch:
+            conn.exec_driver_sql("INSERT INTO search VALUES (?, ?, ?)", batch)
+            rows += len(batch)
+        conn.exec_driver_sql("INSERT INTO search(search) VALUES ('optimize')")
+    target.dispose()
+    tmp_path.replace(path)
+    return rows
+
+
+def get_index_version() -> str:
+    """
+    Rebuild the index when the store or the indexed properties change
+    """
+    from ftmstore_fastapi.store import get_store_fingerprint
+
+    parts = [get_store_fingerprint(), *sorted(settings.INDEX_PROPERTIES)]
+    return hashlib.sha1(":".join(parts).encode()).hexdigest()
+
+
+def get_index_prefix() -> str:
+    from ftmstore_fastapi.store import get_exposed_datasets
+
+    datasets = sorted(get_exposed_datasets() or [])
+    properties = sorted(settings.INDEX_PROPERTIES)
+    return get_prefix(INDEX_NAME, settings.FTM_STORE_URI, *datasets, *properties)
+
+
+def get_index_path(version: str) -> Path:
+    return Path(settings.PRELOAD_PATH) / f"{get_index_prefix()}-{version[:16]}.db"
+
+
+class SearchIndex:
+    def __init__(self, path: Path, version: str) -> None:
+        self.path = path
+        self.version = version
+        self.engine = create_engine(
+            f"sqlite:///file:{path}?mode=ro&immutable=1&uri=true"
+        )
+
+    def search(self, q: str, limit: int | None = None) -> list[str]:
+        """
+        Canonical ids of the best matching entities (BM25 ranked)
+        """
+        query = to_fts_query(q)
+        if query is None:
+            return []
+        params = {"search_q": query, "search_limit": limit or settings.SEARCH_LIMIT}
+        with metrics.timer("search"):
+            with self.engine.connect() as conn:
+                res = conn.execute(text(MATCHES.format(schema="")), params)
+                return [r[0] for r in res]
+
+    def get_matches(self, q: str) -> TextualSelect | None:
+        """
+        Subquery for the canonical ids of the best matching entities, for
+        sqlite stores that have the index attached
+        """
+        query = to_fts_query(q)
+        if query is None:
+            return None
+        stmt = text(MATCHES.format(schema=f"{SCHEMA}."))
+        stmt = stmt.bindparams(search_q=query, search_limit=settings.SEARCH_LIMIT)
+        return stmt.columns(column("canonical_id"))
+
+
+def _attach(dbapi_connection, connection_record, connection_proxy) -> None:
+    index = _index
+    if index is None or connection_record.info.get(SCHEMA) == index.path:
+        return
+    cursor = dbapi_connection.cursor()
+    try:
+        if SCHEMA in connection_record.info:  # outdated index
+            cursor.execute(f"DETACH DATABASE {SCHEMA}")
+        cursor.execute(f"ATTACH DATABASE ? AS {SCHEMA}", (str(index.path),))
+    finally:
+        cursor.close()
+    connection_record.info[SCHEMA] = index.path
+
+
+def attach(engine: Engine) -> None:
+    """
+    Attach the current index to the connections of a sqlite store (as
+    `search_index`, once they are checked out)
+    """
+    if engine.dialect.name == "sqlite" and not is_attached(engine):
+        event.listen(engine, "checkout", _attach)
+
+
+def is_attached(engine: Engine) -> bool:
+    return event.contains(engine, "checkout", _attach)
+
+
+def load_index(version: str) -> SearchIndex:
+    """
+    Build the index for the given store version once (the first process to
+    get here builds it, the others wait)
+    """
+    from ftmstore_fastapi.store import get_catalog, get_source_engine
+
+    path = get_index_path(version)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with file_lock(path.with_suffix(".lock")):
+        if path.exists():
+            log.info("Using search index", path=str(path))
+        else:
+            datasets = sorted(get_catalog().names) or None
+            with metrics.timer("search_index"), get_source_engine() as engine:
+                rows = build(engine, path, datasets)
+            log.info("Built search index", path=str(path), rows=rows)
+            remove_outdated(path, get_index_prefix())
+    return SearchIndex(path, version)
+
+
+def get_search_index() -> SearchIndex | None:
+    """
+    The search index for the current store version if `SEARCH_INDEX` is
+    enabled (and the store supports it)
+    """
+    global _index
+    if not settings.SEARCH_INDEX:
+        return None
+    version = get_index_version()
+    if _index is not None and _index.version == version:
+        return _index
+    with _lock:
+        if _index is None or _index.version != version:
+            try:
+                _index = load_index(version)
+            except Exception as e:
+                log.warning(f"Search index not available: {e}")
+                return None
+    return _index
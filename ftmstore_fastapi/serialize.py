@@ -3,25 +3,39 @@ serialization data models as seen in
 https://github.com/opensanctions/yente/
 """
 
+import gzip
 from collections import defaultdict
 from collections.abc import Iterable
 from typing import Any, Self, Union
 
+import orjson
 from banal import clean_dict
-from fastapi import Request
+from fastapi import Request, Response
 from followthemoney.types import registry
 from ftmq.aggregations import AggregatorResult
 from ftmq.model import Catalog, Dataset, DatasetStats
 from ftmq.types import CE, CEGenerator
 from furl import furl
-from pydantic import BaseModel, ConfigDict, Field
+from pydantic import (
+    BaseModel,
+    ConfigDict,
+    Field,
+    SerializerFunctionWrapHandler,
+    model_serializer,
+)
 
-from ftmstore_fastapi.query import ViewQueryParams
+from ftmstore_fastapi.query import Cursor, ViewQueryParams
+from ftmstore_fastapi.suggest import Suggestion
 
 EntityProperties = dict[str, list[Union[str, "EntityResponse"]]]
 Aggregations = dict[str, dict[str, Any]]
 
 
+JSON = "application/json"
+# partial responses (flagged by these attributes) are not cached
+PENDING_ATTRS = ("stats_pending", "index_pending")
+
+
 class ErrorResponse(BaseModel):
     detail: str = Field(..., example="Detailed error message")
 
@@ -35,19 +49,38 @@ class EntityResponse(BaseModel):
     properties: EntityProperties = Field(..., example={"name": ["John Doe"]})
     datasets: list[str] = Field([], example=["us_ofac_sdn"])
     referents: list[str] = Field([], example=["ofac-1234"])
+    truncated: dict[str, int] | None = Field(
+        None,
+        example={"membershipMember": 1200},
+        description="Number of omitted adjacent entities per property",
+    )
+
+    @model_serializer(mode="wrap")
+    def _serialize(self, handler: SerializerFunctionWrapHandler) -> dict[str, Any]:
+        data = handler(self)
+        if self.truncated is None:
+            data.pop("truncated", None)
+        return data
 
     @classmethod
     def from_entity(
-        cls, entity: CE, adjacents: Iterable[CE] | None = None
+        cls,
+        entity: CE,
+        adjacents: "Iterable[CE] | Adjacents | None" = None,
+        nested_limit: int | None = None,
+        props: list[str] | None = None,
     ) -> "EntityResponse":
-        properties = dict(entity.properties)
-        if adjacents:
-            adjacents = {e.id: EntityResponse.from_entity(e) for e in adjacents}
+        properties = get_properties(entity, props)
+        truncated: dict[str, int] = {}
+        if adjacents is not None:
+            adjacents = get_adjacents_map(adjacents)
             for prop in entity.iterprops():
-                if prop.type == registry.entity:
-                    properties[prop.name] = [
-                        adjacents.get(i, i) for i in entity.get(prop)
-                    ]
+                if prop.type == registry.entity and prop.name in properties:
+                    values = entity.get(prop)
+                    if nested_limit and len(values) > nested_limit:
+                        truncated[prop.name] = len(values) - nested_limit
+                        values = values[:nested_limit]
+                    properties[prop.name] = [adjacents.get(i, i) for i in values]
         return cls(
             id=entity.id,
             caption=entity.caption,
@@ -55,20 +88,81 @@ class EntityResponse(BaseModel):
             properties=properties,
             datasets=list(entity.datasets),
             referents=list(entity.referents),
+            truncated=truncated or None,
         )
 
 
+Adjacents = dict[str, EntityResponse]
+
+
+def get_url(request: Request) -> furl:
+    """
+    The request url without the api key, as the responses containing it are
+    cached for all clients
+    """
+    url = furl(str(request.url))
+    url.args.pop("api_key", None)
+    return url
+
+
+def get_properties(entity: CE, props: list[str] | None = None) -> EntityProperties:
+    properties = entity.properties
+    if props:
+        return {k: v for k, v in properties.items() if k in props}
+    return dict(properties)
+
+
+def get_adjacents_map(adjacents: Iterable[CE] | Adjacents) -> Adjacents:
+    if isinstance(adjacents, dict):
+        return adjacents
+    return {e.id: EntityResponse.from_entity(e) for e in adjacents}
+
+
 EntityResponse.model_rebuild()
 
 
+def dump_entity(
+    entity: CE,
+    adjacents: dict[str, dict[str, Any]] | None = None,
+    nested_limit: int | None = None,
+    props: list[str] | None = None,
+) -> dict[str, Any]:
+    """
+    Same as `EntityResponse.from_entity(...).model_dump(by_alias=True)`, but
+    without building (and validating) the models
+    """
+    properties = get_properties(entity, props)
+    truncated: dict[str, int] = {}
+    if adjacents is not None:
+        for prop in entity.iterprops():
+            if prop.type == registry.entity and prop.name in properties:
+                values = entity.get(prop)
+                if nested_limit and len(values) > nested_limit:
+                    truncated[prop.name] = len(values) - nested_limit
+                    values = values[:nested_limit]
+                properties[prop.name] = [adjacents.get(i, i) for i in values]
+    data = {
+        "id": entity.id,
+        "caption": entity.caption,
+        "schema": entity.schema.name,
+        "properties": properties,
+        "datasets": list(entity.datasets),
+        "referents": list(entity.referents),
+    }
+    if truncated:
+        data["truncated"] = truncated
+    return data
+
+
 class EntitiesResponse(BaseModel):
     total: int
     items: int
-    stats: DatasetStats
+    stats: DatasetStats | None = None
     query: ViewQueryParams
     url: str
     next_url: str | None = None
     prev_url: str | None = None
+    next_cursor: str | None = None
     entities: list[EntityResponse]
 
     @classmethod
@@ -76,36 +170,176 @@ class EntitiesResponse(BaseModel):
         cls,
         request: Request,
         entities: CEGenerator,
-        stats: DatasetStats,
+        stats: DatasetStats | None = None,
         adjacents: Iterable[CE] | None = None,
+        nested_limit: int | None = None,
         authenticated: bool | None = False,
+        next_cursor: Cursor | None = None,
+        prev_cursor: Cursor | None = None,
+        total: int | None = None,
+        props: list[str] | None = None,
     ) -> "EntitiesResponse":
         query = ViewQueryParams.from_request(request, authenticated)
-        url = furl(str(request.url))
+        url = get_url(request)
         query_data = clean_dict(query.model_dump())
         query_data.pop("schema_", None)
         url.args.update(query_data)
-        entities = [EntityResponse.from_entity(e, adjacents) for e in entities]
+        if adjacents is not None:
+            adjacents = get_adjacents_map(adjacents)
+        entities = [
+            EntityResponse.from_entity(e, adjacents, nested_limit, props)
+            for e in entities
+        ]
+        if total is None:
+            total = stats.entity_count if stats is not None else 0
         response = cls(
-            total=stats.entity_count,
+            total=total,
             items=len(entities),
             query=query,
             entities=entities,
             stats=stats,
             url=str(url),
         )
-        if query.page > 1:
+        if query.cursor:
+            if prev_cursor is not None:
+                url.args["cursor"] = prev_cursor.encode()
+                response.prev_url = str(url)
+        elif query.page > 1:
             url.args["page"] = query.page - 1
             response.prev_url = str(url)
-        if query.limit * query.page < stats.entity_count:
-            url.args["page"] = query.page + 1
-            response.next_url = str(url)
+        if next_cursor is not None:
+            if query.cursor or query.limit * query.page < total:
+                url.args.pop("page", None)
+                url.args["cursor"] = response.next_cursor = next_cursor.encode()
+                response.next_url = str(url)
         return response
 
+    @classmethod
+    def dump_view(
+        cls,
+        request: Request,
+        entities: Iterable[CE],
+        adjacents: Iterable[CE] | None = None,
+        nested_limit: int | None = None,
+        props: list[str] | None = None,
+        **kwargs: Any,
+    ) -> bytes:
+        """
+        Same json as `from_view(...).model_dump_json(by_alias=True)`, but the
+        entities are serialized directly from the proxies
+        """
+        entities = list(entities)
+        response = cls.from_view(request, [], **kwargs)
+        data = response.model_dump(mode="json", by_alias=True)
+        if adjacents is not None:
+            adjacents = {e.id: dump_entity(e) for e in adjacents}
+        data["items"] = len(entities)
+        data["entities"] = [
+            dump_entity(e, adjacents, nested_limit, props) for e in entities
+        ]
+        return orjson.dumps(data)
+
+
+class EntitiesBatchResponse(BaseModel):
+    items: int
+    entities: list[EntityResponse]
+    redirects: dict[str, str] = Field(
+        {}, description="Requested ids that were merged into another entity"
+    )
+    missing: list[str] = Field([], description="Requested ids that don't exist")
+
+    @classmethod
+    def from_view(
+        cls,
+        entity_ids: Iterable[str],
+        canonicals: dict[str, str],
+        entities: dict[str, CE],
+        adjacents: Iterable[CE] | None = None,
+        nested_limit: int | None = None,
+        props: list[str] | None = None,
+    ) -> Self:
+        if adjacents is not None:
+            adjacents = get_adjacents_map(adjacents)
+        response = cls(items=0, entities=[], redirects={}, missing=[])
+        seen: set[str] = set()
+        for entity_id in entity_ids:
+            canonical_id = canonicals[entity_id]
+            if canonical_id not in entities:
+                response.missing.append(entity_id)
+                continue
+            if canonical_id != entity_id:
+                response.redirects[entity_id] = canonical_id
+            if canonical_id not in seen:
+                seen.add(canonical_id)
+                response.entities.append(
+                    EntityResponse.from_entity(
+                        entities[canonical_id], adjacents, nested_limit, props
+                    )
+                )
+        response.items = len(response.entities)
+        return response
+
+
+class SuggestionResponse(BaseModel):
+    model_config = ConfigDict(populate_by_name=True)
+
+    id: str = Field(..., example="NK-A7z....")
+    caption: str = Field(..., example="John Doe")
+    schema_: str = Field(..., example="LegalEntity", alias="schema")
+
+
+class SuggestResponse(BaseModel):
+    prefix: str
+    items: int
+    suggestions: list[SuggestionResponse]
+    index_pending: bool = False
+
+    @classmethod
+    def from_suggestions(
+        cls, prefix: str, suggestions: Iterable[Suggestion], index_pending: bool = False
+    ) -> Self:
+        items = [
+            SuggestionResponse(id=s.id, caption=s.caption, schema=s.schema)
+            for s in suggestions
+        ]
+        return cls(
+            prefix=prefix,
+            items=len(items),
+            suggestions=items,
+            index_pending=index_pending,
+        )
+
+
+class FacetValue(BaseModel):
+    value: str
+    count: int
+
+
+class FacetsResponse(BaseModel):
+    query: ViewQueryParams
+    url: str
+    facets: dict[str, list[FacetValue]] = Field(
+        ..., example={"country": [{"value": "de", "count": 42}]}
+    )
+
+    @classmethod
+    def from_counts(
+        cls,
+        request: Request,
+        counts: dict[str, list[tuple[str, int]]],
+        authenticated: bool | None = False,
+    ) -> Self:
+        query = ViewQueryParams.from_request(request, authenticated)
+        facets = {
+            facet: [FacetValue(value=v, count=c) for v, c in values]
+            for facet, values in counts.items()
+        }
+        return cls(query=query, url=str(get_url(request)), facets=facets)
+
 
 class AggregationResponse(BaseModel):
     total: int
-    stats: DatasetStats
+    stats: DatasetStats | None = None
     query: ViewQueryParams
     url: str
     aggregations: Aggregations
@@ -114,12 +348,13 @@ class AggregationResponse(BaseModel):
     def from_view(
         cls,
         request: Request,
-        stats: DatasetStats,
         aggregations: AggregatorResult,
+        stats: DatasetStats | None = None,
         authenticated: bool | None = False,
+        total: int | None = None,
     ) -> Self:
         query = ViewQueryParams.from_request(request, authenticated)
-        url = furl(str(request.url))
+        url = get_url(request)
         query_data = clean_dict(query.model_dump())
         query_data.pop("schema_", None)
         url.args.update(query_data)
@@ -130,8 +365,10 @@ class AggregationResponse(BaseModel):
             for field, value in agg.items():
                 agg_data[field][func] = value
 
+        if total is None:
+            total = stats.entity_count if stats is not None else 0
         return cls(
-            total=stats.entity_count,
+            total=total,
             query=query,
             stats=stats,
             aggregations=agg_data,
@@ -141,22 +378,92 @@ class AggregationResponse(BaseModel):
 
 class DatasetResponse(Dataset):
     entities_url: str | None = None
+    stats_pending: bool = False
 
     @classmethod
-    def from_dataset(cls, request: Request, dataset: Dataset) -> Self:
-        return cls(
+    def from_dataset(
+        cls,
+        request: Request,
+        dataset: Dataset,
+        stats: dict[str, DatasetStats | None] | None = None,
+    ) -> Self:
+        res = cls(
             **dataset.model_dump(),
             entities_url=f"{request.base_url}entities?dataset={dataset.name}",
         )
+        if stats is not None:
+            if stats.get(dataset.name) is None:
+                res.stats_pending = True
+            else:
+                res.apply_stats(stats[dataset.name])
+        return res
 
 
 class CatalogResponse(Catalog):
     datasets: list[DatasetResponse]
+    stats_pending: bool = False
+
+    @classmethod
+    def from_catalog(
+        cls,
+        request: Request,
+        catalog: Catalog,
+        stats: dict[str, DatasetStats | None] | None = None,
+    ) -> Self:
+        datasets = [
+            DatasetResponse.from_dataset(request, d, stats) for d in catalog.datasets
+        ]
+        return cls(
+            datasets=datasets,
+            stats_pending=any(d.stats_pending for d in datasets),
+        )
+
+
+class CachedResponse(BaseModel):
+    """
+    A ready to send response (gzip compressed json or a redirect), so that a
+    cache hit doesn't need to rebuild and serialize the response model again
+    """
+
+    content: bytes = b""
+    status_code: int = 200
+    headers: dict[str, str] = {}
+    cacheable: bool = True
 
     @classmethod
-    def from_catalog(cls, request: Request, catalog: Catalog) -> Self:
+    def from_result(cls, result: BaseModel | Response | bytes) -> Self:
+        if isinstance(result, Response):
+            return cls(
+                content=result.body,
+                status_code=result.status_code,
+                headers=dict(result.headers),
+            )
+        if isinstance(result, bytes):  # already serialized json
+            return cls(
+                content=gzip.compress(result, compresslevel=6, mtime=0),
+                headers={"content-type": JSON, "vary": "Accept-Encoding"},
+            )
+        content = result.model_dump_json(by_alias=True).encode()
         return cls(
-            datasets=[
-                DatasetResponse.from_dataset(request, d) for d in catalog.datasets
-            ],
+            content=gzip.compress(content, compresslevel=6, mtime=0),
+            headers={"content-type": JSON, "vary": "Accept-Encoding"},
+            cacheable=not any(getattr(result, attr, False) for attr in PENDING_ATTRS),
         )
+
+    @property
+    def compressed(self) -> bool:
+        return self.headers.get("content-type") == JSON
+
+    def to_response(
+        self, request: Request, headers: dict[str, str] | None = None
+    ) -> Response:
+        headers = {**self.headers, **(headers or {})}
+        if not self.cacheable:
+            headers = {**self.headers, "cache-control": "no-store"}
+        content = self.content
+        if self.compressed:
+            if "gzip" in request.headers.get("accept-encoding", ""):
+                headers["content-encoding"] = "gzip"
+            else:
+                content = gzip.decompress(content)
+        return Response(content, status_code=self.status_code, headers=headers)
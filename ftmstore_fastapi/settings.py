@@ -1,4 +1,5 @@
 import os
+import tempfile
 
 from anystore.io import smart_read
 from banal import as_bool
@@ -12,9 +13,25 @@ CATALOG = os.environ.get("CATALOG")
 RESOLVER = os.environ.get("RESOLVER", os.environ.get("RESOLVER_PATH"))
 
 FTM_STORE_URI = os.environ.get("FTM_STORE_URI", DB_URL)
+# change after store rebuilds for non-file stores to invalidate http caches (etag)
+STORE_VERSION = os.environ.get("STORE_VERSION")
+
+# load datasets into a sqlite mirror at worker start (in memory or at PRELOAD_PATH)
+PRELOAD_DATASETS = as_bool(os.environ.get("PRELOAD_DATASETS", 0))
+SQLITE_IN_MEMORY = as_bool(os.environ.get("SQLITE_IN_MEMORY", 1))
+PRELOAD_PATH = os.environ.get("PRELOAD_PATH", tempfile.gettempdir())  # e.g. /dev/shm
+PRELOAD_MEMORY_MB = int(os.environ.get("PRELOAD_MEMORY_MB", 1024))
+# build one read-only snapshot file at PRELOAD_PATH shared by all workers
+PRELOAD_SHARED = as_bool(os.environ.get("PRELOAD_SHARED", 0))
+# typed, indexed sort keys for numeric and date properties in the preloaded mirror
+SORT_KEYS = as_bool(os.environ.get("SORT_KEYS", 1))
 
 DATASETS = os.environ.get("EXPOSE_DATASETS", "*")  # all by default
 DATASETS_STATS = as_bool(os.environ.get("DATASETS_STATS", 1))
+# precomputed dataset stats per store version
+STATS_PATH = os.environ.get("STATS_PATH", PRELOAD_PATH)
+# max seconds to wait for dataset stats, slower ones are returned as pending
+STATS_TIMEOUT = float(os.environ.get("STATS_TIMEOUT", 5))
 
 DEBUG = as_bool(os.environ.get("DEBUG", 0))
 LOG_LEVEL = "DEBUG" if DEBUG else "INFO"
@@ -23,10 +40,53 @@ BUILD_API_KEY = os.environ.get("BUILD_API_KEY", "secret-key-for-build")
 ALLOWED_ORIGIN = os.environ.get("ALLOWED_ORIGIN", "http://localhost:3000").split(",")
 CACHE = as_bool(os.environ.get("CACHE", 0))
 CACHE_TIMEOUT = int(os.environ.get("CACHE_TIMEOUT", 0))
+# serve expired entries for this many seconds while refreshing them
+CACHE_STALE_TIMEOUT = int(os.environ.get("CACHE_STALE_TIMEOUT", 0))
+# compute missing entries only once across workers (redis lock)
+CACHE_LOCK = as_bool(os.environ.get("CACHE_LOCK", 0))
+CACHE_LOCK_TIMEOUT = int(os.environ.get("CACHE_LOCK_TIMEOUT", 60))
+# in-process cache tier per worker (in front of redis)
+CACHE_MEMORY_SIZE = int(os.environ.get("CACHE_MEMORY_SIZE", 1_000))  # 0 to disable
+CACHE_MEMORY_MB = int(os.environ.get("CACHE_MEMORY_MB", 128))
+CACHE_MEMORY_TTL = int(os.environ.get("CACHE_MEMORY_TTL", 60))
+# in-process cache for single entity lookups per worker
+ENTITY_CACHE_SIZE = int(os.environ.get("ENTITY_CACHE_SIZE", 10_000))  # 0 to disable
+ENTITY_CACHE_MB = int(os.environ.get("ENTITY_CACHE_MB", 64))
+ENTITY_CACHE_TTL = int(os.environ.get("ENTITY_CACHE_TTL", 3600))
+# cache not existing entities (404) for this many seconds, 0 to disable
+ENTITY_CACHE_NEGATIVE_TTL = int(os.environ.get("ENTITY_CACHE_NEGATIVE_TTL", 60))
+# http cache headers, optionally per view, e.g. CACHE_CONTROL_ENTITY_DETAIL
+CACHE_CONTROL = os.environ.get("CACHE_CONTROL", "public, max-age=3600")
+CACHE_CONTROL_VIEWS = {
+    k[14:].lower(): v for k, v in os.environ.items() if k.startswith("CACHE_CONTROL_")
+}
 REDIS_URL = os.environ.get("REDIS_URL", "redis://localhost:6379")
 DEFAULT_LIMIT = 100
+# max entity ids per batch request (authenticated, otherwise DEFAULT_LIMIT)
+BATCH_LIMIT = int(os.environ.get("BATCH_LIMIT", 1_000))
+# max groups per grouped aggregation (`aggGroups`), the biggest ones
+AGGREGATION_GROUPS_LIMIT = int(os.environ.get("AGGREGATION_GROUPS_LIMIT", 100))
+# max inlined adjacent entities per property (nested=true)
+NESTED_LIMIT = int(os.environ.get("NESTED_LIMIT", 100))
+# store / cache calls running concurrently per worker (thread pool size)
+MAX_CONCURRENCY = int(os.environ.get("MAX_CONCURRENCY", 20))
+# expensive calls (aggregations, catalog stats) running concurrently per worker
+MAX_HEAVY_CONCURRENCY = int(os.environ.get("MAX_HEAVY_CONCURRENCY", 4))
 LOG_JSON = as_bool(os.environ.get("LOG_JSON", 0))
-INDEX_PROPERTIES = os.environ.get("INDEX_PROPERTIES", "").split(",")
+# ranked full-text search (`q`) via a sqlite fts5 index at PRELOAD_PATH
+SEARCH_INDEX = as_bool(os.environ.get("SEARCH_INDEX", 0))
+SEARCH_LIMIT = int(os.environ.get("SEARCH_LIMIT", 10_000))  # max ranked matches
+# facets (properties, `schema`, `dataset`) with materialized counts per dataset
+FACETS = [
+    f.strip()
+    for f in os.environ.get("FACETS", "schema,dataset,country,topics").split(",")
+    if f.strip()
+]
+# build the in-memory `/suggest` index at worker start (otherwise on first use)
+SUGGEST_PRELOAD = as_bool(os.environ.get("SUGGEST_PRELOAD", 1))
+INDEX_PROPERTIES = [
+    p.strip() for p in os.environ.get("INDEX_PROPERTIES", "").split(",") if p.strip()
+]
 
 # Api documentation render
 TITLE = os.environ.get("TITLE", "FollowTheMoney Store API")
@@ -48,7 +108,7 @@ read-only endpoint that allows granular data fetching and searching.
 This api works for all store implementations found in
 [`nomenklatura.store`](https://github.com/opensanctions/nomenklatura/tree/main/nomenklatura/store)
 
-There are four main api endpoints:
+There are five main api endpoints:
 
 * Retrieve a single entity based on its id and dataset, optionally with inlined
   adjacent entities: `/{dataset}/entities/{entity_id}`
@@ -57,6 +117,7 @@ There are four main api endpoints:
 * Search for entities (by their name property types) via
   [Sqlite FTS](https://www.sqlite.org/fts5.html): `/{dataset}/search?q=<search term>`
 * Aggregate (on store backend level) `sum`, `avg`, `max`, `min` for ftm properties
+* Typeahead suggestions for entity captions: `/suggest?prefix=<prefix>`
 
 Two more endpoints for catalog / dataset metadata:
 
@@ -0,0 +1,137 @@
+"""
+Typed sort keys for sorting (`order_by`) by numeric and date properties: the
+smallest and biggest value of each entity per property, parsed by its FtM
+type into a number, in an indexed table next to the statements. Sorted pages
+then become index scans instead of casting and sorting all values of the
+property at query time. Entities without any parseable value (invalid dates)
+get keys that sort them last in both directions instead of being dropped.
+
+The table is built into the preloaded sqlite mirror (or snapshot). For other
+sql stores, build it via `build(engine)` after each store rebuild.
+"""
+
+import re
+import sys
+from collections.abc import Generator
+from functools import cache
+from itertools import groupby
+
+from followthemoney.types import registry
+from ftmq.enums import PropertyTypesMap
+from ftmq.util import to_numeric
+from nomenklatura.statement.db import make_statement_table
+from sqlalchemy import (
+    Column,
+    Connection,
+    Engine,
+    Float,
+    Index,
+    MetaData,
+    Table,
+    Unicode,
+    insert,
+    inspect,
+    select,
+)
+
+from ftmstore_fastapi.logging import get_logger
+
+log = get_logger(__name__)
+
+BATCH_SIZE = 10_000
+SORT_TYPES = (registry.number, registry.date)
+# the min (ascending) and, negated, max (descending) key of entities without
+# any parseable value: finite, as not every database stores infinity
+LAST_KEY = sys.float_info.max
+
+metadata = MetaData()
+table = Table(
+    "sort_keys",
+    metadata,
+    Column("prop", Unicode(255), nullable=False),
+    Column("canonical_id", Unicode(255), nullable=False),
+    Column("min_key", Float, nullable=False),
+    Column("max_key", Float, nullable=False),
+)
+Index("ix_sort_keys_min", table.c.prop, table.c.min_key, table.c.canonical_id)
+Index("ix_sort_keys_max", table.c.prop, table.c.max_key.desc(), table.c.canonical_id)
+
+
+def is_sortable(prop: str) -> bool:
+    return prop in PropertyTypesMap.__members__ and (
+        PropertyTypesMap[prop].value in SORT_TYPES
+    )
+
+
+def to_sort_key(prop: str, value: str | int | float | None) -> float | None:
+    """
+    Numbers as such (non-numeric values as 0, like sql casts them), dates as
+    their digits (`2014-05` -> 20140500000000.0) so that they keep the order
+    of the iso strings
+    """
+    if value is None:
+        return None
+    if PropertyTypesMap[prop].value == registry.number:
+        return float(to_numeric(value) or 0)
+    value = registry.date.clean(str(value))
+    if value is None:
+        return None
+    return float(re.sub(r"\D", "", value)[:14].ljust(14, "0"))
+
+
+def iter_keys(conn: Connection) -> Generator[dict[str, str | float], None, None]:
+    statements = make_statement_table(MetaData())
+    q = (
+        select(statements.c.canonical_id, statements.c.prop, statements.c.value)
+        .where(statements.c.prop_type.in_([t.name for t in SORT_TYPES]))
+        .order_by(statements.c.canonical_id, statements.c.prop)
+    )
+    res = conn.execution_options(stream_results=True).execute(q)
+    for (canonical_id, prop), rows in groupby(res, key=lambda r: r[:2]):
+        keys = [k for _, _, v in rows if (k := to_sort_key(prop, v)) is not None]
+        yield {
+            "prop": prop,
+            "canonical_id": canonical_id,
+            "min_key": min(keys) if keys else LAST_KEY,
+            "max_key": max(keys) if keys else -LAST_KEY,
+        }
+
+
+def build(engine: Engine) -> int:
+    """
+    (Re)build the sort keys table from the statements in the same database
+    """
+    metadata.drop_all(engine)
+    metadata.create_all(engine)
+    rows = 0
+    batch = []
+    with engine.begin() as conn:
+        for row in iter_keys(conn):
+            batch.append(row)
+            if len(batch) == BATCH_SIZE:
+                conn.execute(insert(table), batch)
+                rows += len(batch)
+                batch = []
+        if batch:
+            conn.execute(insert(table), batch)
+            rows += len(batch)
+    log.info("Built sort keys", rows=rows, uri=str(engine.url))
+    return rows
+
+
+def to_cursor_key(prop: str, value: str | int | float | None, ascending: bool) -> float:
+    """
+    The sort key of a cursor value: already a key if it came from the sort
+    keys, otherwise the entity's sort value (None if it has no valid one)
+    """
+    if isinstance(value, (int, float)):
+        return float(value)
+    key = to_sort_key(prop, value)
+    if key is None:
+        return LAST_KEY if ascending else -LAST_KEY
+    return key
+
+
+@cache
+def exists(engine: Engine) -> bool:
+    return inspect(engine).has_table(table.name)
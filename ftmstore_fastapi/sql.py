@@ -0,0 +1,334 @@
+"""
+Extend the `ftmq` sql query builder for things the api needs on top, e.g.
+keyset (cursor) pagination.
+"""
+
+from collections.abc import Iterable
+from functools import cached_property
+from typing import TYPE_CHECKING, Any
+
+from followthemoney.types import registry
+from ftmq.enums import Aggregations, Fields, PropertyTypesMap
+from ftmq.exceptions import ValidationError
+from ftmq.sql import Sql as _Sql
+from nomenklatura.statement import Statement
+from sqlalchemy import (
+    NUMERIC,
+    BooleanClauseList,
+    Column,
+    ColumnElement,
+    CompoundSelect,
+    Select,
+    Subquery,
+    and_,
+    desc,
+    distinct,
+    func,
+    literal,
+    or_,
+    select,
+    union_all,
+)
+
+from ftmstore_fastapi import settings, sortkeys
+
+if TYPE_CHECKING:
+    from ftmstore_fastapi.query import Cursor, Query
+
+
+def is_numeric_sort(prop: str) -> bool:
+    return PropertyTypesMap[prop].value == registry.number
+
+
+class Sql(_Sql):
+    q: "Query"
+
+    @cached_property
+    def clause(self) -> BooleanClauseList:
+        clause = _Sql.clause.func(self)
+        if self.q.search_matches is not None:
+            # matches of the attached search index
+            clause = and_(clause, self.table.c.canonical_id.in_(self.q.search_matches))
+        elif self.q.search_ids is not None:
+            # matches of the search index
+            clause = and_(clause, self.table.c.canonical_id.in_(self.q.search_ids))
+        return clause
+
+    @cached_property
+    def all_canonical_ids(self) -> Select:
+        q = select(self.table.c.canonical_id.distinct()).where(self.clause)
+        if self.q.search_filters:
+            search_ids = select(self.table.c.canonical_id.distinct()).where(
+                self.search_clause
+            )
+            q = q.where(self.table.c.canonical_id.in_(search_ids))
+        return q
+
+    @cached_property
+    def canonical_ids(self) -> Select:
+        q = self.all_canonical_ids
+        if self.q.sort is None:
+            order_by = self.table.c.canonical_id
+            cursor = self.q.cursor
+            if cursor is not None:
+                if cursor.reverse:
+                    q = q.where(self.table.c.canonical_id < cursor.id)
+                    order_by = desc(order_by)
+                else:
+                    q = q.where(self.table.c.canonical_id > cursor.id)
+            q = q.order_by(order_by).limit(self.q.limit).offset(self.q.offset)
+        return q
+
+    def get_facet_counts(
+        self, facets: Iterable[str], limit: int | None = None
+    ) -> CompoundSelect:
+        """
+        (facet, value, count) rows of the top `limit` values of each facet
+        (property or `schema`, `dataset`) by their number of matching entities,
+        all facets in one statement over the matching ids
+        """
+        ids = self.all_canonical_ids.cte("ids")
+        where = self.table.c.canonical_id.in_(select(ids))
+        qs = []
+        for facet in facets:
+            value = self.table.c.value
+            facet_where = and_(self.table.c.prop == facet, where)
+            if facet in self.META_COLUMNS:
+                value = self.META_COLUMNS[facet]
+                facet_where = where
+            count = func.count(self.table.c.canonical_id.distinct()).label("count")
+            q = (
+                select(value.label("value"), count)
+                .where(facet_where)
+                .group_by(value)
+                .order_by(desc("count"), value)
+                .limit(limit)
+                .subquery()
+            )
+            qs.append(select(literal(facet), q.c.value, q.c.count))
+        return union_all(*qs)
+
+    def get_grouper(self, group: str) -> Select:
+        """
+        Distinct (canonical_id, group value) pairs of the matching entities
+        """
+        value = self.table.c.value
+        all_ids = self.table.c.canonical_id.in_(self.all_canonical_ids)
+        where: ColumnElement[bool]
+        if group in self.META_COLUMNS:
+            value = self.META_COLUMNS[group]
+            where = self.clause
+        elif group == Fields.year:
+            value = func.substr(self.table.c.value, 1, 4)
+            where = and_(self.table.c.prop_type == registry.date.name, all_ids)
+        else:
+            where = and_(self._get_lookup_column(group) == group, all_ids)
+        return (
+            select(self.table.c.canonical_id, value.label("value"))
+            .where(where)
+            .distinct()
+        )
+
+    @cached_property
+    def group_aggregations(self) -> CompoundSelect:
+        """
+        All grouped aggregations as (grouper, prop, func, group, group size,
+        value) rows in one statement: one GROUP BY per aggregation over the (at
+        most `AGGREGATION_GROUPS_LIMIT`) biggest groups instead of one query
+        per group
+        """
+        qs = []
+        for grouper in sorted(self.group_props):
+            groups = self.get_grouper(grouper).cte(f"groups_{grouper}")
+            top = (
+                select(groups.c.value, func.count().label("count"))
+                .group_by(groups.c.value)
+                .order_by(desc("count"), groups.c.value)
+                .limit(settings.AGGREGATION_GROUPS_LIMIT)
+                .cte(f"top_{grouper}")
+            )
+            for agg in self.q.aggregations:
+                if grouper not in agg.group_props:
+                    continue
+                prop, value = agg.prop, self.table.c.value
+                if prop in self.META_COLUMNS:
+                    prop, value = Statement.BASE, self.META_COLUMNS[prop]
+                if agg.func == Aggregations.count:
+                    value = distinct(value)
+                elif agg.func in (Aggregations.sum, Aggregations.avg):
+                    value = func.cast(value, NUMERIC)
+                qs.append(
+                    select(
+                        literal(str(grouper)),
+                        literal(str(agg.prop)),
+                        literal(str(agg.func)),
+                        top.c.value,
+                        top.c.count,
+                        getattr(func, agg.func)(value),
+                    )
+                    .select_from(
+                        self.table.join(
+                            groups, self.table.c.canonical_id == groups.c.canonical_id
+                        ).join(top, groups.c.value == top.c.value)
+                    )
+                    .where(self.table.c.prop == prop)
+                    .group_by(top.c.value, top.c.count)
+                )
+        return union_all(*qs)
+
+    @cached_property
+    def _sorted_statements(self) -> Select:
+        if len(self.q.sort.values) > 1:
+            raise ValidationError(
+                f"Multi-valued sort not supported for `{self.__class__.__name__}`"
+            )
+        prop = self.q.sort.values[0]
+        ascending = self.q.sort.ascending
+        cursor = self.q.cursor
+        inner_ascending = ascending
+        if cursor is not None and cursor.reverse:
+            # seek before the cursor, the outer query restores the requested
+            # order
+            inner_ascending = not ascending
+        if self.q.sort_keys and sortkeys.is_sortable(prop):
+            inner = self._get_sort_keys_page(prop, ascending, inner_ascending)
+        else:
+            inner = self._get_sort_values_page(prop, ascending, inner_ascending)
+        return select(
+            self.table.join(inner, self.table.c.canonical_id == inner.c.canonical_id)
+        ).order_by(*self._get_sort_order(ascending))
+
+    def _get_sortable_value(self, prop: str, ascending: bool) -> ColumnElement:
+        """
+        The value of an entity to sort by: its smallest (or biggest) value of
+        the property, numeric properties casted
+        """
+        value = self.table.c.value
+        if is_numeric_sort(prop):
+            value = func.cast(self.table.c.value, NUMERIC)
+        group_func = func.min if ascending else func.max
+        return group_func(value)
+
+    def get_sort_values(self, ids: Iterable[str]) -> Select:
+        """
+        (canonical_id, sort value) of the given entities, by the same
+        expression as the sorted pages, for their cursors
+        """
+        prop = self.q.sort.values[0]
+        ascending = self.q.sort.ascending
+        if self.q.sort_keys and sortkeys.is_sortable(prop):
+            keys = sortkeys.table
+            key = keys.c.min_key if ascending else keys.c.max_key
+            return select(keys.c.canonical_id, key).where(
+                keys.c.prop == prop, keys.c.canonical_id.in_(ids)
+            )
+        return (
+            select(self.table.c.canonical_id, self._get_sortable_value(prop, ascending))
+            .where(self.table.c.prop == prop, self.table.c.canonical_id.in_(ids))
+            .group_by(self.table.c.canonical_id)
+        )
+
+    def _get_sort_values_page(
+        self, prop: str, ascending: bool, inner_ascending: bool
+    ) -> Subquery:
+        sortable_value = self._get_sortable_value(prop, ascending)
+        inner = (
+            select(
+                self.table.c.canonical_id,
+                sortable_value.label("sortable_value"),
+            )
+            .where(
+                and_(
+                    self.table.c.prop == prop,
+                    self.table.c.canonical_id.in_(self.canonical_ids),
+                )
+            )
+            .group_by(self.table.c.canonical_id)
+            .limit(self.q.limit)
+            .offset(self.q.offset)
+        )
+        cursor = self.q.cursor
+        if cursor is not None:
+            inner = inner.having(
+                self._get_after_cursor(
+                    cursor,
+                    sortable_value,
+                    cursor.value,
+                    self.table.c.canonical_id,
+                    inner_ascending,
+                )
+            )
+        return inner.order_by(*self._get_sort_order(inner_ascending, cursor)).subquery()
+
+    def _get_sort_keys_page(
+        self, prop: str, ascending: bool, inner_ascending: bool
+    ) -> Subquery:
+        """
+        The page of entity ids via the precomputed sort keys: an index scan
+        over (prop, key, id) instead of grouping and sorting all values
+        """
+        keys = sortkeys.table
+        key = keys.c.min_key if ascending else keys.c.max_key
+        inner = (
+            select(keys.c.canonical_id, key.label("sortable_value"))
+            .where(
+                and_(
+                    keys.c.prop == prop,
+                    keys.c.canonical_id.in_(self.canonical_ids),
+                )
+            )
+            .limit(self.q.limit)
+            .offset(self.q.offset)
+        )
+        cursor = self.q.cursor
+        if cursor is not None:
+            cursor_key = sortkeys.to_cursor_key(prop, cursor.value, ascending)
+            inner = inner.where(
+                self._get_after_cursor(
+                    cursor,
+                    key,
+                    cursor_key,
+                    keys.c.canonical_id,
+                    inner_ascending,
+                )
+            )
+        order_by = self._get_sort_order(inner_ascending, cursor, keys.c.canonical_id)
+        return inner.order_by(*order_by).subquery()
+
+    def _get_after_cursor(
+        self,
+        cursor: "Cursor",
+        value: Any,
+        cursor_value: Any,
+        id_column: Column,
+        ascending: bool,
+    ) -> ColumnElement:
+        """
+        Seek after (or before) the (value, id) pair of the cursor
+        """
+        after_value = value > cursor_value if ascending else value < cursor_value
+        after_id = id_column > cursor.id
+        if cursor.reverse:
+            after_id = id_column < cursor.id
+        return or_(after_value, and_(value == cursor_value, after_id))
+
+    @cached_property
+    def statements(self) -> Select:
+        q = self._sorted_statements if self.q.sort else self._unsorted_statements
+        props = self.q.projected_props
+        if props:
+            # projection: only load the needed properties
+            q = q.where(self.table.c.prop.in_(props))
+        return q
+
+    def _get_sort_order(
+        self,
+        ascending: bool,
+        cursor: "Cursor | None" = None,
+        id_column: Column | None = None,
+    ) -> list[Any]:
+        order_by = "sortable_value" if ascending else desc("sortable_value")
+        id_order = self.table.c.canonical_id if id_column is None else id_column
+        if cursor is not None and cursor.reverse:
+            id_order = desc(id_order)
+        return [order_by, id_order]
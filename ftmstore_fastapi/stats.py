@@ -0,0 +1,164 @@
+"""
+Precomputed dataset statistics for the catalog views.
+
+Stats for all datasets are computed once per store version in the background
+(concurrently across datasets on a bounded pool) and persisted as a json file
+at `STATS_PATH`, so that all workers and restarts reuse them until the store
+changes. Views wait at most `STATS_TIMEOUT` seconds for the stats of a dataset,
+datasets that are not ready yet are returned without stats.
+"""
+
+import json
+from collections.abc import Generator
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from pathlib import Path
+from threading import Lock, Thread
+
+from ftmq.model import DatasetStats
+
+from ftmstore_fastapi import settings
+from ftmstore_fastapi.logging import get_logger
+from ftmstore_fastapi.metrics import metrics
+from ftmstore_fastapi.preload import file_lock, get_prefix, remove_outdated
+from ftmstore_fastapi.store import (
+    get_catalog,
+    get_exposed_datasets,
+    get_store_fingerprint,
+    get_view,
+)
+
+log = get_logger(__name__)
+
+STATS_NAME = "ftmstore-stats"
+
+_lock = Lock()
+_stats: tuple[str, dict[str, Future]] | None = None
+
+
+def get_stats_prefix() -> str:
+    datasets = sorted(get_exposed_datasets() or [])
+    return get_prefix(STATS_NAME, settings.FTM_STORE_URI, *datasets)
+
+
+def get_stats_path(version: str) -> Path:
+    return Path(settings.STATS_PATH) / f"{get_stats_prefix()}-{version[:16]}.json"
+
+
+def compute_stats(
+    futures: dict[str, Future],
+) -> Generator[tuple[str, DatasetStats], None, None]:
+    """
+    Compute the stats of the given datasets concurrently, resolving their
+    futures as soon as each one is done. Failed datasets are skipped, their
+    futures keep the error (and the datasets stay pending).
+    """
+
+    def _compute(name: str) -> DatasetStats:
+        with metrics.timer("dataset_stats"):
+            return get_view(name).stats()
+
+    with ThreadPoolExecutor(settings.MAX_HEAVY_CONCURRENCY) as executor:
+        tasks = {executor.submit(_compute, name): name for name in futures}
+        for task in as_completed(tasks):
+            name = tasks[task]
+            try:
+                res = task.result()
+            except Exception as e:
+                log.error(f"Dataset stats failed: `{e}`", dataset=name)
+                futures[name].set_exception(e)
+                continue
+            futures[name].set_result(res)
+            yield name, res
+
+
+def load_stats(path: Path) -> dict[str, DatasetStats]:
+    with open(path) as fh:
+        data = json.load(fh)
+    return {k: DatasetStats(**v) for k, v in data.items()}
+
+
+def dump_stats(path: Path, stats: dict[str, DatasetStats]) -> None:
+    data = {k: v.model_dump(mode="json") for k, v in stats.items()}
+    tmp_path = path.with_suffix(".tmp")
+    with open(tmp_path, "w") as fh:
+        json.dump(data, fh)
+    tmp_path.replace(path)
+
+
+def build_stats(version: str, futures: dict[str, Future]) -> None:
+    """
+    Load the stats for this store version from disk and compute the missing
+    ones (the first process to get here computes them, the others wait for the
+    file). Stats are persisted as each dataset is done.
+    """
+    path = get_stats_path(version)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    try:
+        with file_lock(path.with_suffix(".lock")):
+            stats = load_stats(path) if path.exists() else {}
+            for name, res in stats.items():
+                if name in futures:
+                    futures[name].set_result(res)
+            # e.g. datasets that failed before
+            missing = {n: f for n, f in futures.items() if n not in stats}
+            if missing:
+                log.info(
+                    "Computing dataset stats", path=str(path), datasets=len(missing)
+                )
+                for name, res in compute_stats(missing):
+                    stats[name] = res
+                    dump_stats(path, stats)  # keep what is done
+                remove_outdated(path, get_stats_prefix())
+    except Exception as e:
+        global _stats
+        log.error(f"Dataset stats failed: `{e}`", path=str(path))
+        with _lock:  # retry on next access
+            if _stats is not None and _stats[1] is futures:
+                _stats = None
+    for future in futures.values():
+        if not future.done():
+            future.set_exception(KeyError("No stats"))
+
+
+def get_stats_futures() -> dict[str, Future]:
+    """
+    The (pending) stats per catalog dataset for the current store version,
+    starting their computation in the background if necessary
+    """
+    global _stats
+    version = get_store_fingerprint()
+    with _lock:
+        if _stats is None or _stats[0] != version:
+            futures: dict[str, Future] = {
+                name: Future() for name in sorted(get_catalog().names)
+            }
+            _stats = version, futures
+            Thread(target=build_stats, args=(version, futures), daemon=True).start()
+        return _stats[1]
+
+
+def get_dataset_stats(
+    *names: str, timeout: float | None = None
+) -> dict[str, DatasetStats | None]:
+    """
+    Stats for the given (or all catalog) datasets, waiting at most `timeout`
+    (default: `STATS_TIMEOUT`) seconds per dataset. Datasets whose stats are
+    not ready yet (or failed) are `None`.
+    """
+    futures = get_stats_futures()
+    if timeout is None:
+        timeout = settings.STATS_TIMEOUT
+    stats: dict[str, DatasetStats | None] = {}
+    for name in names or futures:
+        future = futures.get(name)
+        stats[name] = None
+        if future is None:
+            continue
+        try:
+            stats[name] = future.result(timeout)
+        except FutureTimeoutError:
+            metrics.incr("dataset_stats.pending")
+        except Exception:
+            pass
+    return stats
@@ -1,16 +1,43 @@
-from functools import cache, lru_cache
-from typing import TYPE_CHECKING, Literal
+import hashlib
+import os
+from collections import defaultdict
+from collections.abc import Generator, Iterable
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from functools import cache
+from itertools import islice
+from typing import TYPE_CHECKING, Any, Literal
 
+from anystore.util import clean_dict
 from fastapi import HTTPException
+from followthemoney.types import registry
+from ftmq.aggregations import AggregatorResult
 from ftmq.dedupe import get_resolver
+from ftmq.enums import Fields
 from ftmq.model import Catalog, Dataset
-from ftmq.query import Q
+from ftmq.query import Q, Query
 from ftmq.store import Store
 from ftmq.store import get_store as _get_store
+from ftmq.store.sql import SQLQueryView, clean_agg_value
 from ftmq.types import CE, CEGenerator
+from sqlalchemy import Engine, create_engine
+from sqlalchemy.engine import make_url
 
+from ftmstore_fastapi import search, settings, sortkeys
 from ftmstore_fastapi.logging import get_logger
-from ftmstore_fastapi.settings import CATALOG, FTM_STORE_URI, RESOLVER
+from ftmstore_fastapi.lru import LRUCache
+from ftmstore_fastapi.metrics import metrics
+from ftmstore_fastapi.preload import preload, snapshot
+from ftmstore_fastapi.resolver import get_resolver_map
+from ftmstore_fastapi.settings import (
+    CATALOG,
+    FTM_STORE_URI,
+    PRELOAD_DATASETS,
+    PRELOAD_SHARED,
+    RESOLVER,
+    STORE_VERSION,
+    VERSION,
+)
 from ftmstore_fastapi.util import get_dehydrated_proxy, get_featured_proxy
 
 if TYPE_CHECKING:
@@ -18,12 +45,37 @@ if TYPE_CHECKING:
 
 log = get_logger(__name__)
 
+ADJACENTS_BATCH_SIZE = 1_000
+ENTITY_OVERHEAD = 512  # bytes per cached entity (proxy, schema, statements)
+SCOPE_ALL = "*"
+
+
+def get_exposed_datasets() -> list[str] | None:
+    """
+    Dataset names from `EXPOSE_DATASETS` or `None` for all
+    """
+    if settings.DATASETS.strip() == "*":
+        return None
+    return [n.strip() for n in settings.DATASETS.split(",") if n.strip()]
+
 
 @cache
 def get_catalog(uri: str | None = CATALOG) -> Catalog:
+    """
+    The catalog, limited to the exposed datasets
+    """
     uri = uri or CATALOG
+    exposed = get_exposed_datasets()
     if uri is not None:
-        return Catalog._from_uri(uri)
+        catalog = Catalog._from_uri(uri)
+        if exposed is not None:
+            missing = set(exposed) - set(catalog.names)
+            if missing:
+                log.warning(f"Exposed datasets not in catalog: {', '.join(missing)}")
+            catalog.datasets = [d for d in catalog.datasets if d.name in exposed]
+        return catalog
+    if exposed is not None:
+        return Catalog.from_names(exposed)
     return Catalog()
 
 
@@ -36,6 +88,57 @@ def get_dataset(name: str, catalog: Catalog | None = None) -> Dataset:
     return dataset
 
 
+@cache
+def get_store_uri() -> str:
+    """
+    The preloaded sqlite mirror or shared snapshot (if enabled and the
+    datasets fit into memory) or `FTM_STORE_URI`
+    """
+    if PRELOAD_DATASETS:
+        datasets = [d.name for d in get_catalog().datasets] or None
+        try:
+            if PRELOAD_SHARED:
+                version = get_store_fingerprint()
+                return snapshot(FTM_STORE_URI, datasets, version)
+            return preload(FTM_STORE_URI, datasets)
+        except Exception as e:
+            log.warning(f"Not preloading datasets: {e}", uri=FTM_STORE_URI)
+    return FTM_STORE_URI
+
+
+@contextmanager
+def get_source_engine() -> Generator[Engine, None, None]:
+    """
+    A throwaway engine to build artifacts (search index, facet tables) from
+    the store data, as this happens in the gunicorn master process too: the
+    connections of the cached store must not be inherited by forked workers
+    (and a per-worker mirror is not loaded in the master)
+    """
+    engine = create_engine(get_store_uri() if PRELOAD_SHARED else FTM_STORE_URI)
+    try:
+        yield engine
+    finally:
+        engine.dispose()
+
+
+@contextmanager
+def get_source_store() -> Generator[Store, None, None]:
+    """
+    A throwaway (uncached) store to build in-memory artifacts (suggest index)
+    from, for the same reason as `get_source_engine`
+    """
+    uri = get_store_uri() if PRELOAD_SHARED else FTM_STORE_URI
+    store = _get_store.__wrapped__(
+        uri=uri, catalog=get_catalog(), resolver=get_resolver(RESOLVER)
+    )
+    try:
+        yield store
+    finally:
+        engine = getattr(store, "engine", None)
+        if engine is not None:
+            engine.dispose()
+
+
 @cache
 def get_store(
     dataset: str | None = None,
@@ -47,13 +150,32 @@ def get_store(
     if dataset is not None:
         dataset = get_dataset(dataset, catalog)
         store = _get_store(
-            catalog=catalog, dataset=dataset, uri=FTM_STORE_URI, resolver=resolver
+            catalog=catalog, dataset=dataset, uri=get_store_uri(), resolver=resolver
         )
     else:
-        store = _get_store(catalog=catalog, uri=FTM_STORE_URI, resolver=resolver)
+        store = _get_store(catalog=catalog, uri=get_store_uri(), resolver=resolver)
+    engine = getattr(store, "engine", None)
+    if settings.SEARCH_INDEX and engine is not None:
+        search.attach(engine)
     return store
 
 
+def has_attached_search_index() -> bool:
+    """
+    If the search index is attached to the (sqlite) store connections
+    """
+    engine = getattr(get_store(), "engine", None)
+    return engine is not None and search.is_attached(engine)
+
+
+def has_sort_keys() -> bool:
+    """
+    If the (sql) store has precomputed sort keys
+    """
+    engine = getattr(get_store(), "engine", None)
+    return engine is not None and sortkeys.exists(engine)
+
+
 class View:
     def __init__(
         self,
@@ -63,32 +185,133 @@ class View:
     ) -> None:
         self.store = get_store(dataset, catalog_uri, resolver_uri)
         self.dataset = dataset
+        self.resolver_uri = resolver_uri or RESOLVER
         self.query = self.store.query()
         self.view = self.store.default_view()
 
         self.stats = self.query.stats
-        self.aggregations = self.query.aggregations
-        self.get_adjacents = self.query.get_adjacents
+
+    def aggregations(self, query: Q) -> AggregatorResult | None:
+        """
+        Aggregations, for sql stores with all grouped aggregations (`aggGroups`)
+        computed in one statement
+        """
+        if not isinstance(self.query, SQLQueryView) or not query.sql.group_props:
+            return self.query.aggregations(query)
+        query = self.query.ensure_scoped_query(query)
+        res: AggregatorResult = defaultdict(dict)
+        for prop, func, value in self.store._execute(
+            query.sql.aggregations, stream=False
+        ):
+            res[func][prop] = clean_agg_value(value)
+        res["groups"] = defaultdict(lambda: defaultdict(lambda: defaultdict(dict)))
+        rows = self.store._execute(query.sql.group_aggregations, stream=False)
+        # biggest groups first, years in chronological order
+        for grouper, prop, func, group, _, value in sorted(
+            rows,
+            key=lambda r: (r[0], r[1], r[2], 0 if r[0] == Fields.year else -r[4], r[3]),
+        ):
+            res["groups"][grouper][func][prop][group] = clean_agg_value(value)
+        return clean_dict(res)
+
+    def count(self, query: Q) -> int:
+        if isinstance(self.query, SQLQueryView):
+            query = self.query.ensure_scoped_query(query)
+            for res in self.store._execute(query.sql.count, stream=False):
+                return res[0]
+        return self.stats(query).entity_count
+
+    def get_adjacents(
+        self, proxies: Iterable[CE], limit: int | None = None
+    ) -> list[CE]:
+        """
+        Load the entities referenced by the given proxies (at most `limit`
+        per property), for sql stores in batched queries instead of one lookup
+        per value
+        """
+        ids: set[str] = set()
+        for proxy in proxies:
+            for prop in proxy.iterprops():
+                if prop.type == registry.entity:
+                    ids.update(proxy.get(prop)[:limit])
+        return list(self.load_entities(sorted(ids)))
+
+    def load_entities(self, entity_ids: list[str]) -> CEGenerator:
+        """
+        Load entities by their canonical ids, from sql stores in batched
+        `canonical_id IN (...)` queries, from other stores (where such a query
+        scans the whole store) one by one
+        """
+        if not isinstance(self.query, SQLQueryView):
+            for entity_id in entity_ids:
+                proxy = self.view.get_entity(entity_id)
+                if proxy is not None:
+                    yield proxy
+            return
+        for ix in range(0, len(entity_ids), ADJACENTS_BATCH_SIZE):
+            batch = entity_ids[ix : ix + ADJACENTS_BATCH_SIZE]
+            query = Query().where(canonical_id__in=batch)
+            yield from islice(self.query.entities(query), len(batch))
 
     def get_entity(self, entity_id: str, params: "RetrieveParams") -> CE | None:
-        canonical = self.store.resolver.get_canonical(entity_id)
-        proxy = get_cached_entity(self.view, canonical)
+        canonical = self.get_canonicals([entity_id])[entity_id]
+        proxy = entity_cache.get(self, canonical)
         if proxy is None:
             raise HTTPException(404, detail=[f"Entity `{entity_id}` not found."])
+        return self.retrieve(proxy, params)
+
+    def get_canonicals(self, entity_ids: Iterable[str]) -> dict[str, str]:
+        resolver = get_resolver_map(self.resolver_uri)
+        if resolver is not None:
+            return resolver.get_canonicals(entity_ids)
+        return {i: self.store.resolver.get_canonical(i) for i in entity_ids}
+
+    def get_entities_by_id(
+        self, entity_ids: Iterable[str], params: "RetrieveParams"
+    ) -> dict[str, CE]:
+        """
+        Retrieve multiple entities by their canonical ids, not existing ones
+        are omitted
+        """
+        proxies = entity_cache.get_many(self, entity_ids)
+        return {i: self.retrieve(p, params) for i, p in proxies.items() if p}
+
+    def get_ranked_entities(self, query: Q, params: "RetrieveParams") -> list[CE]:
+        """
+        The current page of a ranked search (via the search index), in the
+        order of the search rank
+        """
+        query = self.query.ensure_scoped_query(query)
+        res = self.store._execute(query.sql.all_canonical_ids, stream=False)
+        matches = {r[0] for r in res}
+        ids = query.paginate([i for i in query.search_ids if i in matches])
+        entities = self.get_entities_by_id(ids, params)
+        return [entities[i] for i in ids if i in entities]
+
+    def get_sort_values(self, query: Q, proxies: list[CE]) -> dict[str, Any] | None:
+        """
+        The sort values of the first and last entity of a sorted page as the
+        sql store sorted them, for the cursors (keyset pagination compares
+        with them in sql)
+        """
+        if not query.sort or not proxies or not isinstance(self.query, SQLQueryView):
+            return None
+        query = self.query.ensure_scoped_query(query)
+        ids = sorted({proxies[0].id, proxies[-1].id})
+        res = self.store._execute(query.sql.get_sort_values(ids), stream=False)
+        return {r[0]: clean_agg_value(r[1]) for r in res}
+
+    def get_entities(self, query: Q, params: "RetrieveParams") -> CEGenerator:
+        for proxy in self.query.entities(query):
+            yield self.retrieve(proxy, params)
+
+    def retrieve(self, proxy: CE, params: "RetrieveParams") -> CE:
         if params.dehydrate:
             return get_dehydrated_proxy(proxy)
         if params.featured:
             return get_featured_proxy(proxy)
         return proxy
 
-    def get_entities(self, query: Q, params: "RetrieveParams") -> CEGenerator:
-        for proxy in self.query.entities(query):
-            if params.dehydrate:
-                proxy = get_dehydrated_proxy(proxy)
-            elif params.featured:
-                proxy = get_featured_proxy(proxy)
-            yield proxy
-
 
 @cache
 def get_view(
@@ -99,9 +322,123 @@ def get_view(
     return View(dataset, catalog_uri, resolver_uri)
 
 
-@lru_cache(10_000)
-def get_cached_entity(view: View, entity_id: str) -> CE:
-    return view.get_entity(entity_id)
+class EntityCache:
+    """
+    In-process (per worker) cache for single entity lookups, bounded by
+    `ENTITY_CACHE_SIZE` entries and `ENTITY_CACHE_MB`. Not existing entities
+    are cached as well (for `ENTITY_CACHE_NEGATIVE_TTL` seconds) so that
+    repeated lookups for them don't hit the store.
+    """
+
+    def __init__(self) -> None:
+        self.cache = LRUCache(
+            settings.ENTITY_CACHE_SIZE,
+            settings.ENTITY_CACHE_MB * 1024 * 1024,
+            settings.ENTITY_CACHE_TTL,
+            name="entity_cache",
+        )
+
+    def get(self, view: View, entity_id: str) -> CE | None:
+        return self.get_many(view, [entity_id])[entity_id]
+
+    def get_many(self, view: View, entity_ids: Iterable[str]) -> dict[str, CE | None]:
+        """
+        Look up multiple (canonical) entity ids, fetching the ones not cached
+        yet from the store in batches (see `View.load_entities`)
+        """
+        res: dict[str, CE | None] = {}
+        missing: list[str] = []
+        for entity_id in entity_ids:
+            try:
+                res[entity_id] = self._get(view, entity_id)
+            except KeyError:
+                missing.append(entity_id)
+        for proxy in view.load_entities(missing):
+            res[proxy.id] = proxy
+        for entity_id in missing:
+            self.put(view, entity_id, res.setdefault(entity_id, None))
+        return res
+
+    def put(self, view: View, entity_id: str, proxy: CE | None) -> None:
+        key = view.dataset, entity_id
+        tags = {view.dataset or SCOPE_ALL}
+        if proxy is None:
+            if settings.ENTITY_CACHE_NEGATIVE_TTL:
+                self.cache.put(
+                    key,
+                    None,
+                    size=len(entity_id),
+                    tags=tags,
+                    ttl=settings.ENTITY_CACHE_NEGATIVE_TTL,
+                )
+        else:
+            tags.update(proxy.datasets)
+            self.cache.put(key, proxy, size=get_entity_size(proxy), tags=tags)
+
+    def _get(self, view: View, entity_id: str) -> CE | None:
+        try:
+            proxy = self.cache.get((view.dataset, entity_id))
+            metrics.incr("entity_cache.hit")
+            return proxy
+        except KeyError:
+            metrics.incr("entity_cache.miss")
+            raise
+
+    def invalidate(self, dataset: str | None = None) -> int:
+        """
+        Remove the entities of the given dataset (and all lookups across
+        datasets) or all entities if no dataset given
+        """
+        if dataset is None:
+            removed = len(self.cache)
+            self.cache.clear()
+            return removed
+        return self.cache.invalidate(dataset, SCOPE_ALL)
+
+
+def get_entity_size(proxy: CE) -> int:
+    """
+    Approximate memory size of an entity (its values plus a fixed overhead)
+    """
+    size = ENTITY_OVERHEAD + len(proxy.id or "")
+    for prop, value in proxy.itervalues():
+        size += len(prop.name) + len(value)
+    return size
+
+
+entity_cache = EntityCache()
+
+
+def get_store_files() -> list[str]:
+    """
+    Local files the api responses depend on (sqlite store, catalog, resolver)
+    """
+    files = [CATALOG, RESOLVER]
+    if FTM_STORE_URI.startswith("sqlite"):
+        files.append(make_url(FTM_STORE_URI).database)
+    return [f for f in files if f and os.path.isfile(f)]
+
+
+def get_store_fingerprint() -> str:
+    """
+    Identify the current version of the store data, this changes when the
+    store (or catalog, resolver, exposed datasets) is rebuilt. For non-file
+    stores, set `STORE_VERSION` to a new value after each rebuild.
+    """
+    parts = [VERSION, FTM_STORE_URI, STORE_VERSION]
+    # instances exposing different datasets must not share artifacts
+    parts.extend(sorted(get_exposed_datasets() or []))
+    for path in get_store_files():
+        stat = os.stat(path)
+        parts.append(f"{path}:{stat.st_mtime_ns}:{stat.st_size}")
+    return hashlib.sha1(":".join(map(str, parts)).encode()).hexdigest()
+
+
+def get_last_modified() -> datetime | None:
+    mtimes = [os.stat(f).st_mtime for f in get_store_files()]
+    if mtimes:
+        return datetime.fromtimestamp(int(max(mtimes)), timezone.utc)
+    return None
 
 
 # cache at boot time
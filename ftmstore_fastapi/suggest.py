@@ -0,0 +1,197 @@
+"""
+Typeahead suggestions (`/suggest`) from an in-memory prefix index of entity
+captions, built once per store version (in the gunicorn master process or per
+worker): sorted arrays of the normalized captions (and the captions starting at
+each of their words) per schema for binary search.
+
+After a store change, the outdated index keeps serving (uncached) responses
+until the index for the new version is built in the background.
+"""
+
+from bisect import bisect_left
+from collections import defaultdict
+from collections.abc import Generator
+from concurrent.futures import Future
+from heapq import merge
+from itertools import chain
+from threading import Lock
+from typing import NamedTuple
+
+from followthemoney import model
+from followthemoney.schema import Schema
+from ftmq.store import Store
+from normality import normalize
+
+from ftmstore_fastapi.concurrency import get_background_executor
+from ftmstore_fastapi.logging import get_logger
+from ftmstore_fastapi.metrics import metrics
+from ftmstore_fastapi.query import Query, get_caption_props
+from ftmstore_fastapi.store import (
+    get_catalog,
+    get_source_store,
+    get_store,
+    get_store_fingerprint,
+)
+
+log = get_logger(__name__)
+
+_lock = Lock()
+_index: "SuggestIndex | None" = None
+_rebuild: Future | None = None
+
+
+class Suggestion(NamedTuple):
+    id: str
+    schema: str
+    caption: str
+
+
+def normalize_caption(caption: str) -> str:
+    # transliterated via pyicu if installed
+    return normalize(caption, lowercase=True, ascii=True) or ""
+
+
+def get_keys(caption: str) -> tuple[str, list[str]]:
+    """
+    The normalized caption, and the caption starting at each of its further
+    words, so that e.g. `hope fou` matches "Somali Hope Foundation"
+    """
+    tokens = normalize_caption(caption).split()
+    return " ".join(tokens), [" ".join(tokens[ix:]) for ix in range(1, len(tokens))]
+
+
+class PrefixArray:
+    """
+    Sorted keys referring to suggestions, looked up via binary search
+    """
+
+    def __init__(self, keys: list[tuple[str, int]]) -> None:
+        keys.sort()
+        self.keys = [k for k, _ in keys]
+        self.refs = [ix for _, ix in keys]
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def lookup(self, prefix: str) -> Generator[tuple[str, int], None, None]:
+        for ix in range(bisect_left(self.keys, prefix), len(self.keys)):
+            if not self.keys[ix].startswith(prefix):
+                return
+            yield self.keys[ix], self.refs[ix]
+
+
+def lookup(
+    arrays: dict[str, PrefixArray], prefix: str, schema: Schema | None = None
+) -> Generator[int, None, None]:
+    """
+    Merge the sorted lookups of the arrays of the (matching) schemata, so that
+    a schema filter doesn't walk past the keys of other entities
+    """
+    lookups = [
+        array.lookup(prefix)
+        for name, array in arrays.items()
+        if schema is None or model[name].is_a(schema)
+    ]
+    for _, ref in merge(*lookups):
+        yield ref
+
+
+class SuggestIndex:
+    def __init__(self, version: str, suggestions: list[Suggestion]) -> None:
+        self.version = version
+        self.suggestions = suggestions
+        captions: dict[str, list[tuple[str, int]]] = defaultdict(list)
+        words: dict[str, list[tuple[str, int]]] = defaultdict(list)
+        for ix, suggestion in enumerate(suggestions):
+            caption, rest = get_keys(suggestion.caption)
+            captions[suggestion.schema].append((caption, ix))
+            words[suggestion.schema].extend((key, ix) for key in rest)
+        self.captions = {s: PrefixArray(keys) for s, keys in captions.items()}
+        self.words = {s: PrefixArray(keys) for s, keys in words.items()}
+
+    def __len__(self) -> int:
+        return len(self.suggestions)
+
+    @property
+    def keys(self) -> int:
+        return sum(len(a) for a in chain(self.captions.values(), self.words.values()))
+
+    def suggest(
+        self, prefix: str, schema: Schema | None = None, limit: int = 10
+    ) -> list[Suggestion]:
+        """
+        Entities whose caption starts with the prefix, followed by the ones
+        where a word within the caption does
+        """
+        prefix = normalize_caption(prefix)
+        if not prefix:
+            return []
+        res: list[Suggestion] = []
+        seen: set[int] = set()
+        for ref in chain(
+            lookup(self.captions, prefix, schema), lookup(self.words, prefix, schema)
+        ):
+            if len(res) == limit:
+                break
+            if ref in seen:
+                continue
+            seen.add(ref)
+            res.append(self.suggestions[ref])
+        return res
+
+
+def build_index(version: str, store: Store | None = None) -> SuggestIndex:
+    store = store or get_store()
+    query = Query().project(sorted(get_caption_props()))
+    datasets = sorted(get_catalog().names)
+    if datasets:
+        query = query.where(dataset__in=datasets)
+    with metrics.timer("suggest_index"):
+        suggestions = [
+            Suggestion(p.id, p.schema.name, p.caption)
+            for p in store.query().entities(query)
+        ]
+        index = SuggestIndex(version, suggestions)
+    log.info("Built suggest index", entities=len(index), keys=index.keys)
+    return index
+
+
+def load_index() -> SuggestIndex:
+    """
+    Build the index from a throwaway store connection, e.g. in the gunicorn
+    master process so that the forked workers share it
+    """
+    global _index
+    version = get_store_fingerprint()
+    with _lock:
+        if _index is None or _index.version != version:
+            with get_source_store() as store:
+                _index = build_index(version, store)
+    return _index
+
+
+def rebuild_index(version: str) -> None:
+    global _index
+    index = build_index(version)
+    with _lock:
+        _index = index
+
+
+def get_suggest_index() -> SuggestIndex:
+    """
+    The suggest index for the current store version (built on first access).
+    After a store change, the outdated index is returned until the rebuild in
+    the background is done.
+    """
+    global _index, _rebuild
+    version = get_store_fingerprint()
+    if _index is None:
+        with _lock:
+            if _index is None:
+                _index = build_index(version)
+    elif _index.version != version:
+        with _lock:
+            if _rebuild is None or _rebuild.done():
+                executor = get_background_executor()
+                _rebuild = executor.submit(rebuild_index, version)
+    return _index
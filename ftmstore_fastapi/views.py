@@ -1,30 +1,72 @@
-from collections.abc import Iterable
+import json
+import zlib
+from collections.abc import Callable, Generator, Iterable
+from typing import Literal
 
-from anystore import anycache
+from fastapi import HTTPException
 from fastapi import Query as QueryField
 from fastapi import Request
 from fastapi.responses import RedirectResponse
-from ftmq.model import Dataset
+from followthemoney import model
+from ftmq.enums import PropertyTypesMap
+from ftmq.model import DatasetStats
 from ftmq.types import CE
-from furl import furl
 
-from ftmstore_fastapi.cache import get_cache_key
+from ftmstore_fastapi import settings
+from ftmstore_fastapi.cache import (
+    cached,
+    get_cache_key,
+    get_count_cache_key,
+    get_stats_cache_key,
+)
+from ftmstore_fastapi.facets import get_facet_counts
+from ftmstore_fastapi.metrics import metrics
 from ftmstore_fastapi.query import (
     AggregationParams,
     Query,
     RetrieveParams,
+    StatsParams,
     ViewQueryParams,
 )
 from ftmstore_fastapi.serialize import (
     AggregationResponse,
+    CachedResponse,
     CatalogResponse,
     DatasetResponse,
+    EntitiesBatchResponse,
     EntitiesResponse,
     EntityResponse,
+    FacetsResponse,
+    SuggestResponse,
+    get_properties,
+    get_url,
+)
+from ftmstore_fastapi.stats import get_dataset_stats
+from ftmstore_fastapi.store import (
+    View,
+    get_catalog,
+    get_dataset,
+    get_store_fingerprint,
+    get_view,
 )
-from ftmstore_fastapi.store import get_catalog, get_dataset, get_view
+from ftmstore_fastapi.suggest import get_suggest_index
 from ftmstore_fastapi.util import get_dehydrated_proxy
 
+STREAM_CHUNK_SIZE = 64 * 1024
+
+
+def cached_response(func: Callable) -> Callable:
+    """
+    Cache the final (compressed) response of a view, the decorated view
+    returns a `CachedResponse`. Partial responses are not cached.
+    """
+    return cached(
+        key_func=get_cache_key,
+        serialization_mode="pickle",
+        serialize_func=CachedResponse.from_result,
+        cache_if=lambda res: res.cacheable,
+    )(func)
+
 
 def get_retrieve_params(
     nested: bool = QueryField(
@@ -37,67 +79,154 @@ def get_retrieve_params(
         False, description="Only include id, schema and caption"
     ),
     dehydrate_nested: bool = QueryField(True, description="Dehydrate nested entities"),
+    nested_limit: int = QueryField(
+        settings.NESTED_LIMIT,
+        ge=1,
+        description="Max inlined adjacent entities per property, the number of "
+        "omitted values is returned in `truncated`",
+    ),
+    props: str | None = QueryField(
+        None,
+        description="Only include these properties (comma separated), e.g. "
+        "`name,country`",
+    ),
 ) -> RetrieveParams:
+    fields: list[str] | None = None
+    if props is not None:
+        fields = sorted({p.strip() for p in props.split(",") if p.strip()})
+        invalid = [p for p in fields if p not in PropertyTypesMap.__members__]
+        if invalid:
+            raise HTTPException(
+                422, detail=[f"Invalid properties: `{', '.join(invalid)}`"]
+            )
     return RetrieveParams(
         nested=nested,
         featured=featured,
         dehydrate=dehydrate,
         dehydrate_nested=dehydrate_nested,
+        nested_limit=nested_limit,
+        props=fields or None,
     )
 
 
+def get_stats_params(
+    stats: bool = QueryField(
+        True, description="Include stats (schemata, countries, coverage)"
+    ),
+    total: Literal["exact", "estimate"] = QueryField(
+        "exact",
+        description="`estimate`: Skip counting (and stats), `total` is then only "
+        "a lower bound derived from the current page",
+    ),
+) -> StatsParams:
+    return StatsParams(stats=stats, total=total)
+
+
 def get_aggregation_params(
     aggSum: list[str] = QueryField([], description="Fields to aggregate for SUM"),
     aggMax: list[str] = QueryField([], description="Fields to aggregate for MAX"),
     aggMin: list[str] = QueryField([], description="Fields to aggregate for MIN"),
     aggAvg: list[str] = QueryField([], description="Fields to aggregate for AVG"),
+    aggCount: list[str] = QueryField(
+        [], description="Fields to aggregate for COUNT (distinct values)"
+    ),
+    aggGroups: list[str] = QueryField(
+        [],
+        description="Fields to group the aggregations by (e.g. `country`, "
+        "`schema`, `year`), at most `AGGREGATION_GROUPS_LIMIT` biggest groups",
+    ),
 ) -> AggregationParams:
-    return AggregationParams(aggSum=aggSum, aggMin=aggMin, aggMax=aggMax, aggAvg=aggAvg)
+    return AggregationParams(
+        aggSum=aggSum,
+        aggMin=aggMin,
+        aggMax=aggMax,
+        aggAvg=aggAvg,
+        aggCount=aggCount,
+        aggGroups=aggGroups,
+    )
+
+
+@cached(key_func=get_stats_cache_key, model=DatasetStats)
+def get_stats(view: View, query: Query) -> DatasetStats:
+    with metrics.timer("stats"):
+        return view.stats(query)
 
 
-@anycache(key_func=get_cache_key, serialization_mode="pickle")
+@cached(key_func=get_count_cache_key)
+def get_count(view: View, query: Query) -> int:
+    with metrics.timer("count"):
+        return view.count(query)
+
+
+def get_totals(
+    view: View, query: Query, params: StatsParams, items: int
+) -> tuple[DatasetStats | None, int]:
+    """
+    Get stats and total count for a query, shared across all its pages
+    """
+    if params.total == "estimate":
+        total = (query.offset or 0) + items
+        if query.limit and items == query.limit:
+            total += 1  # there might be more
+        return None, total
+    if params.stats:
+        stats = get_stats(view, query.stats_query)
+        return stats, stats.entity_count
+    return None, get_count(view, query.stats_query)
+
+
+@cached_response
 def dataset_list(request: Request) -> CatalogResponse:
     catalog = get_catalog()
-    datasets: list[Dataset] = []
-    for dataset in catalog.datasets:
-        view = get_view(dataset.name)
-        dataset.apply_stats(view.stats())
-        datasets.append(dataset)
-    catalog.datasets = datasets
-    return CatalogResponse.from_catalog(request, catalog)
+    stats = get_dataset_stats() if settings.DATASETS_STATS else None
+    return CatalogResponse.from_catalog(request, catalog, stats)
 
 
-@anycache(key_func=get_cache_key, serialization_mode="pickle")
+@cached_response
 def dataset_detail(request: Request, name: str) -> DatasetResponse:
-    view = get_view(name)
     dataset = get_dataset(name)
-    dataset.apply_stats(view.stats())
-    return DatasetResponse.from_dataset(request, dataset)
+    stats = get_dataset_stats(name) if settings.DATASETS_STATS else None
+    return DatasetResponse.from_dataset(request, dataset, stats)
 
 
-@anycache(key_func=get_cache_key, serialization_mode="pickle")
+@cached_response
 def entity_list(
     request: Request,
     retrieve_params: RetrieveParams,
     authenticated: bool | None = False,
-) -> EntitiesResponse:
+    stats_params: StatsParams | None = None,
+) -> bytes:
     view = get_view()
     params = ViewQueryParams.from_request(request, authenticated)
-    query = Query.from_params(params)
-    adjacents = []
-    entities = [e for e in view.get_entities(query, retrieve_params)]
-    if retrieve_params.nested:
-        adjacents = view.get_adjacents(entities)
-    return EntitiesResponse.from_view(
+    query = Query.from_params(params).project(retrieve_params.props)
+    adjacents = None
+    with metrics.timer("entities"):
+        sort_values = None
+        if query.is_ranked:  # already retrieved
+            proxies = view.get_ranked_entities(query, retrieve_params)
+            entities = proxies
+        else:
+            proxies = [e for e in view.query.entities(query)]
+            sort_values = view.get_sort_values(query, proxies)
+            entities = [view.retrieve(e, retrieve_params) for e in proxies]
+        if retrieve_params.nested:
+            adjacents = view.get_adjacents(entities, retrieve_params.nested_limit)
+    stats, total = get_totals(view, query, stats_params or StatsParams(), len(proxies))
+    return EntitiesResponse.dump_view(
         request=request,
         entities=entities,
         adjacents=adjacents,
-        stats=view.stats(query),
+        nested_limit=retrieve_params.nested_limit,
+        stats=stats,
+        total=total,
         authenticated=authenticated,
+        next_cursor=query.get_next_cursor(proxies, sort_values),
+        prev_cursor=query.get_prev_cursor(proxies, sort_values),
+        props=retrieve_params.props,
     )
 
 
-@anycache(key_func=get_cache_key, serialization_mode="pickle")
+@cached_response
 def entity_detail(
     request: Request,
     entity_id: str,
@@ -105,28 +234,125 @@ def entity_detail(
 ) -> EntityResponse | RedirectResponse:
     view = get_view()
     entity = view.get_entity(entity_id, retrieve_params)
-    adjacents: Iterable[CE] = []
+    adjacents: Iterable[CE] | None = None
     if retrieve_params.nested:
-        adjacents = [e[1] for e in view.view.get_adjacent(entity)]
+        adjacents = view.get_adjacents([entity], retrieve_params.nested_limit)
         if retrieve_params.dehydrate_nested:
             adjacents = [get_dehydrated_proxy(e) for e in adjacents]
     if entity.id != entity_id:  # we have a redirect to a merged entity
-        url = furl(request.url)
+        url = get_url(request)
         url.path.segments[-1] = entity.id
         response = RedirectResponse(url)
         response.headers["X-Entity-ID"] = entity.id
         response.headers["X-Entity-Schema"] = entity.schema.name
         return response
-    return EntityResponse.from_entity(entity, adjacents)
+    return EntityResponse.from_entity(
+        entity,
+        adjacents,
+        nested_limit=retrieve_params.nested_limit,
+        props=retrieve_params.props,
+    )
 
 
-@anycache(key_func=get_cache_key, model=AggregationResponse)
-def aggregation(request: Request) -> AggregationResponse:
+@cached_response
+def entity_batch(
+    request: Request,
+    entity_ids: tuple[str, ...],
+    retrieve_params: RetrieveParams,
+) -> EntitiesBatchResponse:
     view = get_view()
+    with metrics.timer("entities_batch"):
+        canonicals = view.get_canonicals(entity_ids)
+        entities = view.get_entities_by_id(set(canonicals.values()), retrieve_params)
+        adjacents: Iterable[CE] | None = None
+        if retrieve_params.nested:
+            adjacents = view.get_adjacents(
+                entities.values(), retrieve_params.nested_limit
+            )
+            if retrieve_params.dehydrate_nested:
+                adjacents = [get_dehydrated_proxy(e) for e in adjacents]
+    return EntitiesBatchResponse.from_view(
+        entity_ids,
+        canonicals,
+        entities,
+        adjacents,
+        nested_limit=retrieve_params.nested_limit,
+        props=retrieve_params.props,
+    )
+
+
+@cached_response
+def facets(
+    request: Request, facets: tuple[str, ...], limit: int | None = None
+) -> FacetsResponse:
     params = ViewQueryParams.from_request(request)
     query = Query.from_params(params)
+    counts = get_facet_counts(query, list(facets), limit)
+    return FacetsResponse.from_counts(request, counts)
+
+
+@cached_response
+def suggest(
+    request: Request, prefix: str, schema: str | None = None, limit: int = 10
+) -> SuggestResponse:
+    index = get_suggest_index()
+    with metrics.timer("suggest"):
+        suggestions = index.suggest(
+            prefix, model.get(schema) if schema else None, limit
+        )
+    # served from the outdated index while the current one is built
+    pending = index.version != get_store_fingerprint()
+    return SuggestResponse.from_suggestions(prefix, suggestions, pending)
+
+
+@cached_response
+def aggregation(
+    request: Request, stats_params: StatsParams | None = None
+) -> AggregationResponse:
+    view = get_view()
+    params = ViewQueryParams.from_request(request)
+    query = Query.from_params(params)
+    with metrics.timer("aggregations"):
+        aggregations = view.aggregations(query)
+    stats, total = get_totals(view, query, stats_params or StatsParams(), 0)
     return AggregationResponse.from_view(
         request=request,
-        aggregations=view.aggregations(query),
-        stats=view.stats(query),
+        aggregations=aggregations,
+        stats=stats,
+        total=total,
     )
+
+
+def entity_stream(
+    request: Request,
+    retrieve_params: RetrieveParams,
+    authenticated: bool | None = False,
+    compress: bool | None = False,
+) -> Generator[bytes, None, None]:
+    """
+    Stream all entities for the query (ignoring pagination) as ftm json lines
+    in chunks of roughly `STREAM_CHUNK_SIZE`, optionally gzip compressed
+    """
+    view = get_view()
+    params = ViewQueryParams.from_request(request, authenticated)
+    query = Query.from_params(params)._chain(slice=None, cursor=None)
+    query = query.project(retrieve_params.props)
+    compressor = zlib.compressobj(wbits=31) if compress else None
+    lines: list[bytes] = []
+    size = 0
+    for proxy in view.get_entities(query, retrieve_params):
+        data = proxy.to_dict()
+        if retrieve_params.props:
+            data["properties"] = get_properties(proxy, retrieve_params.props)
+        line = json.dumps(data, ensure_ascii=False, default=str)
+        lines.append(line.encode() + b"\n")
+        size += len(lines[-1])
+        if size >= STREAM_CHUNK_SIZE:
+            chunk = b"".join(lines)
+            yield compressor.compress(chunk) if compressor else chunk
+            lines, size = [], 0
+    chunk = b"".join(lines)
+    if compressor is not None:
+        yield compressor.compress(chunk) + compressor.flush()
+    elif chunk:
+        yield chunk
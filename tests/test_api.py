@@ -1,6 +1,13 @@
+import asyncio
+import json
+
 from fastapi.testclient import TestClient
+from ftmq.util import make_proxy
+from httpx import ASGITransport, AsyncClient
 
+from ftmstore_fastapi import settings, store
 from ftmstore_fastapi.api import app
+from ftmstore_fastapi.serialize import EntityResponse
 
 client = TestClient(app)
 
@@ -128,6 +135,33 @@ def test_api_reversed():
     assert tested
 
 
+def test_api_nested(monkeypatch):
+    res = client.get("/entities?dataset=gdho&limit=2&nested=true")
+    assert res.status_code == 200
+    assert len(res.json()["entities"]) == 2
+
+    # the fixtures have no entity references, so reference some of them
+    ids = ["eu-authorities-a29wp", "gdho-100", "gdho-1109"]
+    membership = make_proxy(
+        {
+            "id": "m",
+            "schema": "Membership",
+            "properties": {"member": ids[1:], "organization": ids[:1]},
+        }
+    )
+    view = store.get_view()
+    monkeypatch.setattr(store, "ADJACENTS_BATCH_SIZE", 2)  # batched lookups
+    adjacents = view.get_adjacents([membership])
+    assert sorted(e.id for e in adjacents) == ids
+    member = membership.get("member")[0]
+    adjacents = view.get_adjacents([membership], limit=1)
+    assert sorted(e.id for e in adjacents) == sorted([ids[0], member])
+    response = EntityResponse.from_entity(membership, adjacents, nested_limit=1)
+    data = response.model_dump(mode="json")
+    assert [e["id"] for e in data["properties"]["member"]] == [member]
+    assert data["truncated"] == {"member": 1}
+
+
 def test_api_aggregation():
     res = client.get(
         "/aggregate?dataset=ec_meetings&schema=Event&aggMin=date&aggMax=date"
@@ -175,6 +209,7 @@ def test_api_aggregation():
             "page": 1,
             "dataset": ["ec_meetings"],
             "schema": "Event",
+            "cursor": None,
             "order_by": None,
             "reverse": None,
             "aggMax": ["date"],
@@ -223,6 +258,35 @@ def test_api_aggregation():
     }
 
 
+def test_api_aggregation_groups(monkeypatch):
+    res = client.get(
+        "/aggregate?aggGroups=schema&aggGroups=dataset&aggCount=id&aggMin=name"
+    )
+    assert res.status_code == 200
+    data = res.json()["aggregations"]
+    assert data["id"] == {"count": 4784}
+    assert data["schema"]["groups"]["count"]["id"] == {
+        "Organization": 4633,
+        "PublicBody": 151,
+    }
+    assert data["dataset"]["groups"]["count"]["id"] == {
+        "gdho": 4633,
+        "eu_authorities": 151,
+    }
+    assert data["dataset"]["groups"]["min"]["name"]["eu_authorities"] == (
+        "Agencia Ejecutiva de Innovación y Redes"
+    )
+
+    # only the biggest groups, biggest first (years in chronological order)
+    monkeypatch.setattr(settings, "AGGREGATION_GROUPS_LIMIT", 3)
+    res = client.get("/aggregate?dataset=gdho&aggGroups=country&aggCount=id")
+    groups = res.json()["aggregations"]["country"]["groups"]["count"]["id"]
+    assert list(groups.items()) == [("us", 314), ("so", 262), ("af", 239)]
+    res = client.get("/aggregate?dataset=gdho&aggGroups=year&aggCount=id")
+    groups = res.json()["aggregations"]["year"]["groups"]["count"]["id"]
+    assert list(groups.items()) == [("1991", 58), ("1998", 57), ("2003", 56)]
+
+
 def test_api_search():
     res = client.get("/entities?dataset=eu_authorities&q=agency")
     data = res.json()
@@ -272,3 +336,218 @@ def test_api_entities_id_filter():
     res = client.get("/entities?canonical_id__startswith=eu-authorities-&dataset=gdho")
     data = res.json()
     assert data["total"] == data["items"] == 0
+
+
+def test_api_concurrency():
+    # store work runs in the thread pool, concurrent requests on the same event
+    # loop don't block each other
+    async def _run():
+        transport = ASGITransport(app=app)
+        async with AsyncClient(transport=transport, base_url="http://testserver") as c:
+            return await asyncio.gather(
+                c.get("/aggregate?dataset=eu_authorities&aggCount=id"),
+                *(c.get("/entities/eu-authorities-chafea") for _ in range(10)),
+            )
+
+    responses = asyncio.run(_run())
+    assert all(r.status_code == 200 for r in responses)
+    assert responses[0].json()["aggregations"] == {"id": {"count": 151}}
+    assert all(r.json()["id"] == "eu-authorities-chafea" for r in responses[1:])
+
+
+def test_api_entities_cursor():
+    def _walk(url):
+        ids = []
+        while url:
+            data = client.get(url).json()
+            ids.extend(e["id"] for e in data["entities"])
+            url = data["next_url"]
+        return ids
+
+    for order in ("", "&order_by=name", "&order_by=-name"):
+        url = f"/entities?dataset=eu_authorities&limit=40{order}"
+        paged = []
+        for page in range(1, 5):
+            data = client.get(f"{url}&page={page}").json()
+            paged.extend(e["id"] for e in data["entities"])
+        ids = _walk(url)
+        assert len(ids) == len(set(ids)) == 151
+        assert ids == paged
+
+    res = client.get("/entities?dataset=eu_authorities&limit=40&order_by=-name")
+    data = res.json()
+    assert data["next_cursor"]
+    assert "page=" not in data["next_url"]
+    first_page = [e["id"] for e in data["entities"]]
+    data = client.get(data["next_url"]).json()
+    assert data["total"] == 151
+    assert data["items"] == 40
+    assert data["prev_url"]
+    data = client.get(data["prev_url"]).json()
+    assert [e["id"] for e in data["entities"]] == first_page
+
+    res = client.get("/entities?cursor=foo")
+    assert res.status_code == 422
+
+
+def test_api_entities_stream():
+    res = client.get("/entities/stream?dataset=eu_authorities")
+    assert res.status_code == 200
+    assert res.headers["content-type"] == "application/x-ndjson"
+    assert res.headers["content-encoding"] == "gzip"
+    lines = [json.loads(line) for line in res.text.splitlines()]
+    assert len(lines) == 151
+    assert len({e["id"] for e in lines}) == 151
+    assert all(e["datasets"] == ["eu_authorities"] for e in lines)
+
+    res = client.get(
+        "/entities/stream?dataset=eu_authorities&jurisdiction=eu&dehydrate=1",
+        headers={"Accept-Encoding": "identity"},
+    )
+    assert "content-encoding" not in res.headers
+    lines = [json.loads(line) for line in res.text.splitlines()]
+    assert len(lines) == 151
+    assert "jurisdiction" not in lines[0]["properties"]
+
+    # the cursor is pagination, too
+    res = client.get("/entities?dataset=eu_authorities&limit=10")
+    cursor = res.json()["next_cursor"]
+    res = client.get(f"/entities/stream?dataset=eu_authorities&cursor={cursor}")
+    assert len(res.text.splitlines()) == 151
+
+
+def test_api_entities_stats():
+    res = client.get("/entities?dataset=eu_authorities&limit=10")
+    data = res.json()
+    assert data["total"] == 151
+    assert data["stats"]["entity_count"] == 151
+
+    res = client.get("/entities?dataset=eu_authorities&limit=10&page=3&stats=false")
+    data = res.json()
+    assert data["total"] == 151
+    assert data["stats"] is None
+    assert data["next_url"]
+
+    res = client.get("/entities?dataset=eu_authorities&limit=100&total=estimate")
+    data = res.json()
+    assert data["total"] == 101
+    assert data["stats"] is None
+    data = client.get(data["next_url"]).json()
+    assert data["items"] == 51
+    assert data["next_url"] is None
+
+    res = client.get("/aggregate?dataset=eu_authorities&aggCount=id&stats=false")
+    data = res.json()
+    assert data["total"] == 151
+    assert data["stats"] is None
+
+    data = client.get("/metrics").json()
+    assert data["timers"]["entities"]["count"]
+    assert data["timers"]["stats"]["count"]
+    assert data["timers"]["count"]["count"]
+
+
+def test_api_conditional(monkeypatch):
+    res = client.get("/catalog/gdho")
+    assert res.status_code == 200
+    etag = res.headers["etag"]
+    assert etag.startswith('W/"')
+    assert res.headers["cache-control"] == settings.CACHE_CONTROL
+    assert "last-modified" in res.headers
+
+    res = client.get("/catalog/gdho", headers={"If-None-Match": etag})
+    assert res.status_code == 304
+    assert res.content == b""
+    assert res.headers["etag"] == etag
+    res = client.get("/catalog/gdho", headers={"If-None-Match": f'"foo", {etag}'})
+    assert res.status_code == 304
+    res = client.get("/catalog/gdho", headers={"If-None-Match": '"foo"'})
+    assert res.status_code == 200
+    res = client.get(
+        "/catalog/gdho",
+        headers={"If-Modified-Since": "Fri, 01 Jan 2100 00:00:00 GMT"},
+    )
+    assert res.status_code == 304
+    res = client.get(
+        "/catalog/gdho",
+        headers={"If-Modified-Since": "Thu, 01 Jan 1970 00:00:00 GMT"},
+    )
+    assert res.status_code == 200
+
+    # normalized query
+    res = client.get("/entities?dataset=gdho&schema=Organization&limit=1")
+    etag = res.headers["etag"]
+    res = client.get(
+        "/entities?schema=Organization&limit=1&dataset=gdho",
+        headers={"If-None-Match": etag},
+    )
+    assert res.status_code == 304
+    res = client.get("/entities?dataset=gdho&schema=Organization&limit=2")
+    assert res.headers["etag"] != etag
+
+    res = client.get("/entities/stream?dataset=gdho", headers={"If-None-Match": "*"})
+    assert res.status_code == 304
+
+    monkeypatch.setitem(settings.CACHE_CONTROL_VIEWS, "dataset_list", "no-cache")
+    res = client.get("/catalog")
+    assert res.headers["cache-control"] == "no-cache"
+
+
+def test_api_batch():
+    ids = ["gdho-100", "eu-authorities-a29wp", "not-existing", "gdho-100"]
+    res = client.post("/entities/batch", json={"ids": ids})
+    assert res.status_code == 200
+    data = res.json()
+    assert data["items"] == 2
+    assert [e["id"] for e in data["entities"]] == ids[:2]
+    assert data["missing"] == ["not-existing"]
+    assert data["redirects"] == {}
+    # no conditional requests for POST
+    headers = {"if-none-match": res.headers["etag"]}
+    res = client.post("/entities/batch", json={"ids": ids}, headers=headers)
+    assert res.status_code == 200
+    res = client.post(
+        "/entities/batch", json={"ids": ids}, headers={"if-none-match": "*"}
+    )
+    assert res.status_code == 200
+
+    res = client.post("/entities/batch?nested=true", json={"ids": ids[:1]})
+    assert res.json()["entities"][0]["id"] == "gdho-100"
+
+    res = client.post("/entities/batch", json={"ids": []})
+    assert res.status_code == 422
+    ids = [f"id-{i}" for i in range(settings.DEFAULT_LIMIT + 1)]
+    res = client.post("/entities/batch", json={"ids": ids})
+    assert res.status_code == 422
+    res = client.post(
+        f"/entities/batch?api_key={settings.BUILD_API_KEY}", json={"ids": ids}
+    )
+    assert res.status_code == 200
+    assert len(res.json()["missing"]) == len(ids)
+
+
+def test_api_props():
+    res = client.get("/entities?dataset=gdho&props=country&limit=5&order_by=name")
+    assert res.status_code == 200
+    data = res.json()
+    assert data["items"] == 5
+    for entity in data["entities"]:
+        assert set(entity["properties"]) <= {"country"}
+        assert entity["caption"] != "Organization"  # caption from name
+    full = client.get("/entities?dataset=gdho&limit=5&order_by=name").json()
+    assert [e["caption"] for e in full["entities"]] == [
+        e["caption"] for e in data["entities"]
+    ]
+    # cursor pagination with projection
+    res = client.get(data["next_url"])
+    assert res.json()["entities"][0]["id"] != data["entities"][-1]["id"]
+
+    res = client.get("/entities/gdho-100?props=name,legalForm")
+    assert set(res.json()["properties"]) == {"name", "legalForm"}
+    res = client.get("/entities/stream?dataset=eu_authorities&props=name")
+    lines = [json.loads(line) for line in res.text.splitlines()]
+    assert len(lines) == 151
+    assert all(set(e["properties"]) == {"name"} for e in lines)
+
+    res = client.get("/entities?props=name,not_a_prop")
+    assert res.status_code == 422
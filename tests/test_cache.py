@@ -0,0 +1,261 @@
+import gzip
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from fastapi import Request
+from fastapi.testclient import TestClient
+
+from ftmstore_fastapi import cache, settings
+from ftmstore_fastapi.api import app
+from ftmstore_fastapi.cache import (
+    cached,
+    cluster_lock,
+    get_cache_key,
+    get_stats_cache_key,
+    invalidate,
+)
+from ftmstore_fastapi.concurrency import SingleFlight
+from ftmstore_fastapi.lru import LRUCache
+from ftmstore_fastapi.metrics import metrics
+from ftmstore_fastapi.query import Query, RetrieveParams
+from ftmstore_fastapi.store import get_view
+from ftmstore_fastapi.views import dataset_detail, entity_list
+
+
+def _request(path: str, query: str = "", host: str = "localhost") -> Request:
+    return Request(
+        {
+            "type": "http",
+            "method": "GET",
+            "scheme": "http",
+            "path": path,
+            "query_string": query.encode(),
+            "headers": [(b"host", host.encode())],
+        }
+    )
+
+
+def test_cache_key(monkeypatch):
+    monkeypatch.setattr(settings, "CACHE", False)
+    assert get_cache_key(_request("/entities")) is None
+
+    monkeypatch.setattr(settings, "CACHE", True)
+    key = get_cache_key(_request("/entities", "schema=Person&country=de"))
+    assert key.startswith("ftmstore_fastapi:")
+    # parameter order, api keys and defaults don't matter
+    assert key == get_cache_key(_request("/entities", "country=de&schema=Person"))
+    assert key == get_cache_key(
+        _request("/entities", "country=de&api_key=secret&schema=Person")
+    )
+    # responses contain urls of the requested host
+    assert key != get_cache_key(
+        _request("/entities", "country=de&schema=Person", "example.org")
+    )
+    assert key == get_cache_key(
+        _request(
+            "/entities",
+            f"country=de&schema=Person&page=1&limit={settings.DEFAULT_LIMIT}",
+        )
+    )
+    assert key == get_cache_key(
+        _request("/entities", "country=de&schema=Person&limit=100000")
+    )
+    assert key != get_cache_key(
+        _request("/entities", "country=de&schema=Person&limit=100000"),
+        authenticated=True,
+    )
+    assert key != get_cache_key(_request("/entities", "country=fr&schema=Person"))
+    assert key != get_cache_key(_request("/aggregate", "schema=Person&country=de"))
+    assert get_cache_key(
+        _request("/entities", "dataset=gdho&dataset=eu_authorities")
+    ) == get_cache_key(_request("/entities", "dataset=eu_authorities&dataset=gdho"))
+
+    # retrieve params are passed as view arguments
+    params = RetrieveParams(
+        nested=False, featured=False, dehydrate=False, dehydrate_nested=True
+    )
+    request = _request("/entities/x", "nested=1")
+    assert get_cache_key(request, "x", params) == get_cache_key(
+        _request("/entities/x", "nested=true"), "x", params
+    )
+    assert get_cache_key(request, "x", params) != get_cache_key(
+        request, "x", params.model_copy(update={"nested": True})
+    )
+
+    # store rebuilt
+    query = Query().where(dataset="gdho")
+    stats_key = get_stats_cache_key(get_view("gdho"), query)
+    monkeypatch.setattr(cache, "get_store_fingerprint", lambda: "rebuilt")
+    assert key != get_cache_key(_request("/entities", "schema=Person&country=de"))
+    assert stats_key != get_stats_cache_key(get_view("gdho"), query)
+
+
+def test_cache_hits(monkeypatch):
+    monkeypatch.setattr(settings, "CACHE", True)
+    metrics.reset()
+    dataset_detail(_request("/catalog/gdho"), "gdho")
+    dataset_detail(_request("/catalog/gdho", "api_key=foo"), "gdho")
+    data = metrics.to_dict()
+    assert data["counters"]["cache.dataset_detail.hit"] >= 1
+    assert 0 < data["hit_rates"]["cache.dataset_detail"] <= 1
+
+
+def test_cache_lru():
+    lru = LRUCache(maxsize=2, maxbytes=10)
+    lru.put("a", 1, size=4)
+    lru.put("b", 2, size=4)
+    assert lru.get("a") == 1
+    lru.put("c", 3, size=4)  # evicts least recently used `b`
+    assert "b" not in lru
+    assert lru.nbytes == 8
+    lru.put("d", 4, size=11)  # too large
+    assert "d" not in lru
+    assert len(lru) == 2
+
+    lru = LRUCache(ttl=0.01)
+    lru.put("a", 1)
+    assert lru.get("a") == 1
+    time.sleep(0.02)
+    assert "a" not in lru
+
+    lru = LRUCache()
+    lru.put("a", 1, tags=["gdho"])
+    lru.put("b", 2, tags=["gdho", "eu_authorities"])
+    lru.put("c", 3, tags=["eu_authorities"])
+    assert lru.invalidate("gdho") == 2
+    assert "c" in lru
+
+
+def test_cache_tiers(monkeypatch):
+    monkeypatch.setattr(settings, "CACHE", True)
+    invalidate()
+    metrics.reset()
+    request = _request("/catalog/gdho")
+    key = get_cache_key(request, "gdho")
+    res = dataset_detail(request, "gdho")
+    assert key in cache.memory
+    assert dataset_detail(request, "gdho") is res
+    assert metrics.counters["cache.memory.hit"] == 1
+
+    # served from redis after local miss
+    cache.memory.clear()
+    res = dataset_detail(request, "gdho")
+    assert json.loads(gzip.decompress(res.content))["name"] == "gdho"
+    assert metrics.counters["cache.dataset_detail.hit"] == 2
+    assert metrics.counters["cache.dataset_detail.miss"] == 1
+
+    request = _request("/entities", "dataset=eu_authorities&limit=1")
+    params = RetrieveParams(
+        nested=False, featured=False, dehydrate=False, dehydrate_nested=True
+    )
+    entity_list(request, params)
+    eu_key = get_cache_key(request, params)
+    assert eu_key in cache.memory
+    assert invalidate("gdho") == 2  # both tiers, eu_authorities stats remain
+    assert key not in cache.memory
+    assert eu_key in cache.memory
+    dataset_detail(_request("/catalog/gdho"), "gdho")
+    assert metrics.counters["cache.dataset_detail.miss"] == 2
+
+
+def test_cache_invalidate_on_store_change(monkeypatch):
+    monkeypatch.setattr(settings, "CACHE", True)
+    request = _request("/catalog/gdho")
+    res = dataset_detail(request, "gdho")
+    key = get_cache_key(request, "gdho")
+    assert key in cache.memory
+    assert dataset_detail(request, "gdho") is res
+
+    # store rebuilt: the entries of the previous version are removed
+    monkeypatch.setattr(cache, "get_store_fingerprint", lambda: "rebuilt")
+    new_key = get_cache_key(request, "gdho")
+    assert new_key != key
+    assert key not in cache.memory
+    assert dataset_detail(request, "gdho") is not res
+    assert new_key in cache.memory
+    # only once
+    assert get_cache_key(request, "gdho") == new_key
+    assert new_key in cache.memory
+
+
+def test_cache_single_flight(monkeypatch):
+    monkeypatch.setattr(settings, "CACHE", True)
+    invalidate()
+    calls = []
+
+    @cached(key_func=lambda x: f"{cache.PREFIX}:*:test:{x}")
+    def slow(x):
+        calls.append(x)
+        time.sleep(0.2)
+        return x * 2
+
+    with ThreadPoolExecutor(5) as executor:
+        results = list(executor.map(slow, [1] * 5))
+    assert results == [2] * 5
+    assert calls == [1]
+
+    flight = SingleFlight()
+    with ThreadPoolExecutor(5) as executor:
+        futures = [executor.submit(flight.run, "a", slow, 2) for _ in range(5)]
+    assert [f.result() for f in futures] == [4] * 5
+    assert calls == [1, 2]
+
+
+def test_cache_stale_while_revalidate(monkeypatch):
+    monkeypatch.setattr(settings, "CACHE", True)
+    monkeypatch.setattr(settings, "CACHE_TIMEOUT", 10)
+    monkeypatch.setattr(settings, "CACHE_STALE_TIMEOUT", 60)
+    invalidate()
+    metrics.reset()
+    key = f"{cache.PREFIX}:*:test:stale"
+    value = "fresh"
+
+    @cached(key_func=lambda: key)
+    def compute():
+        return value
+
+    assert compute() == "fresh"
+    value = "refreshed"
+    assert compute() == "fresh"
+    cache.memory.put(key, (time.time() - 20, "stale"))
+    assert compute() == "stale"  # served while refreshing
+    for _ in range(20):
+        if cache.memory.get(key)[1] == "refreshed":
+            break
+        time.sleep(0.05)
+    assert compute() == "refreshed"
+    assert metrics.counters["cache.stale"] == 1
+
+    cache.memory.put(key, (time.time() - 100, "expired"))
+    value = "new"
+    assert compute() == "new"
+
+
+def test_cache_cluster_lock(monkeypatch):
+    monkeypatch.setattr(settings, "CACHE_LOCK", True)
+    monkeypatch.setattr(settings, "CACHE_LOCK_TIMEOUT", 1)
+    with cluster_lock("test") as acquired:
+        assert acquired
+        with cluster_lock("test", blocking=False) as acquired:
+            assert not acquired
+    with cluster_lock("test", blocking=False) as acquired:
+        assert acquired
+
+
+def test_cache_no_api_key(monkeypatch):
+    monkeypatch.setattr(settings, "CACHE", True)
+    invalidate()
+    client = TestClient(app)
+    url = "/entities?dataset=gdho&limit=5"
+    res = client.get(f"{url}&api_key={settings.BUILD_API_KEY}")
+    assert res.status_code == 200
+    assert "api_key" not in res.text
+    res = client.get(url)
+    assert res.json()["next_url"]
+    assert "api_key" not in res.text
+    assert metrics.counters["cache.entity_list.hit"] >= 1
+    # absolute urls of the requested host
+    res = client.get(url, headers={"host": "example.org"})
+    assert res.json()["url"].startswith("http://example.org/")
+    assert "api_key" not in client.get("/facets?api_key=foo&dataset=gdho").text
@@ -0,0 +1,91 @@
+from fastapi.testclient import TestClient
+
+from ftmstore_fastapi import facets, settings, store
+from ftmstore_fastapi.api import app
+from ftmstore_fastapi.facets import (
+    get_facet_tables,
+    get_facets_path,
+    get_facets_version,
+    get_scope,
+    iter_counts,
+)
+from ftmstore_fastapi.query import Query
+from ftmstore_fastapi.store import SCOPE_ALL, get_catalog, get_store
+
+client = TestClient(app)
+
+
+def test_facets_scope():
+    assert get_scope(Query()) == SCOPE_ALL
+    assert get_scope(Query()[:10].where(dataset="gdho")) == "gdho"
+    datasets = sorted(get_catalog().names)
+    assert get_scope(Query().where(dataset__in=datasets)) == SCOPE_ALL
+    assert get_scope(Query().where(dataset__in=datasets[:2])) is None
+    assert get_scope(Query().where(schema="Organization")) is None
+    assert get_scope(Query().search("foundation")) is None
+
+
+def test_facets_tables(monkeypatch, tmp_path):
+    monkeypatch.setattr(settings, "PRELOAD_PATH", str(tmp_path))
+    monkeypatch.setattr(facets, "get_facets_version", lambda: "test")
+
+    # built without the cached store (and its connections), e.g. in the
+    # gunicorn master before forking the workers
+    def _get_store(*args, **kwargs):
+        raise RuntimeError("cached store used")
+
+    monkeypatch.setattr(store, "get_store", _get_store)
+    tables = get_facet_tables()
+    assert tables is not None
+    assert tables.path.parent == tmp_path
+    engine = get_store().engine
+    names = ["schema", "dataset", "country"]
+    for scope, datasets in {SCOPE_ALL: [], "gdho": ["gdho"]}.items():
+        filters = {"dataset": datasets[0]} if datasets else {}
+        computed = {f: [] for f in names}
+        for facet, value, count in iter_counts(engine, names, 5, **filters):
+            computed[facet].append((value, count))
+        assert tables.get_counts(scope, names, 5) == computed
+    counts = tables.get_counts(SCOPE_ALL, ["dataset", "country"], 2)
+    assert counts == {
+        "dataset": [("gdho", 4633), ("eu_authorities", 151)],
+        "country": [("us", 314), ("so", 262)],
+    }
+
+
+def test_facets_exposed_datasets(monkeypatch, tmp_path):
+    monkeypatch.setattr(settings, "PRELOAD_PATH", str(tmp_path))
+    monkeypatch.setattr(settings, "DATASETS", "*")
+    facets.load_tables.cache_clear()
+    path = get_facet_tables().path
+    assert path == get_facets_path(get_facets_version())
+    monkeypatch.setattr(settings, "DATASETS", "gdho")
+    other_path = get_facet_tables().path
+    assert other_path != path
+    assert other_path.exists()
+    # the tables of another instance are kept
+    assert path.exists()
+    # and rebuilt if removed
+    monkeypatch.setattr(settings, "DATASETS", "*")
+    path.unlink()
+    assert get_facet_tables().path == path
+    assert path.exists()
+    facets.load_tables.cache_clear()
+
+
+def test_facets_api():
+    res = client.get("/facets?facet=schema&facet=dataset&facet_limit=1")
+    assert res.status_code == 200
+    assert res.json()["facets"] == {
+        "schema": [{"value": "Organization", "count": 4633}],
+        "dataset": [{"value": "gdho", "count": 4633}],
+    }
+    res = client.get("/facets?facet=country&facet=sector&schema=Organization&q=found")
+    data = res.json()["facets"]
+    assert list(data) == ["country", "sector"]
+    assert data["country"][0] == {"value": "ye", "count": 49}
+    assert len(data["sector"]) == 10
+    res = client.get("/facets?facet=country&dataset=eu_authorities")
+    assert res.json()["facets"] == {"country": []}
+    assert client.get("/facets?facet=foo").status_code == 422
+    assert client.get("/facets").status_code == 422
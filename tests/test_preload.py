@@ -0,0 +1,89 @@
+import pytest
+from ftmq.query import Query
+from ftmq.store import get_store as _get_store
+
+from ftmstore_fastapi import settings, sortkeys
+from ftmstore_fastapi.preload import (
+    MIRROR_NAME,
+    PreloadError,
+    check_budget,
+    estimate_size,
+    get_snapshot_path,
+    preload,
+    snapshot,
+)
+from ftmstore_fastapi.store import get_catalog
+
+
+def get_store(uri: str):
+    return _get_store(uri=uri, catalog=get_catalog())
+
+
+def test_preload(monkeypatch, tmp_path):
+    source = settings.FTM_STORE_URI
+    uri = preload(source, ["eu_authorities"])
+    assert "mode=memory" in uri
+    store = get_store(uri=uri)
+    assert store.query().stats().entity_count == 151
+    assert not store.query().stats(Query().where(dataset="gdho")).entity_count
+    # reload
+    uri = preload(source, ["eu_authorities"])
+    assert get_store(uri=uri).query().stats().entity_count == 151
+
+    monkeypatch.setattr(settings, "SQLITE_IN_MEMORY", False)
+    monkeypatch.setattr(settings, "PRELOAD_PATH", str(tmp_path))
+    uri = preload(source)
+    assert str(tmp_path) in uri
+    store = get_store(uri=uri)
+    source_stats = get_store(uri=source).query().stats()
+    assert store.query().stats().entity_count == source_stats.entity_count
+
+    sizes = estimate_size(store.engine)
+    assert set(sizes) == {"eu_authorities", "gdho"}
+    assert sizes["gdho"] > sizes["eu_authorities"]
+    monkeypatch.setattr(settings, "PRELOAD_MEMORY_MB", 1)
+    with pytest.raises(PreloadError):
+        preload(source)
+    with pytest.raises(PreloadError):
+        preload("memory:///")
+
+    # none of the datasets in the store: not the whole store without budget
+    monkeypatch.setattr(settings, "PRELOAD_MEMORY_MB", 1024)
+    with pytest.raises(PreloadError):
+        preload(source, ["not_existing"])
+    assert check_budget(store.engine, ["gdho", "not_existing"]) == ["gdho"]
+    assert check_budget(store.engine) == ["eu_authorities", "gdho"]
+
+
+def test_preload_snapshot(monkeypatch, tmp_path):
+    monkeypatch.setattr(settings, "PRELOAD_PATH", str(tmp_path))
+    source = settings.FTM_STORE_URI
+    uri = snapshot(source, version="v1")
+    assert "immutable=1" in uri
+    path = get_snapshot_path("v1", source)
+    assert path.exists()
+    mtime = path.stat().st_mtime_ns
+    # built only once
+    assert snapshot(source, version="v1") == uri
+    assert path.stat().st_mtime_ns == mtime
+    store = get_store(uri)
+    assert store.query().stats().entity_count == 4784
+
+    # other instances' snapshots and worker mirrors are kept
+    mirror = tmp_path / f"{MIRROR_NAME}-1234.store"
+    mirror.touch()
+    uri = snapshot(source, ["gdho"], version="v2")
+    assert get_store(uri).query().stats().entity_count == 4633
+    assert get_snapshot_path("v2", source, ["gdho"]).exists()
+    assert path.exists()
+    snapshot(source, version="v2")
+    assert not path.exists()  # outdated
+    assert get_snapshot_path("v2", source, ["gdho"]).exists()
+    assert mirror.exists()
+
+    # the sort keys table is only built into snapshots with `SORT_KEYS`
+    assert sortkeys.exists(get_store(snapshot(source, version="v2")).engine)
+    monkeypatch.setattr(settings, "SORT_KEYS", False)
+    assert not get_snapshot_path("v2", source).exists()
+    uri = snapshot(source, version="v2")
+    assert not sortkeys.exists(get_store(uri).engine)
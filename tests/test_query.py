@@ -1,7 +1,12 @@
+from types import SimpleNamespace
+
 import pytest
+from ftmq.store import get_store
+from ftmq.util import make_proxy
 from pydantic import ValidationError
 
-from ftmstore_fastapi.query import Query, ViewQueryParams
+from ftmstore_fastapi.query import Cursor, Query, ViewQueryParams
+from ftmstore_fastapi.store import View
 
 
 def test_query():
@@ -61,3 +66,76 @@ def test_query():
     # invalid schema lookups
     with pytest.raises(ValidationError):
         ViewQueryParams(schema="foo")
+
+
+def test_query_cursor():
+    cursor = Cursor(id="eu-authorities-chafea", value="Chafea")
+    assert Cursor.decode(cursor.encode()) == cursor
+    with pytest.raises(ValueError):
+        Cursor.decode("foo")
+
+    params = ViewQueryParams(order_by="-name", limit=10, cursor=cursor.encode())
+    q = Query.from_params(params)
+    assert q.to_dict() == {
+        "limit": 10,
+        "offset": None,
+        "order_by": ["-name"],
+        "cursor": cursor.encode(),
+    }
+    assert q.cursor == cursor
+
+    with pytest.raises(ValidationError):
+        ViewQueryParams(cursor="foo")
+
+
+def test_query_cursor_numeric(tmp_path):
+    # the cursors have the sort values as sql casted them
+    store = get_store(uri=f"sqlite:///{tmp_path / 'test.store'}", dataset="test")
+    values = ["1,000.5", "12abc", "0.0", "5", "3.5", "abc", "-2", "1e3", "12", "0"]
+    with store.writer() as bulk:
+        for ix, value in enumerate(values):
+            data = {
+                "id": f"p{ix}",
+                "schema": "Payment",
+                "properties": {"amount": [value]},
+            }
+            bulk.add_entity(make_proxy(data, "test"))
+    view = SimpleNamespace(store=store, query=store.query())
+    for ascending in (True, False):
+        q = Query()[:3].order_by("amount", ascending=ascending)
+        ids = [p.id for p in store.query().entities(q[:100])]
+        assert len(ids) == len(values)
+        paged = []
+        while len(paged) <= len(ids):
+            proxies = list(store.query().entities(q))
+            paged.extend(p.id for p in proxies)
+            sort_values = View.get_sort_values(view, q, proxies)
+            cursor = q.get_next_cursor(proxies, sort_values)
+            if cursor is None:
+                break
+            q = q.after(cursor)
+        assert paged == ids
+
+
+def test_query_stats():
+    q1 = Query.from_params(ViewQueryParams(dataset=["gdho"], limit=10))
+    q2 = Query.from_params(
+        ViewQueryParams(dataset=["gdho"], limit=10, page=3, order_by="-name")
+    )
+    assert q1.to_dict() != q2.to_dict()
+    assert q1.stats_query.to_dict() == q2.stats_query.to_dict()
+    assert q1.stats_query.to_dict() == {"dataset__in": {"gdho"}}
+
+
+def test_query_projection():
+    q = Query().where(schema="Organization").project(["country"])
+    assert q.to_dict()["props"] == ["country"]
+    assert "props" not in q.stats_query.to_dict()
+    props = q.projected_props
+    assert props == sorted({"id", "country", "name"})
+    assert "prop IN" in str(q.sql.statements)
+    q = q.order_by("incorporationDate")
+    assert "incorporationDate" in q.projected_props
+    assert "description" in Query().project(["country"]).projected_props
+    assert Query().projected_props is None
+    assert "prop IN" not in str(Query().sql.statements)
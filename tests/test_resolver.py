@@ -0,0 +1,49 @@
+import os
+
+from nomenklatura.judgement import Judgement
+from nomenklatura.resolver import Resolver
+
+from ftmstore_fastapi import settings
+from ftmstore_fastapi.resolver import get_map_path, get_resolver_version, load_map
+
+
+def test_resolver_map(monkeypatch, tmp_path):
+    monkeypatch.setattr(settings, "PRELOAD_PATH", str(tmp_path))
+    path = tmp_path / "resolver.ijson"
+    resolver = Resolver(path)
+    canonical = resolver.decide("a", "b", Judgement.POSITIVE)
+    resolver.decide("b", "c", Judgement.POSITIVE)
+    resolver.decide("c", "d", Judgement.NEGATIVE)
+    resolver.save()
+
+    resolver_map = load_map(str(path))
+    map_path = get_map_path(get_resolver_version(str(path)), str(path))
+    assert resolver_map.path == map_path
+    assert resolver_map.get_canonical("a") == canonical.id
+    assert resolver_map.get_canonicals(["a", "b", "c", "d", "x", canonical.id]) == {
+        "a": canonical.id,
+        "b": canonical.id,
+        "c": canonical.id,
+        "d": "d",
+        "x": "x",
+        canonical.id: canonical.id,
+    }
+    for ix in ("a", "b", "c", "d"):
+        assert resolver_map.get_canonical(ix) == resolver.get_canonical(ix)
+
+    # rebuilt only after the resolver changed
+    mtime = map_path.stat().st_mtime_ns
+    assert load_map(str(path)).path == map_path
+    assert map_path.stat().st_mtime_ns == mtime
+    resolver.decide("d", "e", Judgement.POSITIVE)
+    resolver.save()
+    os.utime(path, ns=(mtime + 1_000_000_000, mtime + 1_000_000_000))
+    # the map of another resolver file is kept
+    other = Resolver(tmp_path / "other.ijson")
+    other.save()
+    other_path = load_map(str(tmp_path / "other.ijson")).path
+    resolver_map = load_map(str(path))
+    assert resolver_map.path != map_path
+    assert not map_path.exists()  # outdated
+    assert other_path.exists()
+    assert resolver_map.get_canonical("e") == resolver.get_canonical("e")
@@ -0,0 +1,136 @@
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import event
+
+from ftmstore_fastapi import search, settings, store
+from ftmstore_fastapi.api import app
+from ftmstore_fastapi.query import Query, ViewQueryParams
+from ftmstore_fastapi.search import get_index_props, get_search_index, to_fts_query
+
+client = TestClient(app)
+
+
+@pytest.fixture
+def search_index(monkeypatch, tmp_path):
+    monkeypatch.setattr(settings, "SEARCH_INDEX", True)
+    monkeypatch.setattr(settings, "PRELOAD_PATH", str(tmp_path))
+    monkeypatch.setattr(search, "_index", None)
+    get_index_props.cache_clear()
+    yield
+    get_index_props.cache_clear()
+
+
+def test_search_fts_query():
+    assert to_fts_query("Data protection") == '"Data" "protection"'
+    assert to_fts_query('amnes* "intl"') == '"amnes"* "intl"'
+    assert to_fts_query(" - ") is None
+
+
+def test_search_index(search_index):
+    index = get_search_index()
+    assert get_search_index() is index
+    assert index.search("") == []
+    res = index.search("data protection")
+    assert len(res) == 4
+    assert index.search("data protection", limit=2) == res[:2]
+    assert index.search("médecins") == index.search("medecins")
+    assert set(index.search("foundation")) < set(index.search("found*"))
+
+
+def test_search_index_cleanup(search_index, tmp_path):
+    path = get_search_index().path
+    # the index of another instance (store, datasets or properties)
+    other = tmp_path / f"{search.INDEX_NAME}-12345678-v1.db"
+    other.touch()
+    index = search.load_index("v2")
+    assert index.path.exists()
+    assert not path.exists()  # outdated
+    assert other.exists()
+
+
+def test_search_index_source(search_index, monkeypatch):
+    # built without the cached store (and its connections), e.g. in the
+    # gunicorn master before forking the workers
+    def get_store(*args, **kwargs):
+        raise RuntimeError("cached store used")
+
+    monkeypatch.setattr(store, "get_store", get_store)
+    index = get_search_index()
+    assert index is not None
+    assert len(index.search("data protection")) == 4
+
+
+@pytest.mark.parametrize("attached", [False, True])
+def test_search_index_api(search_index, attached, monkeypatch):
+    engine = store.get_store().engine
+    if search.is_attached(engine):
+        event.remove(engine, "checkout", search._attach)
+    if attached:
+        # restricted via a subquery on the attached index instead of bound ids
+        search.attach(engine)
+        get_search_index()
+        query = Query.from_params(ViewQueryParams(q="data protection"))
+        assert query.search_matches is not None
+        sql = query.sql.all_canonical_ids.compile()
+        assert "search_index.search" in str(sql)
+        assert not any(v == query.search_ids for v in sql.params.values())
+    assert search.is_attached(engine) == attached
+    res = client.get("/entities?q=data+protection")
+    assert res.status_code == 200
+    data = res.json()
+    assert data["total"] == data["items"] == data["stats"]["entity_count"] == 4
+    ids = [e["id"] for e in data["entities"]]
+    assert ids == get_search_index().search("data protection")
+    assert data["entities"][0]["caption"] == "Data Protection Officer"
+
+    # pagination in rank order
+    res = client.get("/entities?q=data+protection&limit=2&page=2").json()
+    assert [e["id"] for e in res["entities"]] == ids[2:]
+    res = client.get("/entities?q=data+protection&limit=3").json()
+    assert [e["id"] for e in res["entities"]] == ids[:3]
+    res = client.get(res["next_url"]).json()
+    assert [e["id"] for e in res["entities"]] == ids[3:]
+    res = client.get(res["prev_url"]).json()
+    assert [e["id"] for e in res["entities"]] == ids[:3]
+
+    # explicit sort and other filters
+    res = client.get("/entities?q=data+protection&order_by=name").json()
+    assert sorted(ids) == sorted(e["id"] for e in res["entities"])
+    assert res["entities"][0]["caption"] == "Article 29 Working Party"
+    res = client.get("/entities?q=found*&dataset=eu_authorities").json()
+    assert res["total"] == 4
+    assert {d for e in res["entities"] for d in e["datasets"]} == {"eu_authorities"}
+    res = client.get("/entities?q=found*&stats=false").json()
+    assert res["total"] == 292
+    if attached:
+        res = client.get("/facets?facet=country&q=found*&dataset=eu_authorities")
+        assert res.json()["facets"] == {"country": []}
+        event.remove(engine, "checkout", search._attach)
+
+
+def test_search_index_retrieve_once(search_index, monkeypatch):
+    # the ranked page is retrieved (e.g. featured) only once
+    retrieved = []
+    retrieve = store.View.retrieve
+
+    def _retrieve(self, proxy, params):
+        retrieved.append(proxy.id)
+        return retrieve(self, proxy, params)
+
+    monkeypatch.setattr(store.View, "retrieve", _retrieve)
+    data = client.get("/entities?q=data+protection&featured=1").json()
+    ids = [e["id"] for e in data["entities"]]
+    assert ids == get_search_index().search("data protection")
+    assert sorted(retrieved) == sorted(ids)
+
+
+def test_search_index_properties(search_index, monkeypatch):
+    assert "sector" not in get_index_props()[1]
+    url = "/entities?q=logistics&stats=false"
+    total = client.get(url).json()["total"]
+    monkeypatch.setattr(settings, "INDEX_PROPERTIES", ["sector"])
+    monkeypatch.setattr(search, "_index", None)
+    get_index_props.cache_clear()
+    # (different query, as responses are cached independent of the index)
+    res = client.get(url + "&schema=Organization").json()
+    assert res["total"] > total
@@ -0,0 +1,123 @@
+import gzip
+import json
+
+from fastapi import Request
+from fastapi.responses import RedirectResponse
+from ftmq.io import smart_read_proxies
+from ftmq.util import make_proxy
+
+from ftmstore_fastapi.query import Cursor
+from ftmstore_fastapi.serialize import (
+    CachedResponse,
+    EntitiesResponse,
+    EntityResponse,
+)
+from ftmstore_fastapi.store import get_view
+
+
+def test_serialize_nested_limit():
+    person = make_proxy(
+        {"id": "p", "schema": "Person", "properties": {"name": ["Jane"]}}
+    )
+    memberships = [
+        make_proxy(
+            {
+                "id": f"m{i}",
+                "schema": "Membership",
+                "properties": {"member": ["p"], "organization": [f"o{i}"]},
+            }
+        )
+        for i in range(5)
+    ]
+    payment = make_proxy(
+        {
+            "id": "pay",
+            "schema": "Payment",
+            "properties": {"payer": ["p", "o1", "o2"], "amount": ["10"]},
+        }
+    )
+    res = EntityResponse.from_entity(payment, [person], nested_limit=3)
+    assert len(res.properties["payer"]) == 3
+    assert [v.id for v in res.properties["payer"] if not isinstance(v, str)] == ["p"]
+    assert res.truncated is None
+
+    res = EntityResponse.from_entity(payment, [person], nested_limit=2)
+    assert len(res.properties["payer"]) == 2
+    assert res.truncated == {"payer": 1}
+    assert res.model_dump()["truncated"] == {"payer": 1}
+
+    res = EntityResponse.from_entity(memberships[0], [person], nested_limit=2)
+    assert res.properties["member"][0].caption == "Jane"
+    assert res.truncated is None
+    assert "truncated" not in res.model_dump()
+
+
+def test_serialize_cached_response():
+    def _request(encoding: str) -> Request:
+        headers = [(b"accept-encoding", encoding.encode())]
+        return Request({"type": "http", "headers": headers})
+
+    entity = EntityResponse.from_entity(
+        make_proxy({"id": "p", "schema": "Person", "properties": {"name": ["Jane"]}})
+    )
+    cached = CachedResponse.from_result(entity)
+    assert cached.compressed
+    res = cached.to_response(_request("gzip, deflate"))
+    assert res.headers["content-encoding"] == "gzip"
+    assert res.headers["content-type"] == "application/json"
+    assert gzip.decompress(res.body) == entity.model_dump_json(by_alias=True).encode()
+    res = cached.to_response(_request("identity"))
+    assert "content-encoding" not in res.headers
+    assert json.loads(res.body)["schema"] == "Person"
+
+    redirect = RedirectResponse("/entities/q", headers={"x-entity-id": "q"})
+    cached = CachedResponse.from_result(redirect)
+    assert not cached.compressed
+    res = cached.to_response(_request("gzip"))
+    assert res.status_code == 307
+    assert res.headers["location"] == "/entities/q"
+    assert res.headers["x-entity-id"] == "q"
+    assert res.body == b""
+
+
+def test_serialize_fast_path():
+    request = Request(
+        {
+            "type": "http",
+            "scheme": "http",
+            "server": ("testserver", 80),
+            "path": "/entities",
+            "query_string": b"limit=3&nested=true",
+            "headers": [(b"host", b"testserver")],
+        }
+    )
+    entities = [*smart_read_proxies("./tests/fixtures/eu_authorities.ftm.json")]
+    membership = make_proxy(
+        {
+            "id": "m",
+            "schema": "Membership",
+            "properties": {"member": ["p"], "organization": [e.id for e in entities]},
+            "datasets": ["gdho"],
+        }
+    )
+    person = make_proxy(
+        {"id": "p", "schema": "Person", "properties": {"name": ['Jäne "Doe"']}}
+    )
+    kwargs = {
+        "stats": get_view().stats(),
+        "next_cursor": Cursor(id="eu-authorities-acer"),
+        "total": 200,
+    }
+    for items, adjacents in (
+        (entities[:3], None),
+        ([membership, *entities], [person, *entities[:2]]),
+    ):
+        for nested_limit in (None, 2):
+            expected = EntitiesResponse.from_view(
+                request, items, adjacents=adjacents, nested_limit=nested_limit, **kwargs
+            ).model_dump_json(by_alias=True)
+            res = EntitiesResponse.dump_view(
+                request, items, adjacents=adjacents, nested_limit=nested_limit, **kwargs
+            )
+            assert res == expected.encode()
+    assert b"truncated" in res
@@ -0,0 +1,109 @@
+from followthemoney import model
+from ftmq.store import get_store as _get_store
+from ftmq.util import make_proxy
+
+from ftmstore_fastapi import settings, sortkeys
+from ftmstore_fastapi.preload import preload
+from ftmstore_fastapi.query import Cursor, Query
+from ftmstore_fastapi.store import get_catalog, get_store
+
+
+def test_sortkeys_keys():
+    assert sortkeys.is_sortable("amount")
+    assert sortkeys.is_sortable("incorporationDate")
+    assert not sortkeys.is_sortable("name")
+    assert not sortkeys.is_sortable("foo")
+    assert sortkeys.to_sort_key("amount", "1,000.5") == 1000.5
+    assert sortkeys.to_sort_key("amount", "foo") == 0
+    assert sortkeys.to_sort_key("amount", 12) == 12
+    assert sortkeys.to_sort_key("date", "2014") == 20140000000000
+    assert sortkeys.to_sort_key("date", "2014-05-03T10:20") == 20140503102000
+    assert sortkeys.to_sort_key("date", "2014") < sortkeys.to_sort_key(
+        "date", "2014-01-01"
+    )
+    assert sortkeys.to_sort_key("date", "foo") is None
+    assert sortkeys.to_sort_key("date", None) is None
+
+
+def test_sortkeys_query(monkeypatch, tmp_path):
+    assert not sortkeys.exists(get_store().engine)
+    monkeypatch.setattr(settings, "SQLITE_IN_MEMORY", False)
+    monkeypatch.setattr(settings, "PRELOAD_PATH", str(tmp_path))
+    store = _get_store(uri=preload(settings.FTM_STORE_URI), catalog=get_catalog())
+    assert sortkeys.exists(store.engine)
+
+    def get_ids(q: Query) -> list[str]:
+        return [e.id for e in store.query().entities(q)]
+
+    for ascending in (True, False):
+        q = Query()[:10].where(dataset="gdho")
+        q = q.order_by("incorporationDate", ascending=ascending)
+        proxies = list(store.query().entities(q))
+        assert len(proxies) == 10
+        assert get_ids(q.use_sort_keys()) == [p.id for p in proxies]
+        for proxy in proxies[3], proxies[7]:
+            for reverse in (False, True):
+                cursor = Cursor.from_proxy(proxy, q.sort, reverse=reverse)
+                ids = get_ids(q.after(cursor))
+                assert ids
+                assert get_ids(q.after(cursor).use_sort_keys()) == ids
+
+    monkeypatch.setattr(settings, "SORT_KEYS", False)
+    engine = _get_store(uri=preload(settings.FTM_STORE_URI)).engine
+    assert not sortkeys.exists(engine)
+
+
+def test_sortkeys_cursor_dates():
+    proxy = model.make_entity("Company")
+    proxy.id = "c"
+    proxy.add("incorporationDate", ["2014-05", "2015", "unknown"], cleaned=True)
+    for ascending, value in ((True, "2014-05"), (False, "2015")):
+        sort = Query().order_by("incorporationDate", ascending=ascending).sort
+        cursor = Cursor.from_proxy(proxy, sort)
+        # the same value as the entity's sort key
+        assert cursor.value == value
+        key = sortkeys.to_sort_key("incorporationDate", cursor.value)
+        assert key == (20140500000000 if ascending else 20150000000000)
+
+
+def test_sortkeys_invalid_dates(tmp_path):
+    # entities without a parseable date are sorted last instead of dropped
+    store = _get_store(uri=f"sqlite:///{tmp_path / 'store.db'}", dataset="test")
+    with store.writer() as bulk:
+        for i, date in enumerate(("2014", "unknown", "2012-05", "2020", "n/a")):
+            data = {
+                "id": f"c{i}",
+                "schema": "Company",
+                "properties": {"name": [f"Company {i}"], "incorporationDate": [date]},
+            }
+            bulk.add_entity(make_proxy(data, "test"))
+    assert sortkeys.build(store.engine) == 5
+
+    def get_pages(q: Query) -> list[list[str]]:
+        pages, cursor = [], None
+        while True:
+            page = q if cursor is None else q.after(cursor)
+            proxies = list(store.query().entities(page))
+            if not proxies:
+                return pages
+            pages.append([p.id for p in proxies])
+            sql = page.sql.get_sort_values([proxies[-1].id])
+            with store.engine.connect() as conn:
+                values = dict(conn.execute(sql).all())
+            cursor = Cursor.from_proxy(proxies[-1], q.sort, values=values)
+
+    for ascending in (True, False):
+        q = Query()[:2].where(dataset="test")
+        q = q.order_by("incorporationDate", ascending=ascending)
+        pages = get_pages(q.use_sort_keys())
+        ids = [i for p in pages for i in p]
+        assert sorted(ids) == sorted(i for p in get_pages(q) for i in p)
+        assert ids[-2:] == ["c1", "c4"]
+        assert ids[:3] == (["c2", "c0", "c3"] if ascending else ["c3", "c0", "c2"])
+
+        # from the entities without key back to the others
+        cursor = Cursor.from_proxy(
+            store.view(store.dataset).get_entity("c1"), q.sort, reverse=True
+        )
+        q = q.use_sort_keys().after(cursor)
+        assert [e.id for e in store.query().entities(q)] == ids[1:3]
@@ -0,0 +1,112 @@
+import time
+
+from fastapi.testclient import TestClient
+
+from ftmstore_fastapi import settings, stats
+from ftmstore_fastapi.api import app
+from ftmstore_fastapi.stats import get_dataset_stats, get_stats_path
+
+client = TestClient(app)
+
+
+def test_stats_snapshot(monkeypatch, tmp_path):
+    monkeypatch.setattr(settings, "STATS_PATH", str(tmp_path))
+    monkeypatch.setattr(stats, "_stats", None)
+    monkeypatch.setattr(stats, "get_store_fingerprint", lambda: "v1")
+    res = get_dataset_stats(timeout=30)
+    assert res["eu_authorities"].entity_count == 151
+    assert res["gdho"].entity_count == 4633
+    path = get_stats_path("v1")
+    time.sleep(0.1)  # written after the last dataset is done
+    assert path.exists()
+    mtime = path.stat().st_mtime_ns
+
+    # reused within the process and from the file (other workers, restarts)
+    assert get_dataset_stats("gdho", timeout=0)["gdho"] is res["gdho"]
+    monkeypatch.setattr(stats, "_stats", None)
+    loaded = get_dataset_stats(timeout=30)
+    assert loaded["gdho"] == res["gdho"]
+    assert path.stat().st_mtime_ns == mtime
+
+    # store changed
+    other = tmp_path / f"{stats.STATS_NAME}-12345678-v1.json"  # another instance
+    other.touch()
+    monkeypatch.setattr(stats, "get_store_fingerprint", lambda: "v2")
+    assert get_dataset_stats("gdho", timeout=30)["gdho"].entity_count == 4633
+    time.sleep(0.1)
+    assert get_stats_path("v2").exists()
+    assert not path.exists()  # outdated
+    assert other.exists()
+
+
+def test_stats_pending(monkeypatch, tmp_path):
+    monkeypatch.setattr(settings, "STATS_PATH", str(tmp_path))
+    monkeypatch.setattr(stats, "_stats", None)
+    monkeypatch.setattr(stats, "get_store_fingerprint", lambda: "slow")
+    get_view = stats.get_view
+
+    class SlowView:
+        def __init__(self, name):
+            self.name = name
+
+        def stats(self):
+            if self.name == "gdho":
+                time.sleep(1)
+            return get_view(self.name).stats()
+
+    monkeypatch.setattr(stats, "get_view", SlowView)
+    monkeypatch.setattr(settings, "STATS_TIMEOUT", 0.2)
+    res = client.get("/catalog")
+    assert res.status_code == 200
+    assert res.headers["cache-control"] == "no-store"
+    assert "etag" not in res.headers
+    data = res.json()
+    assert data["stats_pending"]
+    datasets = {d["name"]: d for d in data["datasets"]}
+    assert datasets["gdho"]["stats_pending"]
+    assert not datasets["eu_authorities"]["stats_pending"]
+    assert datasets["eu_authorities"]["entity_count"] == 151
+
+    # partial response was not cached
+    time.sleep(1)
+    data = client.get("/catalog").json()
+    assert not data["stats_pending"]
+    datasets = {d["name"]: d for d in data["datasets"]}
+    assert datasets["gdho"]["entity_count"] == 4633
+
+
+def test_stats_failed(monkeypatch, tmp_path):
+    monkeypatch.setattr(settings, "STATS_PATH", str(tmp_path))
+    monkeypatch.setattr(stats, "_stats", None)
+    monkeypatch.setattr(stats, "get_store_fingerprint", lambda: "failed")
+    get_view = stats.get_view
+    failing = {"gdho"}
+    computed = []
+
+    class FailingView:
+        def __init__(self, name):
+            self.name = name
+
+        def stats(self):
+            computed.append(self.name)
+            if self.name in failing:
+                raise RuntimeError("failed")
+            return get_view(self.name).stats()
+
+    monkeypatch.setattr(stats, "get_view", FailingView)
+    res = get_dataset_stats(timeout=30)
+    assert res["gdho"] is None  # pending
+    assert res["eu_authorities"].entity_count == 151
+    # the other datasets are persisted
+    time.sleep(0.1)
+    path = get_stats_path("failed")
+    assert set(stats.load_stats(path)) == set(res) - {"gdho"}
+
+    # only the failed dataset is computed again (e.g. on restart)
+    failing.clear()
+    computed.clear()
+    monkeypatch.setattr(stats, "_stats", None)
+    assert get_dataset_stats("gdho", timeout=30)["gdho"].entity_count == 4633
+    assert computed == ["gdho"]
+    time.sleep(0.1)
+    assert set(stats.load_stats(path)) == set(res)
@@ -0,0 +1,79 @@
+from ftmq.store import get_store as _get_store
+
+from ftmstore_fastapi import settings, store
+from ftmstore_fastapi.metrics import metrics
+from ftmstore_fastapi.query import Query, ViewQueryParams
+from ftmstore_fastapi.store import (
+    View,
+    entity_cache,
+    get_catalog,
+    get_entity_size,
+    get_exposed_datasets,
+    get_view,
+)
+
+
+def test_store_expose_datasets(monkeypatch):
+    assert get_exposed_datasets() is None
+    assert not Query.from_params(ViewQueryParams()).dataset_names
+
+    monkeypatch.setattr(settings, "DATASETS", "gdho, not_existing")
+    get_catalog.cache_clear()
+    try:
+        assert get_exposed_datasets() == ["gdho", "not_existing"]
+        catalog = get_catalog()
+        assert catalog.names == {"gdho"}
+        with monkeypatch.context() as m:
+            m.setattr(store, "CATALOG", None)
+            assert get_catalog.__wrapped__(None).names == {"gdho", "not_existing"}
+        q = Query.from_params(ViewQueryParams())
+        assert q.dataset_names == {"gdho"}
+        q = Query.from_params(ViewQueryParams(dataset=["gdho"]))
+        assert q.dataset_names == {"gdho"}
+    finally:
+        get_catalog.cache_clear()
+
+
+def test_store_entity_cache():
+    view = get_view("gdho")
+    entity_cache.invalidate()
+    metrics.reset()
+    proxy = entity_cache.get(view, "gdho-100")
+    assert proxy.id == "gdho-100"
+    assert entity_cache.get(view, "gdho-100") is proxy
+    assert entity_cache.get(view, "not-existing") is None
+    assert entity_cache.get(view, "not-existing") is None
+    assert metrics.counters["entity_cache.hit"] == 2
+    assert metrics.counters["entity_cache.miss"] == 2
+    assert entity_cache.cache.nbytes > get_entity_size(proxy)
+
+    all_view = get_view()
+    assert entity_cache.get(all_view, "gdho-100") == proxy
+    assert entity_cache.get(get_view("eu_authorities"), "eu-authorities-a29wp")
+    assert entity_cache.invalidate("gdho") == 3  # incl. lookups across datasets
+    assert len(entity_cache.cache) == 1
+
+
+def test_store_load_entities_memory(monkeypatch):
+    # non-sql stores look up entities directly instead of scanning the store
+    source = get_view("gdho")
+    memory = _get_store.__wrapped__(uri="memory:///", catalog=get_catalog())
+    with memory.writer() as bulk:
+        for proxy in source.load_entities(["gdho-100", "gdho-1109"]):
+            bulk.add_entity(proxy)
+    view = View.__new__(View)
+    view.dataset = "memory"
+    view.store = memory
+    view.query = memory.query()
+    view.view = memory.default_view()
+
+    def entities(*args, **kwargs):
+        raise RuntimeError("store scanned")
+
+    monkeypatch.setattr(view.query, "entities", entities)
+    ids = [p.id for p in view.load_entities(["gdho-1109", "not-existing", "gdho-100"])]
+    assert ids == ["gdho-1109", "gdho-100"]
+    res = entity_cache.get_many(view, ["gdho-100", "not-existing"])
+    assert res["gdho-100"].id == "gdho-100"
+    assert res["not-existing"] is None
+    entity_cache.invalidate()
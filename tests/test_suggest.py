@@ -0,0 +1,103 @@
+from threading import Event
+
+from fastapi.testclient import TestClient
+from followthemoney import model
+
+from ftmstore_fastapi import cache, store, suggest, views
+from ftmstore_fastapi.api import app
+from ftmstore_fastapi.suggest import SuggestIndex, Suggestion, get_suggest_index
+
+client = TestClient(app)
+
+
+def test_suggest_index():
+    index = SuggestIndex(
+        "v1",
+        [
+            Suggestion("a", "Organization", "Somali Hope Foundation"),
+            Suggestion("b", "Person", "Jane Hope"),
+            Suggestion("c", "Company", "Hopewell Ltd."),
+            Suggestion("d", "Organization", "Médecins du Monde"),
+        ],
+    )
+    assert [s.id for s in index.suggest("hope")] == ["c", "b", "a"]
+    assert [s.id for s in index.suggest("HOPE F")] == ["a"]
+    assert [s.id for s in index.suggest("hope", limit=1)] == ["c"]
+    assert [s.id for s in index.suggest("hope", model["Organization"])] == ["c", "a"]
+    assert [s.id for s in index.suggest("medecins")] == ["d"]
+    assert [s.id for s in index.suggest("médecins du")] == ["d"]
+    assert index.suggest("-") == []
+    assert index.suggest("xyz") == []
+
+
+def test_suggest_api():
+    assert get_suggest_index() is get_suggest_index()
+    res = client.get("/suggest?prefix=data+prot")
+    assert res.status_code == 200
+    data = res.json()
+    assert data["items"] == 3
+    assert data["suggestions"][0] == {
+        "id": "eu-authorities-dpo",
+        "caption": "Data Protection Officer",
+        "schema": "PublicBody",
+    }
+    data = client.get("/suggest?prefix=eur&schema=PublicBody&limit=3").json()
+    assert data["items"] == 3
+    assert all(s["schema"] == "PublicBody" for s in data["suggestions"])
+    assert client.get("/suggest?prefix=eur&schema=Foo").status_code == 422
+    assert client.get("/suggest?prefix=").status_code == 422
+    assert client.get("/suggest?prefix=e&limit=1000").status_code == 422
+
+
+def test_suggest_index_schemata():
+    suggestions = [Suggestion(f"p{i}", "Person", f"Europe {i}") for i in range(100)]
+    suggestions.append(Suggestion("x", "PublicBody", "Europol"))
+    index = SuggestIndex("v1", suggestions)
+    assert set(index.captions) == {"Person", "PublicBody"}
+    # the filtered lookup only walks the keys of matching schemata
+    array = index.captions["Person"]
+    keys = array.keys
+    array.keys = []
+    assert [s.id for s in index.suggest("euro", model["PublicBody"])] == ["x"]
+    assert [s.id for s in index.suggest("euro", model["LegalEntity"])] == ["x"]
+    array.keys = keys
+    assert len(index.suggest("euro", model["LegalEntity"], limit=200)) == 101
+    assert [s.id for s in index.suggest("europe 1", limit=3)] == ["p1", "p10", "p11"]
+
+
+def test_suggest_index_rebuild(monkeypatch):
+    index = get_suggest_index()
+    monkeypatch.setattr(suggest, "_index", index)
+    built = Event()
+
+    def build_index(version):
+        built.wait(5)
+        return SuggestIndex(version, [])
+
+    monkeypatch.setattr(suggest, "build_index", build_index)
+    monkeypatch.setattr(suggest, "get_store_fingerprint", lambda: "v2")
+    monkeypatch.setattr(views, "get_store_fingerprint", lambda: "v2")
+    monkeypatch.setattr(cache, "get_store_fingerprint", lambda: "v2")
+    # the outdated index answers while the current one is built
+    assert get_suggest_index() is index
+    rebuild = suggest._rebuild
+    assert not rebuild.done()
+    res = client.get("/suggest?prefix=data+prot")
+    assert res.json()["index_pending"]
+    assert res.json()["items"] == 3
+    assert res.headers["cache-control"] == "no-store"
+    assert suggest._rebuild is rebuild  # not submitted again
+    built.set()
+    rebuild.result(5)
+    assert get_suggest_index().version == "v2"
+    res = client.get("/suggest?prefix=data+prot")
+    assert not res.json()["index_pending"]
+    assert res.json()["items"] == 0
+
+
+def test_suggest_index_load(monkeypatch):
+    index = get_suggest_index()
+    monkeypatch.setattr(store, "get_store", lambda *args: 1 / 0)
+    monkeypatch.setattr(suggest, "_index", None)
+    assert suggest.load_index().suggestions == index.suggestions
+    assert get_suggest_index() is suggest.load_index()